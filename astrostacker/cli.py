@@ -0,0 +1,243 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+import tifffile as tf
+from astropy.io import fits as pyfits
+from astrostacker.img.stack import stack
+from astrostacker.img.calibrate import load_calibration
+from astrostacker.img.debayer import RGGB
+from astrostacker.img.reject import MEAN, MEMORY_BUDGET
+from astrostacker.img.report import StackReport, WRITE, CPROFILE, TRACEMALLOC
+from astrostacker.img.drizzle import SCALE, PIXFRAC
+from astrostacker.img.warp import SHIFT
+from astrostacker.img.distributed import stack_distributed, serve, parse_address, HOST, TOKEN_VARIABLE
+from astrostacker.img.lucky import lucky_stack, KEEP_PERCENT
+from astrostacker.img.register import STARS
+
+logger = logging.getLogger()
+
+# Headless stacking of jobs listed in JSON job file:
+# {
+#     "cpu": 8,                      optional, number of processes all jobs may use at once
+#     "memory": 8192,                optional, MB of memory all jobs may use at once
+#     "jobs": [
+#         {
+#             "name": "M31",
+#             "files": ["m31/1.fits", "m31/2.fits"] or "m31/*.fits",
+#             "output": "m31.tif",
+#             "ref_frame_idx": 0, "debayer": false, "mask": "rggb", "workers": 4,
+#             "method": "mean", "kappa": 3.0, "superpixel": false, "binning": 1,
+#             "bias": [...], "darks": [...], "flats": [...],   calibration files, the same way as files
+#             "cache": true,                                cache registration next to reference frame
+#             "reject_percentile": 10,                      reject worst frames, reference becomes the best one
+#             "drizzle": false, "drizzle_scale": 2.0, "pixfrac": 0.7,
+#             "interpolation": "shift",                     or "bilinear", "lanczos"
+#             "integrators": 0,                             processes adding frames to tiles of stack in shared memory
+#             "registration": "stars",                      or "phase" for phase correlation of translated frames
+#             "hosts": ["box1:5730", "box2"]                mean stack by workers started with --serve on those hosts,
+#                                                           options method, reject_percentile, drizzle, registration,
+#                                                           workers and integrators do not apply to it
+#             "token": "...",                               shared token of workers, by default --token
+#             "keep_percent": 10                            for SER videos, lucky imaging stack of the sharpest frames
+#         }
+#     ]
+# }
+# Files ending with .ser are SER videos, each job stacks its first video by lucky imaging (astrostacker.img.lucky),
+# only options debayer and keep_percent apply to them.
+# Relative paths are relative to the job file. Jobs run concurrently as long as the sum of their workers
+# and estimated memory fits in budget. Result of every job is written to JSON results file, performance report
+# of every job (astrostacker.img.report) next to its output as <output>.report.json.
+
+
+# Returns list of files given as list or glob pattern, relative to base_dir.
+def expand_files(files, base_dir):
+    if files is None:
+        return []
+    if isinstance(files, str):
+        return sorted(glob.glob(os.path.join(base_dir, files)))
+    return [os.path.join(base_dir, f) for f in files]
+
+
+# Returns True if job stacks SER video.
+def is_video_job(job):
+    return job['files'][0].lower().endswith('.ser')
+
+
+# Estimates memory used by stacking job in bytes from size of its reference frame:
+# int64 accumulator and coverage (or drizzle planes), frames read ahead and frames in flight in worker processes.
+def estimate_memory(job):
+    if is_video_job(job):
+        # frames are memory mapped, blocks of frames are scored and aligned at once
+        return 256 * 1024 ** 2
+    header = pyfits.getheader(job['files'][job.get('ref_frame_idx', 0)])
+    pixels = header.get('NAXIS1', 0) * header.get('NAXIS2', 0) * max(1, header.get('NAXIS3', 1))
+    frames = 4 + 3 * job.get('workers', 1)
+    estimate = pixels * (12 + 4 * frames)
+    if job.get('drizzle', False):
+        estimate += int(pixels * job.get('drizzle_scale', SCALE) ** 2 * 8)
+    if job.get('method', MEAN) != MEAN:
+        estimate += MEMORY_BUDGET
+    return estimate
+
+
+# Options of job which do not apply to distributed stacking and their default values.
+DISTRIBUTED_DEFAULTS = {'method': MEAN, 'reject_percentile': None, 'drizzle': False, 'registration': STARS,
+                        'workers': 1, 'integrators': 0}
+
+
+# Raises exception if distributed job sets options which distributed stacking does not support.
+def check_distributed_job(job):
+    unsupported = [option for option, default in DISTRIBUTED_DEFAULTS.items() if job.get(option, default) != default]
+    if len(unsupported) > 0:
+        raise Exception(f'Options not supported by distributed stacking (hosts): {", ".join(unsupported):s}')
+
+
+# Runs single job and returns its result. Job can be profiled with CPROFILE or TRACEMALLOC.
+def run_job(job, profile=None):
+    result = {'name': job['name'], 'output': job['output'], 'frames': len(job['files'])}
+    started = time.time()
+    report = StackReport(profile)
+    report.start(len(job['files']))
+    try:
+        ref_frame_idx = job.get('ref_frame_idx', 0)
+        cache_dir = os.path.dirname(job['files'][ref_frame_idx]) if job.get('cache', True) else None
+        calibration = None
+        if (job['bias'] or job['darks'] or job['flats']) and not job.get('hosts') and not is_video_job(job):
+            calibration = load_calibration(job['bias'], job['darks'], job['flats'], cache_dir=cache_dir)
+        superpixel = job.get('superpixel', False)
+        if is_video_job(job):
+            data = lucky_stack(job['files'][0], job.get('keep_percent', KEEP_PERCENT), job.get('debayer', False))
+        elif job.get('hosts'):
+            check_distributed_job(job)
+            calibration_files = (job['bias'], job['darks'], job['flats'])
+            data = stack_distributed(job['files'], job['hosts'], debayer_result=job.get('debayer', False),
+                                     mask=job.get('mask', RGGB), ref_frame_idx=ref_frame_idx, superpixel=superpixel,
+                                     binning=job.get('binning', 1), calibration_files=calibration_files,
+                                     cache_dir=cache_dir, interpolation=job.get('interpolation', SHIFT),
+                                     token=job.get('token'))
+        else:
+            data = stack(job['files'], job.get('debayer', False), job.get('mask', RGGB), ref_frame_idx,
+                         job.get('workers', 1), method=job.get('method', MEAN), kappa=job.get('kappa', 3.0),
+                         cache_dir=cache_dir, superpixel=superpixel, binning=job.get('binning', 1),
+                         calibration=calibration, reject_percentile=job.get('reject_percentile'), report=report,
+                         drizzle=job.get('drizzle', False), drizzle_scale=job.get('drizzle_scale', SCALE),
+                         pixfrac=job.get('pixfrac', PIXFRAC), interpolation=job.get('interpolation', SHIFT),
+                         integrators=job.get('integrators', 0),
+                         registration_method=job.get('registration', STARS))
+        logger.info(f'Saving {job["output"]:s}')
+        with report.time(WRITE):
+            tf.imwrite(job['output'], data.astype(np.uint16))
+        result['status'] = 'ok'
+        result['shape'] = list(data.shape)
+    except Exception as e:
+        logger.exception(f'Job {job["name"]:s} failed.')
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['started'] = started
+    result['seconds'] = time.time() - started
+    report.finish()
+    result['report'] = os.path.splitext(job['output'])[0] + '.report.json'
+    report.save(result['report'])
+    return result
+
+
+# Runs jobs concurrently within cpu (number of processes) and memory (bytes) budget.
+# Job needing more than whole budget runs alone. Returns list of job results in order of jobs.
+def run_jobs(jobs, cpu, memory, profile=None):
+    results = [None] * len(jobs)
+    pending = list(range(0, len(jobs)))
+    lock = threading.Condition()
+    # used budget and number of running jobs
+    used = {'cpu': 0, 'memory': 0, 'running': 0}
+    needs = [(min(job.get('workers', 1) + job.get('integrators', 0), cpu), estimate_memory(job)) for job in jobs]
+
+    def run(i):
+        results[i] = run_job(jobs[i], profile)
+        with lock:
+            used['cpu'] -= needs[i][0]
+            used['memory'] -= needs[i][1]
+            used['running'] -= 1
+            lock.notify_all()
+
+    threads = []
+    with lock:
+        while len(pending) > 0:
+            for i in list(pending):
+                job_cpu, job_memory = needs[i]
+                fits_budget = used['cpu'] + job_cpu <= cpu and used['memory'] + job_memory <= memory
+                if fits_budget or used['running'] == 0:
+                    pending.remove(i)
+                    used['cpu'] += job_cpu
+                    used['memory'] += job_memory
+                    used['running'] += 1
+                    logger.info(f'Starting job {jobs[i]["name"]:s}')
+                    thread = threading.Thread(target=run, args=(i,), name=jobs[i]['name'])
+                    thread.start()
+                    threads.append(thread)
+            if len(pending) > 0:
+                lock.wait()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Reads job file, resolving paths relative to it.
+def read_job_file(filename):
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as f:
+        job_file = json.load(f)
+    jobs = []
+    for i, job in enumerate(job_file['jobs']):
+        job = dict(job)
+        job.setdefault('name', f'job{i:d}')
+        job['files'] = expand_files(job.get('files'), base_dir)
+        if len(job['files']) == 0:
+            raise Exception(f'No files to stack in job {job["name"]:s}.')
+        job['output'] = os.path.join(base_dir, job.get('output', job['name'] + '.tif'))
+        for kind in ('bias', 'darks', 'flats'):
+            job[kind] = expand_files(job.get(kind), base_dir)
+        jobs.append(job)
+    return job_file, jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='astrostacker', description='Stacks jobs listed in JSON job file.')
+    parser.add_argument('job_file', nargs='?')
+    parser.add_argument('--cpu', type=int, help='number of processes all jobs may use at once')
+    parser.add_argument('--memory', type=int, help='MB of memory all jobs may use at once')
+    parser.add_argument('--results', help='JSON file for results, by default job file name with .results.json')
+    parser.add_argument('--serve', metavar='[HOST:]PORT',
+                        help='run as worker of distributed stacking (job option hosts) instead of running jobs, '
+                             f'on {HOST:s} unless HOST is given (0.0.0.0 for all interfaces)')
+    parser.add_argument('--token', default=os.environ.get(TOKEN_VARIABLE),
+                        help=f'shared token of workers and jobs with hosts, by default ${TOKEN_VARIABLE:s}')
+    parser.add_argument('--profile', choices=[CPROFILE, TRACEMALLOC],
+                        help='profile jobs, results are added to their reports (tracemalloc needs --cpu 1 budget '
+                             'or single job to be accurate)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s: %(message)s')
+    if args.serve:
+        if not args.token:
+            parser.error(f'worker needs --token or {TOKEN_VARIABLE:s}')
+        host, port = parse_address(args.serve) if ':' in args.serve else (HOST, int(args.serve))
+        serve(host, port, args.token)
+        return 0
+    if args.job_file is None:
+        parser.error('job file is required')
+    job_file, jobs = read_job_file(args.job_file)
+    for job in jobs:
+        job.setdefault('token', args.token)
+    cpu = args.cpu or job_file.get('cpu') or os.cpu_count() or 1
+    memory = (args.memory or job_file.get('memory') or 4096) * 1024 ** 2
+    results = run_jobs(jobs, cpu, memory, args.profile)
+    results_file = args.results or os.path.splitext(args.job_file)[0] + '.results.json'
+    with open(results_file, 'w') as f:
+        json.dump({'jobs': results}, f, indent=2)
+    logger.info(f'Results written to {results_file:s}')
+    return 0 if all(r['status'] == 'ok' for r in results) else 1
@@ -1,22 +1,53 @@
 import logging
+import os
+import queue
+import time
+from threading import Thread
 import tkinter as tk
 import tkinter.filedialog
 from tkinter import ttk
 import tkinter.font as tkfont
 from astrostacker.img.debayer import RGGB, BGGR, GRBG, GBRG
+from astrostacker.img.stretch import LINEAR, ASINH, STF
+from astrostacker.img.quality import score_files, select_frames, STARS, FWHM, ECCENTRICITY, BACKGROUND, NOISE
+from astrostacker.img.catalogue import Catalogue, POSITION, FRAME_COLUMNS
+from astrostacker.logging.events import emit_progress
 
 
 logger = logging.getLogger()
 
+# columns of image list: heading, column of astrostacker.img.catalogue.Catalogue and format of its value
+COLUMNS = [
+    ('Filename', 'path', '{}'),
+    ('Exposure', 'exposure', '{}'),
+    ('Filter', 'filter_name', '{}'),
+    ('Temperature', 'temperature', '{}'),
+    ('Gain', 'gain', '{}'),
+    ('Stars', STARS, '{:d}'),
+    ('FWHM', FWHM, '{:.2f}'),
+    ('Eccentricity', ECCENTRICITY, '{:.2f}'),
+    ('Background', BACKGROUND, '{:.1f}'),
+    ('Noise', NOISE, '{:.2f}'),
+]
+# filter option showing frames of all filters
+ALL_FILTERS = 'All'
+# number of rows scrolled by one step of mouse wheel
+WHEEL_ROWS = 3
+
 
 # Frame for displaying list of images
+# Images of session are kept in catalogue (astrostacker.img.catalogue.Catalogue), which indexes them in background
+# and restores the session when application starts again. List is virtual: treeview holds only visible rows,
+# which are read from catalogue sorted and filtered as they are scrolled into view.
 class ImageList(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
 
-        # list of filenames
-        self.filenames = []
+        # catalogue of session
+        self.catalogue = Catalogue()
+        # list of filenames of session in their order
+        self.filenames = self.catalogue.session_files()
         # variable holding sate of debayer checkbox
         self.var_debayer = tk.IntVar()
         # variable holding sate of reference frame checkbox
@@ -24,15 +55,55 @@ class ImageList(tk.Frame):
         # variable holding value of bayer mask
         self.var_bayer_mask = tk.StringVar()
         self.var_bayer_mask.set(RGGB)
-        # index of reference frame
-        self.ref_frame_idx = 0
+        # variable holding sate of superpixel checkbox
+        self.var_superpixel = tk.IntVar()
+        # variable holding binning factor of displayed images
+        self.var_binning = tk.IntVar()
+        self.var_binning.set(1)
+        # variable holding stretch mode of displayed images
+        self.var_stretch = tk.StringVar()
+        self.var_stretch.set(STF)
+        # variable holding percentile of worst frames rejected by quality analysis
+        self.var_reject_percentile = tk.IntVar()
+        self.var_reject_percentile.set(10)
+        # variable holding filter of listed and stacked frames
+        self.var_filter = tk.StringVar()
+        self.var_filter.set(ALL_FILTERS)
+        # filename of reference frame
+        self.ref_filename = self.catalogue.reference()
+        if self.ref_filename is None and len(self.filenames) > 0:
+            self.ref_filename = self.filenames[0]
+        # filename of the last selected image, rows selected again after refresh are not displayed again
+        self.selected_filename = None
+        # queue with results of quality analysis running in background
+        self.analysis_queue = queue.Queue()
+        # queue with progress of indexing running in background, None when indexing of files is finished
+        self.ingest_queue = queue.Queue()
+        # number of running indexing threads
+        self.ingesting = 0
+        # catalogue column the list is sorted by and direction of sorting
+        self.sort_column = POSITION
+        self.sort_descending = False
+        # index of the first displayed row, number of displayed rows and number of all rows
+        self.first_row = 0
+        self.visible_rows = 1
+        self.total_rows = 0
         # Fonts for image list
         self.font_img = tkfont.Font(font=('TkDefaultFont', 8))
         self.font_img_bold = tkfont.Font(font=('TkDefaultFont', 8, 'bold'))
+        # height of row of image list
+        self.row_height = self.font_img_bold.metrics('linespace') + 4
         # function to be called when image is selected
         # arg0: filename (string)
         # arg1: debayer flag (boolean)
+        # arg2: bayer mask (string)
+        # arg3: superpixel flag (boolean)
+        # arg4: binning factor (int)
+        # arg5: stretch mode (string)
         self.event_on_select = None
+        # function to be called when files to be stacked change
+        # arg0: filenames of selected filter not rejected by quality analysis (list)
+        # arg1: index of reference frame in arg0 (int)
         self.event_on_change_filenames = None
         self.event_on_change_bayer_mask = None
 
@@ -48,9 +119,11 @@ class ImageList(tk.Frame):
         self.image_list.grid(row=1, column=0, sticky='nws')
 
         # control panel
-        # 2 rows and 4 columns
+        # 3 rows and 4 columns
         # Label | button add images | label | button clear images | checkbox debayer
-        # checkbox reference frame | label | option menu bayer mask
+        # checkbox reference frame | label | option menu bayer mask | checkbox superpixel | label | option menu binning
+        # | label | option menu stretch
+        # button analyse quality | label | spinbox reject percentile | label | option menu filter
         ctrl = self.control_panel
 
         ctrl.lblSelectFitsImages = tk.Label(ctrl, text='Add FITS images:')
@@ -81,108 +154,346 @@ class ImageList(tk.Frame):
                                          command=self.__cmd_bayer_mask_changed)
         ctrl.omBayerMask.grid(row=0, column=2, padx=5, pady=5)
 
+        ctrl.cbSuperpixel = tk.Checkbutton(ctrl.row1, variable=self.var_superpixel, text='Superpixel')
+        ctrl.cbSuperpixel.grid(row=0, column=3, padx=5, pady=5)
+
+        ctrl.lblBinning = tk.Label(ctrl.row1, text='Binning:')
+        ctrl.lblBinning.grid(row=0, column=4, padx=5, pady=5)
+
+        ctrl.omBinning = tk.OptionMenu(ctrl.row1, self.var_binning, 1, 2, 3)
+        ctrl.omBinning.grid(row=0, column=5, padx=5, pady=5)
+
+        ctrl.lblStretch = tk.Label(ctrl.row1, text='Stretch:')
+        ctrl.lblStretch.grid(row=0, column=6, padx=5, pady=5)
+
+        ctrl.omStretch = tk.OptionMenu(ctrl.row1, self.var_stretch, LINEAR, ASINH, STF)
+        ctrl.omStretch.grid(row=0, column=7, padx=5, pady=5)
+
+        ctrl.row2 = tk.Frame(ctrl)
+        ctrl.row2.grid(row=2, column=0, columnspan=5, sticky='w')
+        ctrl.btnAnalyse = tk.Button(ctrl.row2, text='Analyse quality', command=self.__cmd_analyse)
+        ctrl.btnAnalyse.grid(row=0, column=0, padx=5, pady=5)
+
+        ctrl.lblRejectPercentile = tk.Label(ctrl.row2, text='Reject worst %:')
+        ctrl.lblRejectPercentile.grid(row=0, column=1, padx=5, pady=5)
+
+        ctrl.sbRejectPercentile = tk.Spinbox(ctrl.row2, from_=0, to=90, width=3,
+                                             textvariable=self.var_reject_percentile)
+        ctrl.sbRejectPercentile.grid(row=0, column=2, padx=5, pady=5)
+
+        ctrl.lblFilter = tk.Label(ctrl.row2, text='Filter:')
+        ctrl.lblFilter.grid(row=0, column=3, padx=5, pady=5)
+
+        ctrl.omFilter = tk.OptionMenu(ctrl.row2, self.var_filter, ALL_FILTERS)
+        ctrl.omFilter.grid(row=0, column=4, padx=5, pady=5)
+
         # image list
         # 2 rows and 2 columns
         # treeview with 2 scrollbars
+        # Vertical scrollbar scrolls rows read from catalogue, rows are identified by their filenames.
         lst = self.image_list
         lst.rowconfigure(0, weight=1)
         lst.columnconfigure(0, weight=1)
         lst.columnconfigure(1, weight=1)
-        cols = ['Filename']
+        cols = [heading for heading, _, _ in COLUMNS]
+        ttk.Style(self).configure('ImageList.Treeview', rowheight=self.row_height)
         lst.scrollbar_v = ttk.Scrollbar(lst, orient='vertical')
         lst.scrollbar_h = ttk.Scrollbar(lst, orient='horizontal')
-        lst.treeview = ttk.Treeview(lst, columns=cols, show='headings',
-                                    xscrollcommand=lst.scrollbar_h.set,
-                                    yscrollcommand=lst.scrollbar_v.set)
+        lst.treeview = ttk.Treeview(lst, columns=cols, show='headings', style='ImageList.Treeview',
+                                    xscrollcommand=lst.scrollbar_h.set)
         lst.treeview.bind('<<TreeviewSelect>>', self.__on_select)
         lst.treeview.bind("<Key>", self.__on_key_pressed)
+        lst.treeview.bind('<Configure>', self.__on_configure)
+        lst.treeview.bind('<MouseWheel>', self.__on_mouse_wheel)
+        lst.treeview.bind('<Button-4>', self.__on_mouse_wheel)
+        lst.treeview.bind('<Button-5>', self.__on_mouse_wheel)
         lst.treeview.tag_configure('NORMAL_TAG', font=self.font_img)
         lst.treeview.tag_configure('REF_TAG', font=self.font_img_bold)
+        lst.treeview.tag_configure('REJECTED_TAG', foreground='gray')
         lst.scrollbar_h.config(command=lst.treeview.xview)
-        lst.scrollbar_v.config(command=lst.treeview.yview)
-        for col in cols:
-            lst.treeview.heading(col, text=col)
-            lst.treeview.column(col, width=400, stretch=True)
+        lst.scrollbar_v.config(command=self.__on_scroll)
+        for heading, column, _ in COLUMNS:
+            lst.treeview.heading(heading, text=heading, command=lambda c=column: self.__sort_by(c))
+            lst.treeview.column(heading, width=70, stretch=False)
+        lst.treeview.column('Filename', width=400, stretch=True)
         lst.treeview.grid(row=0, column=0, sticky='nws')
         lst.scrollbar_v.grid(row=0, column=1, sticky='nws')
         lst.scrollbar_h.grid(row=1, column=0, sticky='wes')
 
-    # Clears image list and puts all files from filenames in it.
-    def __refresh_treeview(self, filenames):
+        # restored session is shown when event handlers are set, files changed since last session are indexed again
+        self.after_idle(self.__restore_session)
+
+    # Shows session restored from catalogue.
+    def __restore_session(self):
+        if len(self.filenames) > 0:
+            logger.info(f'{len(self.filenames):d} files of last session restored.')
+        self.__refresh_filters()
+        self.__refresh_treeview()
+        self.__notify_change_filenames()
+        if len(self.filenames) > 0:
+            self.__start_ingestion(self.filenames)
+
+    # Returns filter name of listed and stacked frames or None for all filters.
+    def __filter_name(self):
+        filter_name = self.var_filter.get()
+        return None if filter_name == ALL_FILTERS else filter_name
+
+    # Returns values of row read from catalogue.
+    @staticmethod
+    def __row_values(row):
+        # catalogue rows have rejected flag after path
+        values = dict(zip(('path', 'rejected') + FRAME_COLUMNS, row))
+        return ['' if values[column] is None else fmt.format(values[column]) for _, column, fmt in COLUMNS]
+
+    # Returns tags of row read from catalogue.
+    def __row_tags(self, row):
+        path, rejected = row[0:2]
+        tags = ['REF_TAG' if path == self.ref_filename else 'NORMAL_TAG']
+        if rejected:
+            tags.append('REJECTED_TAG')
+        return tags
+
+    # Puts visible rows in image list, reading them from catalogue, and updates vertical scrollbar.
+    def __refresh_treeview(self):
         lst = self.image_list.treeview
+        filter_name = self.__filter_name()
+        self.total_rows = self.catalogue.count(filter_name)
+        self.first_row = max(0, min(self.first_row, self.total_rows - self.visible_rows))
+        rows = self.catalogue.rows(self.first_row, self.visible_rows, self.sort_column, self.sort_descending,
+                                   filter_name)
+        selection = lst.selection()
         lst.delete(*lst.get_children())
-        for i in range(0, len(filenames)):
-            file = filenames[i]
-            if i == self.ref_frame_idx:
-                tag = 'REF_TAG'
-            else:
-                tag = 'NORMAL_TAG'
-            self.image_list.treeview.insert('', 'end', values=[file, i], tag=tag)
-
-    # Asks user to choose files and adds them to at the end of image list and self.filenames.
+        for row in rows:
+            lst.insert('', 'end', iid=row[0], values=self.__row_values(row), tag=self.__row_tags(row))
+        kept_selection = [item for item in selection if lst.exists(item)]
+        if len(kept_selection) > 0:
+            lst.selection_set(kept_selection)
+        if self.total_rows == 0:
+            self.image_list.scrollbar_v.set(0, 1)
+        else:
+            self.image_list.scrollbar_v.set(self.first_row / self.total_rows,
+                                            (self.first_row + len(rows)) / self.total_rows)
+
+    # Puts filters of indexed frames in filter option menu.
+    def __refresh_filters(self):
+        menu = self.control_panel.omFilter['menu']
+        menu.delete(0, 'end')
+        for filter_name in [ALL_FILTERS] + self.catalogue.filters():
+            menu.add_command(label=filter_name, command=lambda f=filter_name: self.__cmd_filter_changed(f))
+
+    # Calls event_on_change_filenames with files of selected filter not rejected by quality analysis.
+    def __notify_change_filenames(self):
+        kept = self.catalogue.session_files(self.__filter_name(), kept_only=True)
+        ref_frame_idx = 0
+        if self.ref_filename in kept:
+            ref_frame_idx = kept.index(self.ref_filename)
+        self.event_on_change_filenames(kept, ref_frame_idx)
+
+    # Sets reference frame and stores it in catalogue.
+    def __set_reference(self, filename):
+        self.ref_filename = filename
+        if filename is not None:
+            self.catalogue.set_reference(filename)
+
+    # Event scrolling image list by vertical scrollbar.
+    def __on_scroll(self, action, value, units=None):
+        if action == 'moveto':
+            self.first_row = int(float(value) * self.total_rows)
+        elif units == 'pages':
+            self.first_row += int(value) * self.visible_rows
+        else:
+            self.first_row += int(value)
+        self.__refresh_treeview()
+
+    # Event scrolling image list by mouse wheel.
+    def __on_mouse_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.first_row -= WHEEL_ROWS
+        else:
+            self.first_row += WHEEL_ROWS
+        self.__refresh_treeview()
+        return 'break'
+
+    # Event reading as many rows as fit in resized image list.
+    def __on_configure(self, event):
+        # heading takes one row
+        visible_rows = max(1, event.height // self.row_height - 1)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.__refresh_treeview()
+
+    # Event sorting list by clicked column, clicking the same column again reverses order.
+    def __sort_by(self, column):
+        if self.sort_column == column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column = column
+            self.sort_descending = False
+        self.first_row = 0
+        self.__refresh_treeview()
+
+    # Event listing and stacking only frames of selected filter.
+    def __cmd_filter_changed(self, filter_name):
+        self.var_filter.set(filter_name)
+        self.first_row = 0
+        self.__refresh_treeview()
+        self.__notify_change_filenames()
+
+    # Starts indexing of files in background.
+    def __start_ingestion(self, filenames):
+        self.ingesting += 1
+        self.control_panel.btnAnalyse['state'] = 'disabled'
+        thread = Thread(target=self.__ingest, args=(list(filenames),), daemon=True)
+        thread.start()
+        if self.ingesting == 1:
+            self.after(200, self.__poll_ingestion)
+
+    # Indexes files in catalogue of this thread, puts progress in ingest_queue and sends it as event.
+    def __ingest(self, filenames):
+        started = time.time()
+
+        def progress(done, total):
+            self.ingest_queue.put(done)
+            emit_progress(done, total, started)
+
+        try:
+            with Catalogue(self.catalogue.path) as catalogue:
+                indexed = catalogue.ingest(filenames, progress=progress)
+            if indexed > 0:
+                logger.info(f'{indexed:d} files indexed.')
+        except Exception as e:
+            logger.info(f'Indexing of files failed: {e}')
+        finally:
+            self.ingest_queue.put(None)
+
+    # Shows rows of indexed files as indexing progresses.
+    def __poll_ingestion(self):
+        progressed = False
+        while True:
+            try:
+                done = self.ingest_queue.get(block=False)
+            except queue.Empty:
+                break
+            progressed = True
+            if done is None:
+                self.ingesting -= 1
+        if progressed:
+            self.__refresh_treeview()
+        if self.ingesting > 0:
+            self.after(200, self.__poll_ingestion)
+            return
+        self.control_panel.btnAnalyse['state'] = 'normal'
+        self.__refresh_filters()
+
+    # Starts quality analysis of all files in background.
+    def __cmd_analyse(self):
+        if len(self.filenames) == 0:
+            return
+        filenames = list(self.filenames)
+        percentile = self.var_reject_percentile.get()
+        self.control_panel.btnAnalyse['state'] = 'disabled'
+        logger.info(f'Analysing {len(filenames):d} files.')
+        thread = Thread(target=self.__analyse, args=(filenames, percentile), daemon=True)
+        thread.start()
+        self.after(100, self.__poll_analysis)
+
+    # Scores files and selects frames to stack, puts result in analysis_queue.
+    def __analyse(self, filenames, percentile):
+        try:
+            metrics = score_files(filenames, os.cpu_count() or 1)
+            kept, best = select_frames(metrics, percentile)
+            self.analysis_queue.put((filenames, metrics, kept, best))
+        except Exception as e:
+            logger.info(f'Quality analysis failed: {e}')
+            self.analysis_queue.put(None)
+
+    # Shows result of quality analysis when it is finished: metrics, rejected frames and best reference frame.
+    def __poll_analysis(self):
+        try:
+            result = self.analysis_queue.get(block=False)
+        except queue.Empty:
+            self.after(100, self.__poll_analysis)
+            return
+        self.control_panel.btnAnalyse['state'] = 'normal'
+        if result is None:
+            return
+        filenames, metrics, kept, best = result
+        self.catalogue.put_metrics(filenames, metrics)
+        kept = set(kept)
+        rejected = [filenames[i] for i in range(0, len(filenames)) if i not in kept]
+        self.catalogue.set_rejected(rejected)
+        self.__set_reference(filenames[best])
+        logger.info(f'{len(rejected):d} files rejected, best frame: {filenames[best]:s}')
+        self.__refresh_treeview()
+        self.__notify_change_filenames()
+
+    # Asks user to choose files, adds them to at the end of session and starts their indexing.
     def __cmd_add_files(self):
         new_filenames = tk.filedialog.askopenfilenames(
             title='Select files:',
             filetypes=(('fits files', '*.fit *.fits'), ('all files', '*.*')))
-        if len(self.filenames) == 0:
-            self.ref_frame_idx = 0
-        for i in range(0, len(new_filenames)):
-            file = new_filenames[i]
-            if i + len(self.filenames) == self.ref_frame_idx:
-                self.image_list.treeview.insert('', 'end', values=[file, i + len(self.filenames)], tag='REF_TAG')
-            else:
-                self.image_list.treeview.insert('', 'end', values=[file, i + len(self.filenames)], tag='NORMAL_TAG')
-        self.filenames.extend(new_filenames)
-        logger.info(f'{len(new_filenames):d} files added.')
-        self.event_on_change_filenames(self.filenames, self.ref_frame_idx)
+        if len(new_filenames) == 0:
+            return
+        added = self.catalogue.add_to_session(new_filenames)
+        self.filenames = self.catalogue.session_files()
+        if self.ref_filename is None:
+            self.__set_reference(self.filenames[0])
+        logger.info(f'{added:d} files added.')
+        self.__refresh_treeview()
+        self.__notify_change_filenames()
+        self.__start_ingestion(new_filenames)
 
     # Clears image list.
     def __cmd_clear_files(self):
+        self.catalogue.clear_session()
         self.filenames = []
-        lst = self.image_list.treeview
-        lst.delete(*lst.get_children())
-        self.event_on_change_filenames(self.filenames, self.ref_frame_idx)
+        self.ref_filename = None
+        self.var_filter.set(ALL_FILTERS)
+        self.first_row = 0
+        self.__refresh_filters()
+        self.__refresh_treeview()
+        self.__notify_change_filenames()
 
-    # Event deleting selected row in react to press of delete key.
+    # Event deleting selected rows in react to press of delete key.
     def __on_key_pressed(self, event):
         if event.keysym == 'Delete':
-            selected_items = self.image_list.treeview.selection()
-            for i in range(0, len(selected_items)):
-                selected_item = selected_items[i]
-                item = self.image_list.treeview.item(selected_item)
-                self.filenames.remove(item['values'][0])
-                if i == self.ref_frame_idx:
-                    self.ref_frame_idx = 0
-            if len(selected_items) > 0:
-                self.__refresh_treeview(self.filenames)
-                self.event_on_change_filenames(self.filenames, self.ref_frame_idx)
+            selected = set(self.image_list.treeview.selection())
+            if len(selected) == 0:
+                return
+            self.catalogue.remove_from_session(selected)
+            self.filenames = [f for f in self.filenames if f not in selected]
+            if self.ref_filename in selected:
+                self.__set_reference(self.filenames[0] if len(self.filenames) > 0 else None)
+            self.__refresh_treeview()
+            self.__notify_change_filenames()
 
     # Event displaying selected image.
     def __on_select(self, event):
-        sel = self.image_list.treeview.item(event.widget.selection()[0])
-        idx = sel['values'][1]
-        if idx == self.ref_frame_idx:
+        selection = self.image_list.treeview.selection()
+        if len(selection) == 0:
+            return
+        filename = selection[0]
+        if filename == self.selected_filename:
+            return
+        self.selected_filename = filename
+        if filename == self.ref_filename:
             self.var_ref_frame.set(True)
             self.control_panel.cbRefFrame['state'] = 'disable'
         else:
             self.var_ref_frame.set(False)
             self.control_panel.cbRefFrame['state'] = 'normal'
-        filename = self.filenames[idx]
         debayer = self.var_debayer.get()
-        self.event_on_select(filename, debayer, self.var_bayer_mask.get())
+        self.event_on_select(filename, debayer, self.var_bayer_mask.get(),
+                             self.var_superpixel.get(), self.var_binning.get(), self.var_stretch.get())
 
     # Event setting new reference frame when checkbox is changed
     def __on_cb_ref_frame_changed(self):
+        self.control_panel.cbRefFrame['state'] = 'disable'
         if len(self.image_list.treeview.selection()) == 0:
             return
-        for idx in self.image_list.treeview.get_children():
-            if self.image_list.treeview.item(idx)['values'][1] == self.ref_frame_idx:
-                idx_old = idx
-        idx_new = self.image_list.treeview.selection()[0]
-        self.image_list.treeview.item(idx_old, tag='NORMAL_TAG')
-        self.image_list.treeview.item(idx_new, tag='REF_TAG')
-        item_new = self.image_list.treeview.item(idx_new)
-        self.ref_frame_idx = item_new['values'][1]
+        self.__set_reference(self.image_list.treeview.selection()[0])
+        self.__refresh_treeview()
+        self.__notify_change_filenames()
 
     # Event setting new reference frame when checkbox is changed
     def __cmd_bayer_mask_changed(self, event):
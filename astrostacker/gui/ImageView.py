@@ -1,13 +1,42 @@
-import numpy as np
+import math
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
-from astrostacker.img.scale import lingray
-from astrostacker.img.debayer import debayer
-from astrostacker.img.debayer import debayer
+from astrostacker.img.stretch import stretch, STF
+from astrostacker.img.debayer import debayer, superpixel
+from astrostacker.img.binning import bin_image
+
+# size of the smallest level of image pyramid, in pixels of its longer side
+PYRAMID_MIN_SIZE = 256
+
+
+# Returns list of images, each next one downsampled 2 times from the previous one,
+# starting with given image and ending with one not longer than PYRAMID_MIN_SIZE.
+def build_pyramid(image):
+    pyramid = [image]
+    while max(image.width, image.height) > PYRAMID_MIN_SIZE:
+        image = image.reduce(2)
+        pyramid.append(image)
+    return pyramid
+
+
+# Renders data from 2D matrix as 8bit PIL image.
+# Data is debayered bilinearly or to superpixels, binned by given factor
+# and stretched with given mode of astrostacker.img.stretch.
+def render_image(data, debayer_data, bayer_mask, superpixel_data=False, binning=1, stretch_mode=STF):
+    if superpixel_data:
+        data = superpixel(data, bayer_mask)
+    elif debayer_data:
+        data = debayer(data, bayer_mask)
+    data = bin_image(data, binning)
+    data = stretch(data, stretch_mode)
+    if data.ndim == 3:
+        return Image.fromarray(data, 'RGB')
+    return Image.fromarray(data)
 
 
 # Frame for displaying images. Has 2 scrollbars.
+# Only visible part of zoomed image is rendered, from pyramid level closest to the zoom.
 class ImageView(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
@@ -17,8 +46,12 @@ class ImageView(tk.Frame):
         self.canvas_image = None
         # PIL image
         self.image = None
+        # pyramid of PIL image
+        self.pyramid = None
         # zoom factor
         self.zoom_factor = 1.0
+        # id of scheduled rendering of visible part of image
+        self.render_id = None
 
         # 2 rows and 2 columns
         # canvas for displaying image with 2 scrollbars
@@ -34,58 +67,84 @@ class ImageView(tk.Frame):
 
         self.canvas = tk.Canvas(self)
         self.canvas.bind("<MouseWheel>", self.__on_mouse_wheel)
+        self.canvas.bind("<Configure>", self.__on_configure)
         self.canvas_image = self.canvas.create_image(0, 0, anchor='nw', image=None)
 
         self.canvas.config(xscrollcommand=self.h_scrollbar.set, yscrollcommand=self.v_scrollbar.set)
-        self.v_scrollbar.config(command=self.canvas.yview)
-        self.h_scrollbar.config(command=self.canvas.xview)
-        self.canvas.config(scrollregion=self.canvas.bbox(tk.ALL))
+        self.v_scrollbar.config(command=self.__cmd_yview)
+        self.h_scrollbar.config(command=self.__cmd_xview)
+        self.canvas.config(scrollregion=(0, 0, 0, 0))
         self.canvas.grid(row=0, column=0, sticky='nwse')
         self.canvas.image = None
         self.canvas.img = None
 
-    # Draws PIL image in canvas.
-    def __draw_image(self, image):
+    # Draws PIL image in canvas at given position.
+    def __draw_image(self, image, x, y):
         img = ImageTk.PhotoImage(image=image)
         self.canvas.itemconfig(self.canvas_image, image=img)
-        self.canvas.config(scrollregion=self.canvas.bbox(tk.ALL))
+        self.canvas.coords(self.canvas_image, x, y)
         self.canvas.img = img
 
-    # Displays data from 2D matrix as 8bit image.
-    def show_image(self, data, debayer_data, bayer_mask):
-        scale = 255
-        if debayer_data:
-            data = debayer(data, bayer_mask)
-            data[:, :, 0] = lingray(data[:, :, 0], max=scale)
-            data[:, :, 1] = lingray(data[:, :, 1], max=scale)
-            data[:, :, 2] = lingray(data[:, :, 2], max=scale)
-            data = data.astype(np.uint8)
-            image = Image.fromarray(data, 'RGB')
-        else:
-            data = lingray(data, max=scale)
-            data = data.astype(np.uint8)
-            image = Image.fromarray(data)
-        self.image = image
-        self.canvas.update()
-        new_width = self.image.width * self.zoom_factor
-        image = self.__resize_image(image, new_width)
-        self.__draw_image(image)
-
-    # Resizes image.
-    def __resize_image(self, image, width):
-        if image is None:
-            return image
-        ratio = image.width / width
-        height = int(image.height / ratio)
-        width = int(width)
-        image = image.resize((width, height))
-        return image
-
-    # Zooms image.
-    def __zoom_image(self, factor):
-        image = self.image
-        image = self.__resize_image(image, image.width * factor)
-        self.__draw_image(image)
+    # Displays data from 2D matrix as 8bit image, rendered by render_image.
+    def show_image(self, data, debayer_data, bayer_mask, superpixel_data=False, binning=1, stretch_mode=STF):
+        image = render_image(data, debayer_data, bayer_mask, superpixel_data, binning, stretch_mode)
+        self.show_pyramid(build_pyramid(image))
+
+    # Displays image from its pyramid built by build_pyramid.
+    def show_pyramid(self, pyramid):
+        self.image = pyramid[0]
+        self.pyramid = pyramid
+        self.__update_scrollregion()
+        self.__render()
+
+    # Sets scroll region to size of zoomed image.
+    def __update_scrollregion(self):
+        width = int(self.image.width * self.zoom_factor)
+        height = int(self.image.height * self.zoom_factor)
+        self.canvas.config(scrollregion=(0, 0, width, height))
+
+    # Schedules rendering of visible part of image, once for many scroll or resize events.
+    def __schedule_render(self):
+        if self.render_id is None:
+            self.render_id = self.after_idle(self.__render)
+
+    # Renders part of zoomed image visible in canvas from pyramid level
+    # with the smallest resolution not lower than zoom.
+    def __render(self):
+        self.render_id = None
+        if self.pyramid is None:
+            return
+        zoom = self.zoom_factor
+        width = int(self.image.width * zoom)
+        height = int(self.image.height * zoom)
+        # visible rectangle in canvas coordinates, clipped to the image
+        left = max(0, int(self.canvas.canvasx(0)))
+        top = max(0, int(self.canvas.canvasy(0)))
+        right = min(width, left + self.canvas.winfo_width())
+        bottom = min(height, top + self.canvas.winfo_height())
+        if right <= left or bottom <= top:
+            return
+        level_idx = 0
+        if zoom < 1:
+            level_idx = min(int(math.floor(math.log2(1 / zoom))), len(self.pyramid) - 1)
+        level = self.pyramid[level_idx]
+        # scale from canvas coordinates to level coordinates
+        scale = level.width / width
+        box = (left * scale, top * scale, right * scale, bottom * scale)
+        image = level.resize((right - left, bottom - top), box=box)
+        self.__draw_image(image, left, top)
+
+    def __cmd_xview(self, *args):
+        self.canvas.xview(*args)
+        self.__schedule_render()
+
+    def __cmd_yview(self, *args):
+        self.canvas.yview(*args)
+        self.__schedule_render()
+
+    # Event rendering image again when canvas is resized.
+    def __on_configure(self, event):
+        self.__schedule_render()
 
     # Event zooming image in or out in reaction to mouse wheel movement.
     def __on_mouse_wheel(self, event):
@@ -96,6 +155,6 @@ class ImageView(tk.Frame):
         else:
             new_zoom = self.zoom_factor - 0.1
         if 0 < new_zoom <= 2:
-            image = self.__resize_image(self.image, int(self.image.width * new_zoom))
-            self.__draw_image(image)
             self.zoom_factor = new_zoom
+            self.__update_scrollregion()
+            self.__render()
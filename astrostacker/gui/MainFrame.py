@@ -1,16 +1,28 @@
-import logging; logging.basicConfig(level=logging.NOTSET)
-import queue
+import logging; logging.basicConfig(level=logging.INFO)
+import os
 import tkinter as tk
+from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
-from astropy.io import fits as pyfits
 from astrostacker.gui.ImageList import ImageList
 from astrostacker.gui.ImageView import ImageView
 from astrostacker.gui.StackingControlPanel import StackingControlPanel
-from astrostacker.logging.loghandler import LogHandler
+from astrostacker.gui.PreviewLoader import PreviewLoader
+from astrostacker.logging.events import EventChannel, LOG, PROGRESS, STAGE, METRICS
+from astrostacker.logging.loghandler import attach
+from astrostacker.img.report import format_duration
 from astrostacker.img.debayer import RGGB
+from astrostacker.img.stretch import STF
 
 logger = logging.getLogger()
 
+# minimal time between refreshes of displayed live stack, in ms
+LIVE_REFRESH_INTERVAL = 2000
+# interval of draining events, in ms, and maximum number of events drained at once
+EVENT_INTERVAL = 100
+MAX_EVENTS = 1000
+# number of lines kept in log window
+MAX_LOG_LINES = 5000
+
 
 class MainFrame(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
@@ -30,44 +42,97 @@ class MainFrame(tk.Frame):
         self.stackingPanel.bayer_mask = RGGB
         self.imageList.event_on_change_filenames = self.stackingPanel.set_filenames
         self.imageList.event_on_change_bayer_mask = self.stackingPanel.set_bayer_mask
+        self.stackingPanel.event_on_live_update = self.set_live_stack
+        # live stack to be displayed and number of its frames already displayed
+        self.live_stack = None
+        self.live_stack_displayed = 0
 
-        self.scrolledText = ScrolledText(self, width=50, height=10)
+        self.scrolledText = ScrolledText(self, width=50, height=10, state='disabled')
         self.scrolledText.grid(row=2, column=0, columnspan=2, sticky='wes')
 
-        self.log_queue = queue.Queue()
-        self.log_handler = LogHandler(self.log_queue)
+        # progress bar and status of the last stage, progress and metrics
+        self.status = tk.Frame(self)
+        self.status.grid(row=3, column=0, columnspan=2, sticky='we')
+        self.status.columnconfigure(1, weight=1)
+        self.progressBar = ttk.Progressbar(self.status, mode='determinate', length=300)
+        self.progressBar.grid(row=0, column=0, padx=5, pady=5)
+        self.lblStatus = tk.Label(self.status, anchor='w')
+        self.lblStatus.grid(row=0, column=1, padx=5, pady=5, sticky='we')
+        # the last stage, progress and metrics events
+        self.last_events = {}
 
-        formatter = logging.Formatter('%(asctime)s: %(message)s')
-        self.log_handler.setFormatter(formatter)
-        logger.addHandler(self.log_handler)
+        # log messages and events of this process and of worker processes it starts
+        self.events = EventChannel()
+        attach(self.events)
 
         self.imageView = ImageView(self)
         self.imageView.grid(row=0, column=1, rowspan=2, sticky='nwse')
+        self.previewLoader = PreviewLoader(self, self.imageView.show_pyramid)
+
+        self.after(EVENT_INTERVAL, self.poll_events)
+        self.after(LIVE_REFRESH_INTERVAL, self.poll_live_stack)
 
-        self.after(100, self.poll_log_queue)
+    # loads and displays selected image in background
+    def display_image(self, filename, debayer=False, bayer_mask=RGGB, superpixel=False, binning=1, stretch_mode=STF):
+        self.previewLoader.request(filename, bool(debayer), bayer_mask, bool(superpixel), binning, stretch_mode)
 
-    # loads and displays selected image
-    def display_image(self, filename, debayer=False, bayer_mask=RGGB):
-        img = pyfits.open(filename)
-        data = img[0].data
-        self.imageView.show_image(data, debayer, bayer_mask)
+    # sets live stack to be displayed, called from live stacking thread
+    def set_live_stack(self, live_stack):
+        self.live_stack = live_stack
 
-    # displays log message
-    def display_message(self, record):
-        msg = self.log_handler.format(record)
+    # displays live stack if it got new frames, at most once per LIVE_REFRESH_INTERVAL
+    def poll_live_stack(self):
+        live_stack = self.live_stack
+        if live_stack is not None and live_stack.n != self.live_stack_displayed:
+            self.live_stack_displayed = live_stack.n
+            data = live_stack.result()
+            debayer = self.imageList.var_debayer.get() and data.ndim == 2
+            self.imageView.show_image(data, debayer, self.imageList.var_bayer_mask.get(),
+                                      stretch_mode=self.imageList.var_stretch.get())
+        self.after(LIVE_REFRESH_INTERVAL, self.poll_live_stack)
+
+    # displays log messages at once, keeping at most MAX_LOG_LINES lines
+    def display_messages(self, messages):
         self.scrolledText.configure(state='normal')
-        self.scrolledText.insert(tk.END, msg + '\n')
+        self.scrolledText.insert(tk.END, '\n'.join(messages) + '\n')
+        lines = int(self.scrolledText.index('end-1c').split('.')[0]) - 1
+        if lines > MAX_LOG_LINES:
+            self.scrolledText.delete('1.0', f'{lines - MAX_LOG_LINES + 1:d}.0')
         self.scrolledText.configure(state='disabled')
         # Autoscroll to the bottom
         self.scrolledText.yview(tk.END)
 
-    # displays queued messages every 100ms
-    def poll_log_queue(self):
-        while True:
-            try:
-                record = self.log_queue.get(block=False)
-            except queue.Empty:
-                break
+    # displays the last stage, progress and metrics in progress bar and status
+    def display_status(self):
+        parts = []
+        stage = self.last_events.get(STAGE)
+        if stage is not None:
+            parts.append(stage['stage'])
+        progress = self.last_events.get(PROGRESS)
+        if progress is not None:
+            self.progressBar.configure(maximum=max(1, progress['total']), value=progress['done'])
+            parts.append(f'{progress["done"]:d}/{progress["total"]:d}, '
+                         f'elapsed {format_duration(progress["elapsed"]):s}, ETA {format_duration(progress["eta"]):s}')
+        metrics = self.last_events.get(METRICS)
+        if metrics is not None:
+            values = ', '.join(f'{name:s} {value:.4g}' for name, value in metrics['metrics'].items()
+                               if isinstance(value, (int, float)))
+            parts.append(f'{os.path.basename(metrics["name"]):s}: {values:s}')
+        self.lblStatus['text'] = ' | '.join(parts)
+
+    # drains events every EVENT_INTERVAL ms, at most MAX_EVENTS at once: log messages are displayed together,
+    # only the last stage, progress and metrics are displayed
+    def poll_events(self):
+        messages = []
+        status_changed = False
+        for event in self.events.drain(MAX_EVENTS):
+            if event['type'] == LOG:
+                messages.append(event['message'])
             else:
-                self.display_message(record)
-        self.after(100, self.poll_log_queue)
+                self.last_events[event['type']] = event
+                status_changed = True
+        if len(messages) > 0:
+            self.display_messages(messages)
+        if status_changed:
+            self.display_status()
+        self.after(EVENT_INTERVAL, self.poll_events)
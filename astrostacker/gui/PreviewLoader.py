@@ -0,0 +1,102 @@
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from astrostacker.img.frames import read_frame
+from astrostacker.gui.ImageView import render_image, build_pyramid
+
+logger = logging.getLogger()
+
+# default memory limit of cached previews, in bytes
+CACHE_SIZE = 512 * 1024 ** 2
+# interval of checking for decoded previews, in ms
+POLL_INTERVAL = 20
+
+
+# Returns number of bytes used by pyramid of PIL images.
+def pyramid_size(pyramid):
+    return sum(image.width * image.height * len(image.getbands()) for image in pyramid)
+
+
+# Loads and renders previews of files in background thread.
+# Only the latest requested preview is rendered, requests superseded while waiting are dropped
+# and previews finished after being superseded are only cached.
+# Rendered previews (image pyramids) are kept in LRU cache limited to cache_size bytes.
+# on_loaded(pyramid) is called in Tk thread of widget.
+class PreviewLoader:
+    def __init__(self, widget, on_loaded, cache_size=CACHE_SIZE):
+        self.widget = widget
+        self.on_loaded = on_loaded
+        self.cache_size = cache_size
+        # cached pyramids by (filename, size, modification time, render_image arguments)
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        # number of the latest request
+        self.generation = 0
+        # pending request (generation, key) waiting for thread
+        self.pending = None
+        self.condition = threading.Condition()
+        # rendered (generation, key, pyramid) waiting for Tk thread
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+        self.widget.after(POLL_INTERVAL, self.__poll)
+
+    # Requests preview of file rendered with given arguments of render_image.
+    # Cached preview is displayed at once. Preview of file overwritten since it was cached is rendered again.
+    def request(self, filename, *render_args):
+        try:
+            stat = os.stat(filename)
+            version = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            # missing file is not cached, loading it logs the error
+            version = (None, None)
+        key = (filename,) + version + tuple(render_args)
+        with self.condition:
+            self.generation += 1
+            pyramid = self.cache.get(key)
+            if pyramid is None:
+                self.pending = (self.generation, key)
+                self.condition.notify()
+                return
+            self.pending = None
+            self.cache.move_to_end(key)
+        self.on_loaded(pyramid)
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                generation, key = self.pending
+                self.pending = None
+            try:
+                pyramid = build_pyramid(render_image(read_frame(key[0]), *key[3:]))
+            except Exception as e:
+                logger.info(f'Cannot display {key[0]:s}: {e}')
+                continue
+            self.results.put((generation, key, pyramid))
+
+    # Caches rendered previews and displays the one of the latest request.
+    def __poll(self):
+        while True:
+            try:
+                generation, key, pyramid = self.results.get(block=False)
+            except queue.Empty:
+                break
+            self.__put(key, pyramid)
+            if generation == self.generation:
+                self.on_loaded(pyramid)
+        self.widget.after(POLL_INTERVAL, self.__poll)
+
+    # Adds pyramid to cache, removing least recently used ones above cache_size.
+    def __put(self, key, pyramid):
+        with self.condition:
+            if key in self.cache:
+                return
+            self.cache[key] = pyramid
+            self.cached_bytes += pyramid_size(pyramid)
+            while self.cached_bytes > self.cache_size and len(self.cache) > 1:
+                _, removed = self.cache.popitem(last=False)
+                self.cached_bytes -= pyramid_size(removed)
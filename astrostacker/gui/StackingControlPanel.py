@@ -4,6 +4,15 @@ import numpy as np
 import tkinter as tk
 import tkinter.filedialog
 from astrostacker.img.stack import stack
+from astrostacker.img.reject import MEAN, MEDIAN, KAPPA_SIGMA, WINSORIZED
+from astrostacker.img.calibrate import load_calibration
+from astrostacker.img.live import LiveStacker
+from astrostacker.img.report import StackReport, WRITE
+from astrostacker.img.drizzle import SCALE, PIXFRAC
+from astrostacker.img.warp import SHIFT, BILINEAR, LANCZOS
+from astrostacker.img.lucky import lucky_stack, KEEP_PERCENT
+from astrostacker.img.register import STARS
+from astrostacker.img.phase import PHASE
 import tifffile as tf
 import os
 
@@ -25,14 +34,149 @@ class StackingControlPanel(tk.Frame):
         self.var_debayer = tk.IntVar()
         # pattern of bayer mask
         self.bayer_mask = None
+        # variable holding number of registering processes
+        self.var_workers = tk.IntVar()
+        self.var_workers.set(os.cpu_count() or 1)
+        # variable holding stacking method
+        self.var_method = tk.StringVar()
+        self.var_method.set(MEAN)
+        # variable holding kappa of rejection methods
+        self.var_kappa = tk.DoubleVar()
+        self.var_kappa.set(3.0)
+        # variable holding sate of superpixel checkbox
+        self.var_superpixel = tk.IntVar()
+        # variable holding binning factor of stacked images
+        self.var_binning = tk.IntVar()
+        self.var_binning.set(1)
+        # variable holding sate of drizzle checkbox
+        self.var_drizzle = tk.IntVar()
+        # variables holding drizzle output scale and drop size
+        self.var_drizzle_scale = tk.DoubleVar()
+        self.var_drizzle_scale.set(SCALE)
+        self.var_pixfrac = tk.DoubleVar()
+        self.var_pixfrac.set(PIXFRAC)
+        # variable holding interpolation of registered frames
+        self.var_interpolation = tk.StringVar()
+        self.var_interpolation.set(SHIFT)
+        # variable holding number of integrating processes, 0 integrates in stacking thread
+        self.var_integrators = tk.IntVar()
+        self.var_integrators.set(0)
+        # variable holding registration method
+        self.var_registration = tk.StringVar()
+        self.var_registration.set(STARS)
+        # variable holding percentage of the sharpest frames of SER video kept by lucky imaging
+        self.var_keep_percent = tk.IntVar()
+        self.var_keep_percent.set(KEEP_PERCENT)
+        # lists of bias, dark and flat files for calibration
+        self.bias_files = []
+        self.dark_files = []
+        self.flat_files = []
+        # running live stacker
+        self.live_stacker = None
+        # function to be called from live stacking thread after each stacked frame
+        # arg0: astrostacker.img.live.LiveStack
+        self.event_on_live_update = None
 
-        # 1 row and 2 columns
-        # Debayer checkbox and stack button.
+        # 9 rows and 4 columns
+        # Debayer checkbox, label | workers spinbox and stack button.
+        # label | option menu stacking method, label | kappa spinbox
+        # superpixel checkbox, label | option menu binning
+        # buttons selecting bias, dark and flat files, button clearing them
+        # drizzle checkbox, label | option menu drizzle scale, live stacking button
+        # label | pixfrac spinbox
+        # label | option menu interpolation, label | integrators spinbox
+        # label | keep percent spinbox, lucky stacking button
+        # label | option menu registration method
         self.cbDebayer = tk.Checkbutton(self, variable=self.var_debayer, text='Debayer stacked images')
         self.cbDebayer.grid(row=0, column=0, padx=5, pady=5)
 
+        self.lblWorkers = tk.Label(self, text='Processes:')
+        self.lblWorkers.grid(row=0, column=1, padx=5, pady=5)
+
+        self.sbWorkers = tk.Spinbox(self, from_=1, to=os.cpu_count() or 1, width=3, textvariable=self.var_workers)
+        self.sbWorkers.grid(row=0, column=2, padx=5, pady=5)
+
         self.btnStack = tk.Button(self, text='Stack all images', command=self.cmd_stack)
-        self.btnStack.grid(row=0, column=1, padx=5, pady=5)
+        self.btnStack.grid(row=0, column=3, padx=5, pady=5)
+
+        self.lblMethod = tk.Label(self, text='Method:')
+        self.lblMethod.grid(row=1, column=0, padx=5, pady=5, sticky='e')
+
+        self.omMethod = tk.OptionMenu(self, self.var_method, MEAN, MEDIAN, KAPPA_SIGMA, WINSORIZED)
+        self.omMethod.grid(row=1, column=1, padx=5, pady=5)
+
+        self.lblKappa = tk.Label(self, text='Kappa:')
+        self.lblKappa.grid(row=1, column=2, padx=5, pady=5)
+
+        self.sbKappa = tk.Spinbox(self, from_=1.0, to=10.0, increment=0.1, width=4, textvariable=self.var_kappa)
+        self.sbKappa.grid(row=1, column=3, padx=5, pady=5)
+
+        self.cbSuperpixel = tk.Checkbutton(self, variable=self.var_superpixel, text='Superpixel frames')
+        self.cbSuperpixel.grid(row=2, column=0, padx=5, pady=5)
+
+        self.lblBinning = tk.Label(self, text='Binning:')
+        self.lblBinning.grid(row=2, column=1, padx=5, pady=5)
+
+        self.omBinning = tk.OptionMenu(self, self.var_binning, 1, 2, 3)
+        self.omBinning.grid(row=2, column=2, padx=5, pady=5)
+
+        self.btnBias = tk.Button(self, text='Bias: 0', command=self.__cmd_select_bias)
+        self.btnBias.grid(row=3, column=0, padx=5, pady=5)
+
+        self.btnDarks = tk.Button(self, text='Darks: 0', command=self.__cmd_select_darks)
+        self.btnDarks.grid(row=3, column=1, padx=5, pady=5)
+
+        self.btnFlats = tk.Button(self, text='Flats: 0', command=self.__cmd_select_flats)
+        self.btnFlats.grid(row=3, column=2, padx=5, pady=5)
+
+        self.btnClearCalibration = tk.Button(self, text='No calibration', command=self.__cmd_clear_calibration)
+        self.btnClearCalibration.grid(row=3, column=3, padx=5, pady=5)
+
+        self.cbDrizzle = tk.Checkbutton(self, variable=self.var_drizzle, text='Drizzle')
+        self.cbDrizzle.grid(row=4, column=0, padx=5, pady=5)
+
+        self.lblDrizzleScale = tk.Label(self, text='Drizzle scale:')
+        self.lblDrizzleScale.grid(row=4, column=1, padx=5, pady=5)
+
+        self.omDrizzleScale = tk.OptionMenu(self, self.var_drizzle_scale, 1.0, 1.5, 2.0, 3.0)
+        self.omDrizzleScale.grid(row=4, column=2, padx=5, pady=5)
+
+        self.btnLive = tk.Button(self, text='Live stack directory', command=self.cmd_live)
+        self.btnLive.grid(row=4, column=3, padx=5, pady=5)
+
+        self.lblPixfrac = tk.Label(self, text='Pixfrac:')
+        self.lblPixfrac.grid(row=5, column=1, padx=5, pady=5)
+
+        self.sbPixfrac = tk.Spinbox(self, from_=0.1, to=1.0, increment=0.1, width=4, textvariable=self.var_pixfrac)
+        self.sbPixfrac.grid(row=5, column=2, padx=5, pady=5)
+
+        self.lblInterpolation = tk.Label(self, text='Interpolation:')
+        self.lblInterpolation.grid(row=6, column=0, padx=5, pady=5, sticky='e')
+
+        self.omInterpolation = tk.OptionMenu(self, self.var_interpolation, SHIFT, BILINEAR, LANCZOS)
+        self.omInterpolation.grid(row=6, column=1, padx=5, pady=5)
+
+        self.lblIntegrators = tk.Label(self, text='Integrators:')
+        self.lblIntegrators.grid(row=6, column=2, padx=5, pady=5)
+
+        self.sbIntegrators = tk.Spinbox(self, from_=0, to=os.cpu_count() or 1, width=3,
+                                        textvariable=self.var_integrators)
+        self.sbIntegrators.grid(row=6, column=3, padx=5, pady=5)
+
+        self.lblKeepPercent = tk.Label(self, text='Keep best %:')
+        self.lblKeepPercent.grid(row=7, column=0, padx=5, pady=5, sticky='e')
+
+        self.sbKeepPercent = tk.Spinbox(self, from_=1, to=100, width=3, textvariable=self.var_keep_percent)
+        self.sbKeepPercent.grid(row=7, column=1, padx=5, pady=5)
+
+        self.btnLucky = tk.Button(self, text='Lucky stack SER video', command=self.cmd_lucky)
+        self.btnLucky.grid(row=7, column=3, padx=5, pady=5)
+
+        self.lblRegistration = tk.Label(self, text='Registration:')
+        self.lblRegistration.grid(row=8, column=0, padx=5, pady=5, sticky='e')
+
+        self.omRegistration = tk.OptionMenu(self, self.var_registration, STARS, PHASE)
+        self.omRegistration.grid(row=8, column=1, padx=5, pady=5)
 
     # Checks if filename already has tif or tiff extensions and adds tif extension if not.
     def __check_extension(self, filename):
@@ -56,12 +200,81 @@ class StackingControlPanel(tk.Frame):
     def set_bayer_mask(self, bayer_mask):
         self.bayer_mask = bayer_mask
 
+    # Asks user to choose calibration files of given kind.
+    def __ask_calibration_files(self, kind):
+        filenames = tk.filedialog.askopenfilenames(
+            title=f'Select {kind:s} files:',
+            filetypes=(('fits files', '*.fit *.fits'), ('all files', '*.*')))
+        return list(filenames)
+
+    def __cmd_select_bias(self):
+        self.bias_files = self.__ask_calibration_files('bias')
+        self.btnBias['text'] = f'Bias: {len(self.bias_files):d}'
+
+    def __cmd_select_darks(self):
+        self.dark_files = self.__ask_calibration_files('dark')
+        self.btnDarks['text'] = f'Darks: {len(self.dark_files):d}'
+
+    def __cmd_select_flats(self):
+        self.flat_files = self.__ask_calibration_files('flat')
+        self.btnFlats['text'] = f'Flats: {len(self.flat_files):d}'
+
+    def __cmd_clear_calibration(self):
+        self.bias_files = []
+        self.dark_files = []
+        self.flat_files = []
+        self.btnBias['text'] = 'Bias: 0'
+        self.btnDarks['text'] = 'Darks: 0'
+        self.btnFlats['text'] = 'Flats: 0'
+
+    # Asks for directory and starts live stacking of files appearing in it or stops running live stacking.
+    def cmd_live(self):
+        if self.live_stacker is not None:
+            self.live_stacker.stop()
+            self.live_stacker = None
+            self.btnLive['text'] = 'Live stack directory'
+            return
+        directory = tk.filedialog.askdirectory(title='Select directory with captured files:')
+        if directory == '':
+            return
+        calibration_files = None
+        if any((self.bias_files, self.dark_files, self.flat_files)):
+            # masters are built by live stacking thread
+            calibration_files = (self.bias_files, self.dark_files, self.flat_files)
+        mask = self.bayer_mask if self.var_superpixel.get() else None
+        prepare_options = (None, mask, self.var_binning.get())
+        self.live_stacker = LiveStacker(directory, self.event_on_live_update, prepare_options,
+                                        calibration_files=calibration_files)
+        self.live_stacker.start()
+        self.btnLive['text'] = 'Stop live stacking'
+
     # Asks for filename and starts new thread for image stacking.
     def cmd_stack(self):
-        debayer = self.var_debayer.get()
-        mask = self.bayer_mask
         files_to_stack = self.filenames
         ref_frame_idx = self.ref_frame_idx
+        calibration_files = (self.bias_files, self.dark_files, self.flat_files)
+        # arguments of astrostacker.img.stack.stack
+        options = {
+            'debayer_result': self.var_debayer.get(),
+            'mask': self.bayer_mask,
+            'workers': self.var_workers.get(),
+            'method': self.var_method.get(),
+            'kappa': self.var_kappa.get(),
+            'superpixel': self.var_superpixel.get(),
+            'binning': self.var_binning.get(),
+            'drizzle': self.var_drizzle.get(),
+            'drizzle_scale': self.var_drizzle_scale.get(),
+            'pixfrac': self.var_pixfrac.get(),
+            'interpolation': self.var_interpolation.get(),
+            'integrators': self.var_integrators.get(),
+            'registration_method': self.var_registration.get(),
+        }
+        if options['binning'] > 1 and options['debayer_result'] and not options['superpixel']:
+            logger.info('Bayer frames can be binned only debayered to superpixels.')
+            return
+        if options['interpolation'] != SHIFT and options['debayer_result'] and not options['superpixel']:
+            logger.info('Bayer frames can be interpolated only debayered to superpixels.')
+            return
         filename = tk.filedialog.asksaveasfilename(
             title='Select TIFF file for stacking result:',
             filetypes=(('TIFF files', '*.tif *.tiff'), ('all files', '*.*')))
@@ -69,13 +282,48 @@ class StackingControlPanel(tk.Frame):
             return
         filename = self.__check_extension(filename)
 
-        thread = Thread(target=self.stack, args=(filename, files_to_stack, debayer, mask, ref_frame_idx))
+        thread = Thread(target=self.stack, args=(filename, files_to_stack, ref_frame_idx, calibration_files, options))
+        thread.start()
+
+    # Asks for SER video and filename and starts new thread for lucky imaging stacking of video.
+    def cmd_lucky(self):
+        video = tk.filedialog.askopenfilename(
+            title='Select SER video:',
+            filetypes=(('SER files', '*.ser'), ('all files', '*.*')))
+        if video == '':
+            return
+        filename = tk.filedialog.asksaveasfilename(
+            title='Select TIFF file for stacking result:',
+            filetypes=(('TIFF files', '*.tif *.tiff'), ('all files', '*.*')))
+        if filename == '':
+            return
+        filename = self.__check_extension(filename)
+        thread = Thread(target=self.stack_lucky, args=(video, filename, self.var_keep_percent.get(),
+                                                       self.var_debayer.get()))
         thread.start()
 
+    # Stacks the sharpest frames of SER video.
+    def stack_lucky(self, video, filename, keep_percent, debayer_result):
+        data = lucky_stack(video, keep_percent, debayer_result)
+        logger.info(f'Saving {filename:s}')
+        if os.path.exists(filename):
+            os.remove(filename)
+        tf.imwrite(filename, data)
+        logger.info(f'{filename:s} saved.')
+        logger.info('Stacking completed.')
+
     # Stacks images.
-    def stack(self, filename, files_to_stack, debayer, mask, ref_frame_idx):
-        data = stack(files_to_stack, debayer, mask, ref_frame_idx)
-        if debayer:
+    def stack(self, filename, files_to_stack, ref_frame_idx, calibration_files, options):
+        # registration cache and master frames are kept in directory of reference frame
+        cache_dir = os.path.dirname(files_to_stack[ref_frame_idx])
+        calibration = None
+        if any(calibration_files):
+            calibration = load_calibration(*calibration_files, cache_dir=cache_dir)
+        report = StackReport()
+        report.start(len(files_to_stack))
+        data = stack(files_to_stack, ref_frame_idx=ref_frame_idx, cache_dir=cache_dir, calibration=calibration,
+                     report=report, **options)
+        if options['debayer_result'] or options['superpixel']:
             data = data.astype(np.uint16)
             r = data[:, :, 0]
             g = data[:, :, 1]
@@ -84,9 +332,12 @@ class StackingControlPanel(tk.Frame):
         else:
             image = data
         logger.info(f'Saving {filename:s}')
-        if os.path.exists(filename):
-            os.remove(filename)
-        tf.imwrite(filename, data)
-        os.utime(filename)
+        with report.time(WRITE):
+            if os.path.exists(filename):
+                os.remove(filename)
+            tf.imwrite(filename, data)
+            os.utime(filename)
         logger.info(f'{filename:s} saved.')
+        report.finish()
+        report.save(os.path.splitext(filename)[0] + '.report.json')
         logger.info('Stacking completed.')
@@ -0,0 +1,115 @@
+import io
+import numpy as np
+
+
+# Returns pair of slices (destination, source) of overlap of axis of given length, when source of source_length
+# (by default the same length) is moved by offset.
+def overlap(length, offset, source_length=None):
+    if source_length is None:
+        source_length = length
+    start = min(max(offset, 0), length)
+    end = max(min(source_length + offset, length), start)
+    return slice(start, end), slice(start - offset, end - offset)
+
+
+# Running sum of frames added at integer offsets with per pixel count of frames covering each pixel.
+# Frame is added through overlapping slice views of sum and frame, without shifted copy of the frame,
+# and pixels moved out of the frame are not counted, so mean of edges is not darkened by missing pixels.
+# Offsets move frame content right (x) and down (y), the same way as astrostacker.img.shift.shift.
+# Integer frames are summed as int64, other ones as float64. Nan pixels of float frames (e.g. warped from outside
+# of frame) are not added nor counted. Works for mono and colour (height, width, channels).
+# Accumulator may cover only band of rows of stacked image starting at row origin_y and it may accumulate
+# into given (sum, coverage) buffers, e.g. in shared memory.
+class Accumulator:
+    def __init__(self, shape, dtype, origin_y=0, buffers=None):
+        if buffers is None:
+            self.sum = np.zeros(shape, dtype=np.int64 if np.dtype(dtype).kind in 'ui' else np.float64)
+            self.coverage = np.zeros(shape[:2], dtype=np.uint32)
+        else:
+            self.sum, self.coverage = buffers
+        self.origin_y = origin_y
+
+    # Adds frame moved by offset_x, offset_y pixels to the sum.
+    def add(self, data, offset_x=0, offset_y=0):
+        dst_y, src_y = overlap(self.sum.shape[0], offset_y - self.origin_y, data.shape[0])
+        dst_x, src_x = overlap(self.sum.shape[1], offset_x, data.shape[1])
+        if data.dtype.kind != 'f':
+            self.sum[dst_y, dst_x] += data[src_y, src_x]
+            self.coverage[dst_y, dst_x] += 1
+            return
+        data = data[src_y, src_x]
+        valid = ~np.isnan(data if data.ndim == 2 else data[:, :, 0])
+        np.add(self.sum[dst_y, dst_x], data, out=self.sum[dst_y, dst_x],
+               where=valid if data.ndim == 2 else valid[:, :, np.newaxis])
+        self.coverage[dst_y, dst_x] += valid
+
+    # Returns mean of frames covering each pixel, 0 where no frame does, as float64 or in given out array.
+    def mean(self, out=None):
+        coverage = self.coverage if self.sum.ndim == 2 else self.coverage[:, :, np.newaxis]
+        if out is None:
+            out = np.empty(self.sum.shape, dtype=np.float64)
+        out[...] = 0
+        np.divide(self.sum, coverage, out=out, where=coverage > 0, casting='unsafe')
+        return out
+
+
+# Accumulator of part of frames of stack, which can be merged with partial stacks of other frames of the same
+# stack and serialized, so parts can be stacked by different processes or machines.
+# With statistics sum of squares is accumulated too, for per pixel variance of frames.
+class PartialStack(Accumulator):
+    def __init__(self, shape, dtype, statistics=False):
+        Accumulator.__init__(self, shape, dtype)
+        self.frames = 0
+        self.squares = np.zeros(shape, dtype=np.float64) if statistics else None
+
+    # Adds frame moved by offset_x, offset_y pixels.
+    def add(self, data, offset_x=0, offset_y=0):
+        Accumulator.add(self, data, offset_x, offset_y)
+        self.frames += 1
+        if self.squares is None:
+            return
+        dst_y, src_y = overlap(self.squares.shape[0], offset_y, data.shape[0])
+        dst_x, src_x = overlap(self.squares.shape[1], offset_x, data.shape[1])
+        data = np.square(data[src_y, src_x], dtype=np.float64)
+        np.add(self.squares[dst_y, dst_x], data, out=self.squares[dst_y, dst_x], where=~np.isnan(data))
+
+    # Adds frames of other partial stack of the same shape to this one.
+    def merge(self, other):
+        self.sum += other.sum
+        self.coverage += other.coverage
+        self.frames += other.frames
+        if self.squares is not None and other.squares is not None:
+            self.squares += other.squares
+        else:
+            self.squares = None
+
+    # Returns float64 per pixel variance of frames covering each pixel, 0 where less than 2 frames do.
+    def variance(self):
+        if self.squares is None:
+            raise Exception('Partial stack has no statistics.')
+        coverage = self.coverage if self.sum.ndim == 2 else self.coverage[:, :, np.newaxis]
+        mean = self.mean()
+        result = np.zeros(self.sum.shape, dtype=np.float64)
+        np.divide(self.squares - coverage * mean * mean, coverage - 1.0, out=result, where=coverage > 1)
+        return np.maximum(result, 0, out=result)
+
+    # Returns partial stack serialized as npz archive.
+    def to_bytes(self):
+        arrays = {'sum': self.sum, 'coverage': self.coverage, 'frames': np.array(self.frames)}
+        if self.squares is not None:
+            arrays['squares'] = self.squares
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    # Returns partial stack from bytes made by to_bytes.
+    @staticmethod
+    def from_bytes(data):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            partial = PartialStack(arrays['sum'].shape, arrays['sum'].dtype, 'squares' in arrays)
+            partial.sum = arrays['sum']
+            partial.coverage = arrays['coverage']
+            partial.frames = int(arrays['frames'])
+            if partial.squares is not None:
+                partial.squares = arrays['squares']
+        return partial
@@ -0,0 +1,33 @@
+import numpy as np
+
+
+# Software binning: each factor x factor block of pixels becomes one pixel with average value of the block
+# (truncated for integer images). Rows and columns not filling whole block are dropped.
+# Works for mono and colour (height, width, channels) images. Integer images keep their type.
+def bin_image(img, factor):
+    if factor <= 1:
+        return img
+    height = img.shape[0] // factor * factor
+    width = img.shape[1] // factor * factor
+    if img.dtype.kind == 'u':
+        acc_dtype = np.uint32 if img.dtype.itemsize <= 2 else np.uint64
+    elif img.dtype.kind == 'i':
+        acc_dtype = np.int64
+    else:
+        acc_dtype = np.float64
+    # blocks are summed through strided views, one pixel position of the block at a time
+    acc = np.zeros((height // factor, width // factor) + img.shape[2:], dtype=acc_dtype)
+    for y in range(0, factor):
+        for x in range(0, factor):
+            acc += img[y:height:factor, x:width:factor]
+    n = factor * factor
+    if acc.dtype.kind == 'u':
+        acc //= n
+    elif acc.dtype.kind == 'i':
+        # truncate towards zero like integer mean
+        acc = np.trunc(acc / n)
+    else:
+        acc /= n
+    if img.dtype.kind in 'ui':
+        return acc.astype(img.dtype)
+    return acc.astype(np.float32)
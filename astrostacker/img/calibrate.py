@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import tempfile
+import numpy as np
+from astrostacker.img.frames import FrameReader
+from astrostacker.img.reject import ScratchCube, MEDIAN, MEMORY_BUDGET
+
+logger = logging.getLogger()
+
+# name of directory with cached master frames, created in session directory
+CACHE_DIRNAME = '.astrostacker-masters'
+
+
+# Returns key identifying set of input files (their paths, sizes and modification times) and combine method
+# with its kappa and iterations.
+def input_set_key(filenames, method, kappa=3.0, iterations=5):
+    h = hashlib.sha1(f'{method}\0{float(kappa)!r}\0{iterations}\0'.encode())
+    for filename in sorted(os.path.abspath(f) for f in filenames):
+        stat = os.stat(filename)
+        h.update(f'{filename}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+    return h.hexdigest()
+
+
+# Combines frames into master frame with out-of-core combine of astrostacker.img.reject.
+# If cache_dir is given, master is cached there keyed by input set, so it is built only once.
+# Cached master is written to temporary file first and renamed, so interrupted or concurrent build
+# never leaves truncated master behind. Returns float32 array.
+def build_master(filenames, method=MEDIAN, cache_dir=None, kappa=3.0, memory_budget=MEMORY_BUDGET,
+                 scratch_dir=None, iterations=5):
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, CACHE_DIRNAME,
+                                  input_set_key(filenames, method, kappa, iterations) + '.npy')
+        if os.path.exists(cache_path):
+            logger.info(f'Master frame of {len(filenames):d} files loaded from cache.')
+            return np.load(cache_path)
+    logger.info(f'Building master frame of {len(filenames):d} files.')
+    with FrameReader(filenames) as reader:
+        cube = None
+        for i, (filename, data) in enumerate(reader):
+            if cube is None:
+                cube = ScratchCube(len(filenames), data.shape, data.dtype, scratch_dir)
+            cube[i] = data
+    with cube:
+        master = cube.combine(method, kappa, iterations, memory_budget)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, master)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    return master
+
+
+# Calibration of light frames with master bias, dark and flat frames (float32 arrays, any may be None).
+# Master dark is expected to include bias, so bias is subtracted from lights only when there is no dark.
+# Flat is corrected with bias and normalized to mean 1.
+class Calibration:
+    def __init__(self, bias=None, dark=None, flat=None):
+        self.offset = dark if dark is not None else bias
+        self.flat = None
+        if flat is not None:
+            flat = np.array(flat, dtype=np.float32)
+            if bias is not None:
+                np.subtract(flat, bias, out=flat)
+            flat /= np.mean(flat)
+            # dead pixels of flat are left uncorrected instead of being divided by 0
+            flat[flat <= 0] = 1
+            self.flat = flat
+
+    # Calibrates data: subtracts dark or bias and divides by flat.
+    # Returns float32 array, data is converted once and then calibrated in place.
+    def apply(self, data):
+        data = np.array(data, dtype=np.float32)
+        if self.offset is not None:
+            np.subtract(data, self.offset, out=data)
+            np.maximum(data, 0, out=data)
+        if self.flat is not None:
+            np.divide(data, self.flat, out=data)
+        return data
+
+
+# Builds (or loads from cache) master frames from given lists of files and returns calibration using them.
+# Empty or None list means no such master frame.
+def load_calibration(bias_files=None, dark_files=None, flat_files=None, method=MEDIAN, cache_dir=None,
+                     kappa=3.0, memory_budget=MEMORY_BUDGET, scratch_dir=None):
+    masters = []
+    for filenames in (bias_files, dark_files, flat_files):
+        if filenames:
+            masters.append(build_master(filenames, method, cache_dir, kappa, memory_budget, scratch_dir))
+        else:
+            masters.append(None)
+    return Calibration(*masters)
@@ -0,0 +1,225 @@
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from astropy.io import fits as pyfits
+from astrostacker.img.quality import METRICS, STARS
+
+# directory and name of catalogue file
+CATALOGUE_DIR = os.path.join(os.path.expanduser('~'), '.astrostacker')
+CATALOGUE_FILENAME = 'catalogue.sqlite'
+# columns filled from FITS header and keywords read into them, the first one present is used
+HEADER_COLUMNS = {
+    'exposure': ('EXPTIME', 'EXPOSURE'),
+    'filter_name': ('FILTER',),
+    'temperature': ('CCD-TEMP', 'SET-TEMP'),
+    'gain': ('GAIN',),
+}
+# columns of indexed frames, in order of rows returned by Catalogue.rows after path and rejected flag
+FRAME_COLUMNS = ('exposure', 'filter_name', 'temperature', 'gain', 'width', 'height') + METRICS
+# column with position of frame in session, default order of frames
+POSITION = 'position'
+# number of files indexed in one transaction
+BATCH_SIZE = 100
+# size of blocks in which files are read for hashing
+HASH_BLOCK_SIZE = 1024 ** 2
+
+
+# Returns sha1 hash of file content.
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+# Returns indexed data of file: path, size, modification time, header columns, dimensions and content hash.
+# Header columns and dimensions of files which are not FITS files are None.
+def index_file(path):
+    stat = os.stat(path)
+    row = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'width': None, 'height': None}
+    for column in HEADER_COLUMNS:
+        row[column] = None
+    try:
+        header = pyfits.getheader(path)
+    except OSError:
+        header = None
+    if header is not None:
+        for column, keywords in HEADER_COLUMNS.items():
+            row[column] = next((header[k] for k in keywords if k in header), None)
+        row['width'] = header.get('NAXIS1')
+        row['height'] = header.get('NAXIS2')
+    row['content_hash'] = file_hash(path)
+    return row
+
+
+# Session catalogue: frames of the session in their order, with rejected flags and reference frame,
+# and index of frames with their size, modification time, FITS header fields, dimensions, content hash
+# and quality metrics (astrostacker.img.quality). Each file is indexed once and indexed again only when
+# its size or modification time changes, so session of thousands of frames is reopened without reading them.
+# Frames are sorted and filtered by indexed columns in SQLite file (by default in user's home directory).
+# Connection must be used by thread which created catalogue, other threads open their own catalogue.
+class Catalogue:
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(CATALOGUE_DIR, exist_ok=True)
+            path = os.path.join(CATALOGUE_DIR, CATALOGUE_FILENAME)
+        self.path = path
+        # ingestion thread writes while list view reads
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        metric_columns = ''.join(f', {metric:s} INTEGER' if metric == STARS else f', {metric:s} REAL'
+                                 for metric in METRICS)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS frames ('
+                                    'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, exposure REAL, '
+                                    'filter_name TEXT, temperature REAL, gain REAL, width INTEGER, height INTEGER, '
+                                    'content_hash TEXT' + metric_columns + ')')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS session ('
+                                    'position INTEGER PRIMARY KEY, path TEXT UNIQUE, rejected INTEGER DEFAULT 0)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS session_info (key TEXT PRIMARY KEY, value TEXT)')
+            for column in FRAME_COLUMNS:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS frames_{column:s} ON frames ({column:s})')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # Returns WHERE clause and its parameters selecting session frames with given filter
+    # and, if kept_only is set, not rejected ones.
+    @staticmethod
+    def __where(filter_name, kept_only=False):
+        conditions = []
+        parameters = []
+        if filter_name is not None:
+            conditions.append('frames.filter_name = ?')
+            parameters.append(filter_name)
+        if kept_only:
+            conditions.append('session.rejected = 0')
+        if len(conditions) == 0:
+            return '', parameters
+        return ' WHERE ' + ' AND '.join(conditions), parameters
+
+    # Returns paths of session frames in their order, with given filter only if it is given
+    # and not rejected only if kept_only is set.
+    def session_files(self, filter_name=None, kept_only=False):
+        where, parameters = self.__where(filter_name, kept_only)
+        rows = self.connection.execute('SELECT session.path FROM session LEFT JOIN frames USING (path)' + where +
+                                       ' ORDER BY session.position', parameters).fetchall()
+        return [row[0] for row in rows]
+
+    # Returns number of session frames, with given filter only if it is given.
+    def count(self, filter_name=None):
+        where, parameters = self.__where(filter_name)
+        return self.connection.execute('SELECT COUNT(*) FROM session LEFT JOIN frames USING (path)' + where,
+                                       parameters).fetchone()[0]
+
+    # Returns rows of session frames from offset to offset + limit sorted by sort_column (POSITION or one of
+    # 'path' and FRAME_COLUMNS), with given filter only if it is given. Frames without value go last.
+    # Row: path, rejected flag and FRAME_COLUMNS (None where frame is not indexed yet).
+    def rows(self, offset, limit, sort_column=POSITION, descending=False, filter_name=None):
+        if sort_column == POSITION or sort_column == 'path':
+            order = f'session.{sort_column:s}'
+        elif sort_column in FRAME_COLUMNS:
+            order = f'frames.{sort_column:s} IS NULL, frames.{sort_column:s}'
+        else:
+            raise Exception(f'Unknown column: {sort_column:s}')
+        direction = ' DESC' if descending else ''
+        where, parameters = self.__where(filter_name)
+        columns = ''.join(f', frames.{column:s}' for column in FRAME_COLUMNS)
+        return self.connection.execute(
+            'SELECT session.path, session.rejected' + columns + ' FROM session LEFT JOIN frames USING (path)' +
+            where + f' ORDER BY {order:s}{direction:s}, session.position LIMIT ? OFFSET ?',
+            parameters + [limit, offset]).fetchall()
+
+    # Returns sorted filter names of indexed session frames.
+    def filters(self):
+        rows = self.connection.execute('SELECT DISTINCT frames.filter_name FROM session JOIN frames USING (path) '
+                                       'WHERE frames.filter_name IS NOT NULL ORDER BY frames.filter_name')
+        return [row[0] for row in rows]
+
+    # Adds paths which are not in session yet at the end of session. Returns number of added paths.
+    def add_to_session(self, paths):
+        with self.connection:
+            cursor = self.connection.executemany('INSERT OR IGNORE INTO session (path) VALUES (?)',
+                                                 [(path,) for path in paths])
+        return cursor.rowcount
+
+    # Removes paths from session.
+    def remove_from_session(self, paths):
+        with self.connection:
+            self.connection.executemany('DELETE FROM session WHERE path = ?', [(path,) for path in paths])
+
+    # Removes all frames from session. Index of frames is kept.
+    def clear_session(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM session')
+            self.connection.execute('DELETE FROM session_info')
+
+    # Marks given session frames as rejected and all others as kept.
+    def set_rejected(self, paths):
+        with self.connection:
+            self.connection.execute('UPDATE session SET rejected = 0')
+            self.connection.executemany('UPDATE session SET rejected = 1 WHERE path = ?', [(path,) for path in paths])
+
+    # Returns path of reference frame of session or None.
+    def reference(self):
+        row = self.connection.execute("SELECT value FROM session_info WHERE key = 'reference'").fetchone()
+        return None if row is None else row[0]
+
+    # Sets path of reference frame of session.
+    def set_reference(self, path):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO session_info (key, value) VALUES ('reference', ?)",
+                                    (path,))
+
+    # Stores quality metrics of files (astrostacker.img.quality) in index.
+    def put_metrics(self, paths, metrics):
+        assignments = ', '.join(f'{metric:s} = ?' for metric in METRICS)
+        with self.connection:
+            self.connection.executemany(f'UPDATE frames SET {assignments:s} WHERE path = ?',
+                                        [[m[metric] for metric in METRICS] + [path] for path, m in zip(paths, metrics)])
+
+    # Returns paths which are not indexed yet or changed since they were indexed.
+    def unindexed(self, paths):
+        indexed = {}
+        for path, size, mtime in self.connection.execute('SELECT path, size, mtime FROM frames'):
+            indexed[path] = (size, mtime)
+        changed = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if indexed.get(path) != (stat.st_size, stat.st_mtime):
+                changed.append(path)
+        return changed
+
+    # Indexes files which are not indexed yet or changed since, by given number of threads reading headers
+    # and hashing content. Index is written in batches of batch_size files, progress(indexed, total) is called
+    # after each of them if it is given. Quality metrics of changed files are cleared.
+    # Returns number of indexed files.
+    def ingest(self, paths, workers=4, batch_size=BATCH_SIZE, progress=None):
+        paths = self.unindexed(paths)
+        columns = ('path', 'size', 'mtime', 'content_hash', 'width', 'height') + tuple(HEADER_COLUMNS)
+        assignments = ', '.join(f'{column:s} = excluded.{column:s}' for column in columns[1:]) + \
+            ''.join(f', {metric:s} = NULL' for metric in METRICS)
+        statement = f'INSERT INTO frames ({", ".join(columns):s}) VALUES ({", ".join("?" * len(columns)):s}) ' \
+                    f'ON CONFLICT (path) DO UPDATE SET {assignments:s}'
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(paths), batch_size):
+                rows = executor.map(index_file, paths[start:start + batch_size])
+                with self.connection:
+                    self.connection.executemany(statement, [[row[column] for column in columns] for row in rows])
+                if progress is not None:
+                    progress(min(start + batch_size, len(paths)), len(paths))
+        return len(paths)
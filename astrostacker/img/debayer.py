@@ -1,51 +1,32 @@
 import numpy as np
-from astrostacker.img.shift import shift
 
 RGGB = 'rggb'
 BGGR = 'bggr'
 GBRG = 'gbrg'
 GRBG = 'grbg'
 
-
-def leftright(x):
-    result = np.empty_like(x)
-    x_left = shift(x, -1, 0)
-    x_right = shift(x, 1, 0)
-    tmp = [x_left, x_right]
-    result = np.nanmean(tmp, axis=0, dtype=np.int)
-    return result
-
-def updown(x):
-    result = np.empty_like(x)
-    x_up = shift(x, 0, -1)
-    x_down = shift(x, 0, 1)
-    tmp = [x_up, x_down]
-    result = np.nanmean(tmp, axis=0, dtype=np.int)
-    return result
-
-
-def x_shape(x):
-    result = np.empty_like(x)
-    x_left_up = shift(x, -1, -1)
-    x_left_down = shift(x, -1, 1)
-    x_right_up = shift(x, 1, -1)
-    x_right_down = shift(x, 1, 1)
-    tmp = [x_left_up, x_left_down, x_right_up, x_right_down]
-    result = np.nanmean(tmp, axis=0, dtype=np.int)
-    return result
-
-
-def cross_shape(x):
-    result = np.empty_like(x)
-    x_left = shift(x, -1, 0)
-    x_right = shift(x, 1, 0)
-    x_up = shift(x, 0, -1)
-    x_down = shift(x, 0, 1)
-    tmp = [x_left, x_right, x_up, x_down]
-    result = np.nanmean(tmp, axis=0, dtype=np.int)
-    return result
-
-
+# Positions (row, column) of red and blue pixel in 2x2 cell of bayer mask.
+# Green pixels take the remaining 2 positions.
+RED_BLUE_POSITIONS = {
+    RGGB: ((0, 0), (1, 1)),
+    BGGR: ((1, 1), (0, 0)),
+    GBRG: ((1, 0), (0, 1)),
+    GRBG: ((0, 1), (1, 0)),
+}
+
+# Offsets (row, column) of neighbours averaged by interpolation.
+LEFT_RIGHT = ((0, -1), (0, 1))
+UP_DOWN = ((-1, 0), (1, 0))
+X_SHAPE = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+CROSS_SHAPE = ((0, -1), (0, 1), (-1, 0), (1, 0))
+
+
+# Bilinear debayering.
+# Each of 4 pixel positions of bayer cell is a sub-lattice (every second row and column) of image.
+# Sub-lattice of given colour keeps its values, on other sub-lattices the colour is average of
+# left-right, up-down, x-shape or cross-shape neighbours. Neighbours outside image count as 0.
+# Integer averages are truncated. Integer images keep their type, other ones are debayered to float32.
+# Returns array of shape (height, width, 3) with r, g, b channels.
 def debayer(img, mask):
     # Bayer mask shape:
     # ---------
@@ -54,205 +35,95 @@ def debayer(img, mask):
     # | P3 | P4 |
     # ---------
     mask = mask.lower()
-    if mask == RGGB:
-        mask_r = np.zeros(img.shape, dtype=np.int)
-        mask_r[::2, ::2] = 1
-        mask_g = np.zeros(img.shape, dtype=np.int)
-        mask_g[::2, 1::2] = 1
-        mask_g[1::2, ::2] = 1
-        mask_b = np.zeros(img.shape, dtype=np.int)
-        mask_b[1::2, 1::2] = 1
-    elif mask == BGGR:
-        mask_r = np.zeros(img.shape, dtype=np.int)
-        mask_r[1::2, 1::2] = 1
-        mask_g = np.zeros(img.shape, dtype=np.int)
-        mask_g[::2, 1::2] = 1
-        mask_g[1::2, ::2] = 1
-        mask_b = np.zeros(img.shape, dtype=np.int)
-        mask_b[::2, ::2] = 1
-    elif mask == GBRG:
-        mask_r = np.zeros(img.shape, dtype=np.int)
-        mask_r[1::2, ::2] = 1
-        mask_g = np.zeros(img.shape, dtype=np.int)
-        mask_g[::2, ::2] = 1
-        mask_g[1::2, 1::2] = 1
-        mask_b = np.zeros(img.shape, dtype=np.int)
-        mask_b[::2, 1::2] = 1
-    elif mask == GRBG:
-        mask_r = np.zeros(img.shape, dtype=np.int)
-        mask_r[::2, 1::2] = 1
-        mask_g = np.zeros(img.shape, dtype=np.int)
-        mask_g[::2, ::2] = 1
-        mask_g[1::2, 1::2] = 1
-        mask_b = np.zeros(img.shape, dtype=np.int)
-        mask_b[1::2, ::2] = 1
-    else:
+    if mask not in RED_BLUE_POSITIONS:
         raise Exception('Not supported bayer mask format.')
-
-    r = img * mask_r
-    g = img * mask_g
-    b = img * mask_b
-
-    mask_r = None
-    mask_g = None
-    mask_b = None
-
-    r_leftright = leftright(r)
-    r_updown = updown(r)
-    r_x_shape = x_shape(r)
-
-    g_cross_shape = cross_shape(g)
-
-    b_leftright = leftright(b)
-    b_updown = updown(b)
-    b_x_shape = x_shape(b)
-
-    r_for_p1 = debayer_r_for_p1(r, leftright=r_leftright, updown=r_updown, x_shape=r_x_shape, mask=mask)
-    r_for_p2 = debayer_r_for_p2(r, leftright=r_leftright, updown=r_updown, x_shape=r_x_shape, mask=mask)
-    r_for_p3 = debayer_r_for_p3(r, leftright=r_leftright, updown=r_updown, x_shape=r_x_shape, mask=mask)
-    r_for_p4 = debayer_r_for_p4(r, leftright=r_leftright, updown=r_updown, x_shape=r_x_shape, mask=mask)
-    r_new = r_for_p1 + r_for_p2 + r_for_p3 + r_for_p4
-
-    g_for_p1_p3 = debayer_g_for_p1_p3(g, cross_shape=g_cross_shape, mask=mask)
-    g_for_p2_p4 = debayer_g_for_p2_p4(g, cross_shape=g_cross_shape, mask=mask)
-    g_new = g_for_p1_p3 + g_for_p2_p4
-
-    b_for_p1 = debayer_b_for_p1(b, leftright=b_leftright, updown=b_updown, x_shape=b_x_shape, mask=mask)
-    b_for_p2 = debayer_b_for_p2(b, leftright=b_leftright, updown=b_updown, x_shape=b_x_shape, mask=mask)
-    b_for_p3 = debayer_b_for_p3(b, leftright=b_leftright, updown=b_updown, x_shape=b_x_shape, mask=mask)
-    b_for_p4 = debayer_b_for_p4(b, leftright=b_leftright, updown=b_updown, x_shape=b_x_shape, mask=mask)
-    b_new = b_for_p1 + b_for_p2 + b_for_p3 + b_for_p4
-
-    result = np.stack((r_new, g_new, b_new), axis=2)
-    return result
-
-
-def debayer_r_for_p1(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = x
-    elif mask == BGGR:
-        result = x_shape
-    elif mask == GBRG:
-        result = updown
-    elif mask == GRBG:
-        result = leftright
+    if img.dtype.kind in 'ui':
+        dtype = img.dtype
     else:
-        raise Exception('Not supported bayer mask format.')
+        dtype = np.float32
+    result = np.empty(img.shape + (3,), dtype=dtype)
+
+    (red_y, red_x), (blue_y, blue_x) = RED_BLUE_POSITIONS[mask]
+    for channel, y, x in ((0, red_y, red_x), (2, blue_y, blue_x)):
+        out = result[:, :, channel]
+        out[y::2, x::2] = img[y::2, x::2]
+        interpolate(img, y, 1 - x, LEFT_RIGHT, out)
+        interpolate(img, 1 - y, x, UP_DOWN, out)
+        interpolate(img, 1 - y, 1 - x, X_SHAPE, out)
+
+    out = result[:, :, 1]
+    out[red_y::2, 1 - red_x::2] = img[red_y::2, 1 - red_x::2]
+    out[1 - red_y::2, red_x::2] = img[1 - red_y::2, red_x::2]
+    interpolate(img, red_y, red_x, CROSS_SHAPE, out)
+    interpolate(img, blue_y, blue_x, CROSS_SHAPE, out)
     return result
 
-def debayer_r_for_p2(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = leftright
-    elif mask == BGGR:
-        result = updown
-    elif mask == GBRG:
-        result = x_shape
-    elif mask == GRBG:
-        result = x
-    else:
-        raise Exception('Not supported bayer mask format.')
-    return result
 
-def debayer_r_for_p3(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = updown
-    elif mask == BGGR:
-        result = leftright
-    elif mask == GBRG:
-        result = x
-    elif mask == GRBG:
-        result = x_shape
-    else:
+# Superpixel debayering: each 2x2 bayer cell becomes one pixel with its red value, average of both greens
+# (truncated for integer images) and blue value. Odd last row and column are dropped.
+# Returns array of shape (height // 2, width // 2, 3) with r, g, b channels.
+def superpixel(img, mask):
+    mask = mask.lower()
+    if mask not in RED_BLUE_POSITIONS:
         raise Exception('Not supported bayer mask format.')
-    return result
-
-def debayer_r_for_p4(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = x_shape
-    elif mask == BGGR:
-        result = x
-    elif mask == GBRG:
-        result = leftright
-    elif mask == GRBG:
-        result = updown
+    if img.dtype.kind in 'ui':
+        dtype = img.dtype
     else:
-        raise Exception('Not supported bayer mask format.')
-    return result
-
-def debayer_g_for_p1_p3(x, cross_shape, mask):
-    if mask == RGGB:
-        result = cross_shape
-    elif mask == BGGR:
-        result = cross_shape
-    elif mask == GBRG:
-        result = x
-    elif mask == GRBG:
-        result = x
+        dtype = np.float32
+    height = img.shape[0] // 2 * 2
+    width = img.shape[1] // 2 * 2
+    result = np.empty((height // 2, width // 2, 3), dtype=dtype)
+    (red_y, red_x), (blue_y, blue_x) = RED_BLUE_POSITIONS[mask]
+    result[:, :, 0] = img[red_y:height:2, red_x:width:2]
+    result[:, :, 2] = img[blue_y:height:2, blue_x:width:2]
+    green = img[red_y:height:2, 1 - red_x:width:2].astype(_accumulator_type(img.dtype))
+    green += img[1 - red_y:height:2, red_x:width:2]
+    if green.dtype.kind == 'f':
+        green /= 2
     else:
-        raise Exception('Not supported bayer mask format.')
+        green //= 2
+    result[:, :, 1] = green
     return result
 
-def debayer_g_for_p2_p4(x, cross_shape, mask):
-    if mask == RGGB:
-        result = x
-    elif mask == BGGR:
-        result = x
-    elif mask == GBRG:
-        result = cross_shape
-    elif mask == GRBG:
-        result = cross_shape
-    else:
-        raise Exception('Not supported bayer mask format.')
-    return result
 
-def debayer_b_for_p1(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = x_shape
-    elif mask == BGGR:
-        result = x
-    elif mask == GBRG:
-        result = leftright
-    elif mask == GRBG:
-        result = updown
+# Sets sub-lattice of out starting at (y, x) to average of img neighbours at given offsets.
+# Neighbours are summed in place into accumulator of sub-lattice size through strided views of img.
+def interpolate(img, y, x, offsets, out):
+    height, width = img.shape
+    rows = len(range(y, height, 2))
+    cols = len(range(x, width, 2))
+    if rows == 0 or cols == 0:
+        return
+    acc = np.zeros((rows, cols), dtype=_accumulator_type(img.dtype))
+    for dy, dx in offsets:
+        first_row, last_row = _neighbour_range(y, dy, height, rows)
+        first_col, last_col = _neighbour_range(x, dx, width, cols)
+        src_y = y + 2 * first_row + dy
+        src_x = x + 2 * first_col + dx
+        acc[first_row:last_row, first_col:last_col] += img[src_y:src_y + 2 * (last_row - first_row):2,
+                                                           src_x:src_x + 2 * (last_col - first_col):2]
+    n = len(offsets)
+    if acc.dtype.kind == 'u':
+        np.floor_divide(acc, n, out=acc)
+    elif acc.dtype.kind == 'i':
+        # truncate towards zero like integer mean
+        acc = np.trunc(acc / n)
     else:
-        raise Exception('Not supported bayer mask format.')
-    return result
+        np.true_divide(acc, n, out=acc)
+    out[y::2, x::2] = acc
 
-def debayer_b_for_p2(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = updown
-    elif mask == BGGR:
-        result = leftright
-    elif mask == GBRG:
-        result = x
-    elif mask == GRBG:
-        result = x_shape
-    else:
-        raise Exception('Not supported bayer mask format.')
-    return result
 
-def debayer_b_for_p3(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = leftright
-    elif mask == BGGR:
-        result = updown
-    elif mask == GBRG:
-        result = x_shape
-    elif mask == GRBG:
-        result = x
-    else:
-        raise Exception('Not supported bayer mask format.')
-    return result
+# Returns range of sub-lattice indices, for which neighbour at offset lies inside image.
+def _neighbour_range(start, offset, size, count):
+    first = 1 if start + offset < 0 else 0
+    last = count - 1 if start + 2 * (count - 1) + offset >= size else count
+    return first, last
 
-def debayer_b_for_p4(x, leftright, updown, x_shape, mask):
-    if mask == RGGB:
-        result = x
-    elif mask == BGGR:
-        result = x_shape
-    elif mask == GBRG:
-        result = updown
-    elif mask == GRBG:
-        result = leftright
-    else:
-        raise Exception('Not supported bayer mask format.')
-    return result
+
+# Returns type big enough for summing 4 values of given type.
+def _accumulator_type(dtype):
+    if dtype.kind == 'u':
+        return np.uint32 if dtype.itemsize <= 2 else np.uint64
+    if dtype.kind == 'i':
+        return np.int64
+    return np.float64
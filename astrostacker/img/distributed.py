@@ -0,0 +1,275 @@
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+import socket
+import struct
+import threading
+import numpy as np
+from astrostacker.img.accumulate import PartialStack
+from astrostacker.img.calibrate import load_calibration
+from astrostacker.img.debayer import debayer, RGGB
+from astrostacker.img.frames import read_frame
+from astrostacker.img.register import Registration
+from astrostacker.img.stack import prepare, register_files, shift_offset
+from astrostacker.img.warp import SHIFT
+
+logger = logging.getLogger()
+
+# Stacking of frames split between worker processes, on this or other machines sharing files (e.g. on NAS).
+# Coordinator prepares the reference frame and detects its stars once, then hands chunks of remaining files
+# to workers over TCP. Workers register frames against the same reference stars, stack them to PartialStack
+# and send it back, coordinator merges partial stacks. Files and calibration files must have the same paths
+# on all machines.
+# Workers listen on local interface unless other host is given and serve only coordinators sending
+# the same shared token. Token is not encrypted, so workers must be reached over trusted network only.
+#
+# Message: 12 bytes prefix (big endian uint32 length of header, uint64 length of payload), JSON header, payload.
+# Messages of coordinator: {"type": "stack", "token": ..., ...task...}, {"type": "stop", "token": ...}.
+# Messages of worker: {"type": "partial", "frames": n} with npz payload of PartialStack, {"type": "error", ...}.
+
+# default host and port of workers
+HOST = '127.0.0.1'
+PORT = 5730
+# environment variable with shared token of workers and coordinator
+TOKEN_VARIABLE = 'ASTROSTACKER_TOKEN'
+# maximum length of received header, longer messages are refused
+MAX_HEADER_SIZE = 16 * 1024 ** 2
+# number of files handed to worker at once
+CHUNK_SIZE = 8
+PREFIX = struct.Struct('>IQ')
+
+
+# Sends message with JSON header and bytes payload.
+def send_message(connection, header, payload=b''):
+    header = json.dumps(header).encode()
+    connection.sendall(PREFIX.pack(len(header), len(payload)) + header)
+    if len(payload) > 0:
+        connection.sendall(payload)
+
+
+# Receives exactly n bytes, raises exception when connection is closed before.
+def _receive_exactly(connection, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = connection.recv_into(view[received:], n - received)
+        if count == 0:
+            raise Exception('Connection closed.')
+        received += count
+    return bytes(buffer)
+
+
+# Receives message. Returns header and payload.
+# Messages with longer header than MAX_HEADER_SIZE or longer payload than max_payload (if given) are refused.
+def receive_message(connection, max_payload=None):
+    header_length, payload_length = PREFIX.unpack(_receive_exactly(connection, PREFIX.size))
+    if header_length > MAX_HEADER_SIZE or (max_payload is not None and payload_length > max_payload):
+        raise Exception('Message too long.')
+    header = json.loads(_receive_exactly(connection, header_length).decode())
+    return header, _receive_exactly(connection, payload_length)
+
+
+# Returns (host, port) of address given as host:port or host.
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    if host == '':
+        return address, PORT
+    return host, int(port)
+
+
+# Stacks files of task to PartialStack.
+# Task: files, stars of reference frame, shape and type of prepared reference frame, calibration files
+# (bias, darks, flats) with cache directory of their masters, superpixel mask, binning, interpolation
+# and statistics (whether to accumulate sum of squares).
+def stack_task(task):
+    calibration = None
+    if task['calibration'] is not None:
+        calibration = load_calibration(*task['calibration'], cache_dir=task['cache_dir'])
+    prepare_options = (calibration, task['superpixel_mask'], task['binning'])
+    registration = Registration(None, stars=np.array(task['stars'], dtype=np.float64))
+    interpolation = task['interpolation']
+    resample = None if interpolation == SHIFT else interpolation
+    frame_type = task['dtype'] if interpolation == SHIFT else np.float32
+    partial = PartialStack(tuple(task['shape']), frame_type, task['statistics'])
+    registered_files = register_files(task['files'], registration, prepare_options=prepare_options,
+                                      resample=resample)
+    for filepath, registered, _ in registered_files:
+        registered_image, _, translation_x, translation_y, _ = registered
+        if resample is None:
+            partial.add(registered_image, *shift_offset(translation_x, translation_y))
+        else:
+            partial.add(registered_image)
+        logger.info(f'{filepath:s} stacked.')
+    return partial
+
+
+# Returns True if token of message header is the shared token.
+def _authorized(header, token):
+    return hmac.compare_digest(str(header.get('token', '')).encode(), token.encode())
+
+
+# Serves tasks of coordinators sending given token, one connection at a time, until stop message.
+# Connection sending message with other token is closed.
+# Port of listening socket is put to ready queue if it is given (port 0 picks free port).
+def serve(host=HOST, port=PORT, token=None, ready=None):
+    if not token:
+        raise Exception('Worker needs shared token.')
+    with socket.create_server((host, port)) as server:
+        if ready is not None:
+            ready.put(server.getsockname()[1])
+        logger.info(f'Worker listening on {host:s} port {server.getsockname()[1]:d}')
+        while True:
+            connection, address = server.accept()
+            with connection:
+                try:
+                    while True:
+                        # coordinator messages have no payload
+                        header, _ = receive_message(connection, max_payload=0)
+                        if not _authorized(header, token):
+                            raise Exception('wrong token')
+                        if header['type'] == 'stop':
+                            return
+                        try:
+                            partial = stack_task(header)
+                        except Exception as e:
+                            logger.exception('Task failed.')
+                            send_message(connection, {'type': 'error', 'message': str(e)})
+                            continue
+                        send_message(connection, {'type': 'partial', 'frames': partial.frames}, partial.to_bytes())
+                except Exception as e:
+                    logger.info(f'Connection from {address[0]:s} closed: {e}')
+
+
+# Starts n worker processes on this machine, serving coordinators with random token.
+# Returns their processes, addresses and token.
+def start_local_workers(n):
+    token = secrets.token_hex(16)
+    ready = multiprocessing.Queue()
+    processes = []
+    for _ in range(0, n):
+        process = multiprocessing.Process(target=serve, args=(HOST, 0, token, ready), daemon=True)
+        process.start()
+        processes.append(process)
+    addresses = [f'{HOST:s}:{ready.get(timeout=60):d}' for _ in processes]
+    return processes, addresses, token
+
+
+# Sends stop message to workers at given addresses.
+def stop_workers(addresses, token):
+    for address in addresses:
+        try:
+            with socket.create_connection(parse_address(address), timeout=10) as connection:
+                send_message(connection, {'type': 'stop', 'token': token})
+        except OSError as e:
+            logger.info(f'Worker {address:s} not stopped: {e}')
+
+
+# Hands chunks from queue to worker at address and merges received partial stacks into total under lock.
+def _run_worker(address, chunks, task, total, lock, errors):
+    try:
+        with socket.create_connection(parse_address(address)) as connection:
+            while len(errors) == 0:
+                try:
+                    chunk = chunks.get(block=False)
+                except queue.Empty:
+                    return
+                send_message(connection, dict(task, files=chunk))
+                header, payload = receive_message(connection)
+                if header['type'] == 'error':
+                    raise Exception(header['message'])
+                partial = PartialStack.from_bytes(payload)
+                with lock:
+                    total.merge(partial)
+                logger.info(f'{address:s} stacked {partial.frames:d} files.')
+    except Exception as e:
+        errors.append(f'{address:s}: {e}')
+
+
+# Stacks files by workers at given addresses (host:port). Returns PartialStack of all files.
+# Reference frame is prepared and its stars are detected here, all workers register against these stars,
+# so registration is the same as in astrostacker.img.stack.stack. Options are the same as of stack.
+# Calibration masters are built here first (cached in cache_dir), so workers only load them from cache.
+# Token is the shared token of workers.
+def distribute(filenames, addresses, token, ref_frame_idx=0, mask=RGGB, superpixel=False, binning=1,
+               calibration_files=None, cache_dir=None, interpolation=SHIFT, statistics=False, chunk_size=CHUNK_SIZE):
+    if ref_frame_idx >= len(filenames):
+        ref_frame_idx = 0
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(filenames[ref_frame_idx]))
+    calibration = None
+    if calibration_files is not None and any(calibration_files):
+        calibration = load_calibration(*calibration_files, cache_dir=cache_dir)
+    else:
+        calibration_files = None
+    superpixel_mask = mask if superpixel else None
+    ref_frame = prepare(read_frame(filenames[ref_frame_idx]), calibration, superpixel_mask, binning)
+    registration = Registration(ref_frame)
+    logger.info(f'{len(registration.stars):d} reference stars found.')
+    task = {
+        'type': 'stack',
+        'token': token,
+        'stars': np.asarray(registration.stars).tolist(),
+        'shape': list(ref_frame.shape),
+        'dtype': ref_frame.dtype.str,
+        'calibration': calibration_files,
+        'cache_dir': cache_dir,
+        'superpixel_mask': superpixel_mask,
+        'binning': binning,
+        'interpolation': interpolation,
+        'statistics': statistics,
+    }
+    total = PartialStack(ref_frame.shape, ref_frame.dtype if interpolation == SHIFT else np.float32, statistics)
+    total.add(ref_frame)
+    remaining = [f for i, f in enumerate(filenames) if i != ref_frame_idx]
+    chunks = queue.Queue()
+    for i in range(0, len(remaining), chunk_size):
+        chunks.put(remaining[i:i + chunk_size])
+    lock = threading.Lock()
+    errors = []
+    threads = [threading.Thread(target=_run_worker, args=(address, chunks, task, total, lock, errors))
+               for address in addresses]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise Exception('Distributed stacking failed: ' + '; '.join(errors))
+    if total.frames != len(filenames):
+        raise Exception(f'Only {total.frames:d} of {len(filenames):d} files were stacked.')
+    return total
+
+
+# Stacks files by workers at given addresses serving given token (by default from TOKEN_VARIABLE),
+# or by local_workers processes started for this stack when no addresses are given.
+# Returns uint16 mean stack, the same as astrostacker.img.stack.stack with MEAN method.
+def stack_distributed(filenames, addresses=None, local_workers=2, debayer_result=False, mask=RGGB, ref_frame_idx=0,
+                      superpixel=False, binning=1, calibration_files=None, cache_dir=None, interpolation=SHIFT,
+                      chunk_size=CHUNK_SIZE, token=None):
+    if binning > 1 and debayer_result and not superpixel:
+        raise Exception('Bayer frames can be binned only debayered to superpixels.')
+    if interpolation != SHIFT and debayer_result and not superpixel:
+        raise Exception('Bayer frames can be interpolated only debayered to superpixels.')
+    processes = []
+    if not addresses:
+        processes, addresses, token = start_local_workers(local_workers)
+    elif not token:
+        token = os.environ.get(TOKEN_VARIABLE)
+        if not token:
+            raise Exception(f'Shared token of workers is not given, set {TOKEN_VARIABLE:s}.')
+    try:
+        total = distribute(filenames, addresses, token, ref_frame_idx, mask, superpixel, binning, calibration_files,
+                           cache_dir, interpolation, chunk_size=chunk_size)
+    finally:
+        if len(processes) > 0:
+            stop_workers(addresses, token)
+            for process in processes:
+                process.join()
+    result = np.clip(total.mean(), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    if debayer_result and not superpixel:
+        result = debayer(result, mask)
+    return result
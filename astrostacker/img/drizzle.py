@@ -0,0 +1,119 @@
+import math
+import numpy as np
+
+# default output scale and drop size (fraction of input pixel side)
+SCALE = 2.0
+PIXFRAC = 0.7
+# side of output tile in pixels, drops are computed for one output tile at a time
+TILE_SIZE = 512
+
+
+# Returns matrix mapping input pixel coordinates to output pixel coordinates (both with pixel centres at integers)
+# from matrix of transformation of input onto reference frame and output scale.
+def output_matrix(matrix, scale):
+    # move to pixel edges, scale and move back to pixel centres
+    to_edges = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+    to_centres = np.array([[1, 0, -0.5], [0, 1, -0.5], [0, 0, 1]])
+    scaling = np.diag([scale, scale, 1.0])
+    return to_centres @ scaling @ to_edges @ np.asarray(matrix, dtype=np.float64)
+
+
+# Returns (start, end) of range of input pixels along axis of given length, covering mapped corners of output tile.
+def _input_range(corners, length, pad):
+    return max(0, int(math.floor(corners.min())) - pad), min(length, int(math.ceil(corners.max())) + pad + 1)
+
+
+# Returns overlap of drops starting at start with given size with output pixels out (array of indices along axis)
+# and index of those pixels in tile start..end. Overlap outside tile is 0 and index is clipped into tile.
+def _overlap(start, size, out, tile_start, tile_end):
+    overlap = np.minimum(start + size, out + 1) - np.maximum(start, out)
+    inside = (overlap > 0) & (out >= tile_start) & (out < tile_end)
+    overlap = np.where(inside, overlap, 0)
+    return overlap, np.clip(out - tile_start, 0, tile_end - tile_start - 1)
+
+
+# Drizzle integration (variable-pixel linear reconstruction).
+# Each input pixel is shrunk to a square drop of side pixfrac, mapped by full sub-pixel transformation onto
+# output grid scale times finer than input and its value is added to output pixels weighted by overlap area.
+# Drops are treated as squares of the same area as the transformed drop, aligned with output grid, which is
+# exact for translation and close for small rotations of registered frames.
+# Output and weight planes are float32. Drops of all input pixels landing in one output tile are computed at once,
+# so temporary arrays take only a few times the size of a tile.
+# Works for mono and colour (height, width, channels) frames.
+class Drizzle:
+    def __init__(self, shape, scale=SCALE, pixfrac=PIXFRAC, tile_size=TILE_SIZE):
+        self.input_shape = tuple(shape)
+        self.scale = scale
+        self.pixfrac = pixfrac
+        self.tile_size = tile_size
+        out_shape = (int(round(shape[0] * scale)), int(round(shape[1] * scale)))
+        self.data = np.zeros(out_shape + tuple(shape[2:]), dtype=np.float32)
+        self.weight = np.zeros(out_shape, dtype=np.float32)
+
+    # Drizzles frame with given 3x3 matrix of transformation of frame onto reference frame
+    # (in (x, y) coordinates, e.g. params of skimage transformation).
+    def add(self, data, matrix=None):
+        if matrix is None:
+            matrix = np.eye(3)
+        matrix = output_matrix(matrix, self.scale)
+        inverse = np.linalg.inv(matrix)
+        # half side of drop in output pixels
+        half = self.pixfrac * math.sqrt(abs(np.linalg.det(matrix[:2, :2]))) / 2
+        # number of output pixels drop can overlap along each axis
+        span = int(math.ceil(2 * half)) + 1
+        height, width = self.weight.shape
+        for y0 in range(0, height, self.tile_size):
+            y1 = min(height, y0 + self.tile_size)
+            for x0 in range(0, width, self.tile_size):
+                x1 = min(width, x0 + self.tile_size)
+                self.__add_tile(data, matrix, inverse, half, span, y0, y1, x0, x1)
+
+    # Drizzles drops of input pixels landing in output tile y0..y1, x0..x1.
+    def __add_tile(self, data, matrix, inverse, half, span, y0, y1, x0, x1):
+        # input region mapped onto tile, padded by drop size
+        corners = inverse @ np.array([[x0 - 1, x1, x0 - 1, x1], [y0 - 1, y0 - 1, y1, y1], [1, 1, 1, 1]])
+        pad = span + 1
+        in_x0, in_x1 = _input_range(corners[0], self.input_shape[1], pad)
+        in_y0, in_y1 = _input_range(corners[1], self.input_shape[0], pad)
+        if in_x1 <= in_x0 or in_y1 <= in_y0:
+            return
+        ys, xs = np.mgrid[in_y0:in_y1, in_x0:in_x1]
+        xs = xs.astype(np.float64)
+        ys = ys.astype(np.float64)
+        # drop edges in output coordinates, where output pixel i spans [i, i + 1)
+        centre_x = matrix[0, 0] * xs + matrix[0, 1] * ys + matrix[0, 2] + 0.5
+        centre_y = matrix[1, 0] * xs + matrix[1, 1] * ys + matrix[1, 2] + 0.5
+        del xs, ys
+        left = centre_x - half
+        top = centre_y - half
+        first_x = np.floor(left).astype(np.int64)
+        first_y = np.floor(top).astype(np.int64)
+        values = data[in_y0:in_y1, in_x0:in_x1]
+        if values.ndim == 2:
+            values = values[:, :, np.newaxis]
+        tile_height = y1 - y0
+        tile_width = x1 - x0
+        n = tile_height * tile_width
+        tile_data = np.zeros((values.shape[2], n), dtype=np.float64)
+        tile_weight = np.zeros(n, dtype=np.float64)
+        # overlaps and tile indices of output columns and rows each drop can fall in,
+        # overlap is 0 for pixels outside drop or tile
+        columns = [_overlap(left, 2 * half, first_x + i, x0, x1) for i in range(0, span)]
+        rows = [_overlap(top, 2 * half, first_y + j, y0, y1) for j in range(0, span)]
+        for overlap_y, out_y in rows:
+            for overlap_x, out_x in columns:
+                area = (overlap_x * overlap_y).ravel()
+                idx = (out_y * tile_width + out_x).ravel()
+                tile_weight += np.bincount(idx, weights=area, minlength=n)
+                for c in range(0, values.shape[2]):
+                    tile_data[c] += np.bincount(idx, weights=area * values[:, :, c].ravel(), minlength=n)
+        tile_data = np.moveaxis(tile_data, 0, -1).reshape((tile_height, tile_width) + data.shape[2:])
+        self.data[y0:y1, x0:x1] += tile_data
+        self.weight[y0:y1, x0:x1] += tile_weight.reshape(tile_height, tile_width)
+
+    # Returns float32 drizzled image: weighted mean of drops, 0 where no drop landed.
+    def result(self):
+        weight = self.weight if self.data.ndim == 2 else self.weight[:, :, np.newaxis]
+        result = np.zeros(self.data.shape, dtype=np.float32)
+        np.divide(self.data, weight, out=result, where=weight > 0)
+        return result
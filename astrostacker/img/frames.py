@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+import numpy as np
+from astropy.io import fits as pyfits
+
+
+# Reads data of primary HDU from FITS file.
+# File is memory mapped, so data is copied from disk only once, while converting it to native byte order.
+# Unsigned data stored with BZERO offset (e.g. uint16) is converted in the same pass.
+# Other scaled data is left to astropy.
+def read_frame(filename):
+    with pyfits.open(filename, memmap=True, do_not_scale_image_data=True) as img:
+        header = img[0].header
+        raw = img[0].data
+        bscale = header.get('BSCALE', 1)
+        bzero = header.get('BZERO', 0)
+        if bscale == 1 and bzero == 0:
+            return np.asarray(raw, dtype=raw.dtype.newbyteorder('='))
+        # BZERO is often written as float (32768.0), integer offset is used for xor
+        offset = 2 ** (8 * raw.dtype.itemsize - 1)
+        if bscale == 1 and raw.dtype.kind == 'i' and bzero == offset and 'BLANK' not in header:
+            unsigned = raw.dtype.newbyteorder('=').str.replace('i', 'u')
+            data = np.empty(raw.shape, dtype=unsigned)
+            np.bitwise_xor(raw.view(raw.dtype.str.replace('i', 'u')), data.dtype.type(offset), out=data,
+                           casting='unsafe')
+            return data
+    return pyfits.getdata(filename, memmap=False)
+
+
+# Iterable reading frames in background thread ahead of the one being processed.
+# Yields (filename, data) in order of filenames. Seconds spent reading the last yielded frame are in read_seconds.
+# At most depth frames wait in queue, so reader holds no more than depth + 2 frames in memory
+# (queued ones, one being read and one being processed).
+class FrameReader:
+    def __init__(self, filenames, depth=2):
+        self.filenames = list(filenames)
+        self.depth = max(1, depth)
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.read_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        self.thread = threading.Thread(target=self.__read_all, daemon=True)
+        self.thread.start()
+        for _ in range(0, len(self.filenames)):
+            filename, data, error, self.read_seconds = self.queue.get()
+            if error is not None:
+                raise error
+            yield filename, data
+
+    # Stops reading thread and releases queued frames.
+    def close(self):
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get(block=False)
+            except queue.Empty:
+                break
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Reads all files, waiting for free place in queue.
+    def __read_all(self):
+        for filename in self.filenames:
+            if self.stopped.is_set():
+                return
+            started = time.perf_counter()
+            try:
+                item = (filename, read_frame(filename), None, time.perf_counter() - started)
+            except Exception as e:
+                item = (filename, None, e, 0.0)
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[2] is not None:
+                return
@@ -0,0 +1,185 @@
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+import numpy as np
+from astrostacker.img.accumulate import Accumulator
+
+# number of rows of stacked image in one tile
+TILE_ROWS = 256
+# number of shared frame slots, frame can be copied to free slot while integrators add previous ones
+SLOTS = 2
+
+
+# Returns types of sum and coverage of frames of given type, small enough for n frames:
+# 16 bit frames are summed as uint32 up to 65537 frames, coverage is uint16 up to 65535 frames.
+def buffer_types(dtype, n):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u' and dtype.itemsize <= 2 and n * np.iinfo(dtype).max <= np.iinfo(np.uint32).max:
+        sum_type = np.uint32
+    elif dtype.kind in 'ui':
+        sum_type = np.int64
+    else:
+        sum_type = np.float64
+    return sum_type, np.uint16 if n <= np.iinfo(np.uint16).max else np.uint32
+
+
+# Creates shared memory block for array of given shape and type. Returns block and array in it.
+def _create_shared(shape, dtype):
+    size = max(1, int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+# Attaches to shared memory block created by other process. Returns block and array in it.
+def _attach_shared(name, shape, dtype):
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+# Runs in integrating process. Accumulates frames from shared slots into owned tiles until None is received.
+# Tiles are given as (origin_y, sum spec, coverage spec), slots and tiles as (name, shape, dtype) specs.
+def _integrate(tiles, slots, tasks, done):
+    blocks = []
+    frames = []
+    for spec in slots:
+        block, frame = _attach_shared(*spec)
+        blocks.append(block)
+        frames.append(frame)
+    accumulators = []
+    for origin_y, sum_spec, coverage_spec in tiles:
+        sum_block, tile_sum = _attach_shared(*sum_spec)
+        coverage_block, tile_coverage = _attach_shared(*coverage_spec)
+        blocks.extend((sum_block, coverage_block))
+        accumulators.append(Accumulator(tile_sum.shape, tile_sum.dtype, origin_y, (tile_sum, tile_coverage)))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, offset_x, offset_y = task
+            for accumulator in accumulators:
+                accumulator.add(frames[slot], offset_x, offset_y)
+            done.put(slot)
+    finally:
+        # arrays must not outlive memory of blocks
+        del frames, accumulators
+        for block in blocks:
+            block.close()
+
+
+# Mean integration of frames by several processes, with stacked image split to tiles (bands of rows)
+# in shared memory. Each process owns every workers-th tile and adds every frame only to its tiles
+# (see astrostacker.img.accumulate.Accumulator). Frame is copied once to shared slot, from which all processes
+# read it in place, so adding frame costs one copy regardless of number of processes.
+# Sum and coverage types are the smallest ones which do not overflow for n frames (see buffer_types).
+# Mean is computed tile by tile straight into float64 result array, without full size temporary copy,
+# so it is the same as mean of astrostacker.img.accumulate.Accumulator.
+# Must be closed (or used as context manager) to release shared memory.
+class SharedIntegrator:
+    def __init__(self, shape, dtype, n, workers, tile_rows=TILE_ROWS, slots=SLOTS):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.blocks = []
+        self.tiles = []
+        self.slots = []
+        self.processes = []
+        sum_type, coverage_type = buffer_types(dtype, n)
+        height = self.shape[0]
+        workers = max(1, min(workers, (height + tile_rows - 1) // tile_rows))
+        owned = [[] for _ in range(0, workers)]
+        for i, y0 in enumerate(range(0, height, tile_rows)):
+            y1 = min(height, y0 + tile_rows)
+            specs = []
+            arrays = []
+            for tile_shape, tile_type in (((y1 - y0,) + self.shape[1:], sum_type), ((y1 - y0,) + self.shape[1:2],
+                                                                                    coverage_type)):
+                block, array = _create_shared(tile_shape, tile_type)
+                array[...] = 0
+                self.blocks.append(block)
+                specs.append((block.name, tile_shape, np.dtype(tile_type).str))
+                arrays.append(array)
+            self.tiles.append((y0, y1, arrays[0], arrays[1]))
+            owned[i % workers].append((y0, specs[0], specs[1]))
+        slot_specs = []
+        for _ in range(0, slots):
+            block, array = _create_shared(self.shape, self.dtype)
+            self.blocks.append(block)
+            self.slots.append(array)
+            slot_specs.append((block.name, self.shape, self.dtype.str))
+        self.free_slots = list(range(0, slots))
+        # number of processes which did not add frame in slot yet
+        self.pending = [0] * slots
+        self.done = multiprocessing.Queue()
+        self.tasks = []
+        for tiles in owned:
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_integrate, args=(tiles, slot_specs, tasks, self.done),
+                                              daemon=True)
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Marks slots as free as integrating processes finish them, waits for at least one if block is set.
+    def __collect(self, block):
+        while True:
+            try:
+                slot = self.done.get(block=block, timeout=1 if block else None)
+            except queue.Empty:
+                if not block:
+                    return
+                if not all(process.is_alive() for process in self.processes):
+                    raise Exception('Integrating process failed.')
+                continue
+            self.pending[slot] -= 1
+            if self.pending[slot] == 0:
+                self.free_slots.append(slot)
+            block = False
+
+    # Adds frame moved by offset_x, offset_y pixels. Frame must have shape and type given to integrator.
+    def add(self, data, offset_x=0, offset_y=0):
+        self.__collect(False)
+        while len(self.free_slots) == 0:
+            self.__collect(True)
+        slot = self.free_slots.pop(0)
+        self.slots[slot][...] = data
+        self.pending[slot] = len(self.processes)
+        for tasks in self.tasks:
+            tasks.put((slot, offset_x, offset_y))
+
+    # Waits for all frames to be added, stops integrating processes and returns mean of frames covering each pixel
+    # (0 where no frame does) as float64 or in given out array. Raises exception if any process failed,
+    # as its tiles are incomplete.
+    def mean(self, out=None):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        failed = any(process.exitcode != 0 for process in self.processes)
+        self.processes = []
+        if failed:
+            raise Exception('Integrating process failed.')
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float64)
+        for y0, y1, tile_sum, tile_coverage in self.tiles:
+            Accumulator(tile_sum.shape, tile_sum.dtype, y0, (tile_sum, tile_coverage)).mean(out[y0:y1])
+        return out
+
+    # Stops integrating processes and releases shared memory.
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+        # arrays must not outlive memory of blocks
+        self.tiles = []
+        self.slots = []
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
@@ -0,0 +1,146 @@
+import logging
+import os
+import threading
+import numpy as np
+from astrostacker.img.accumulate import overlap
+from astrostacker.img.calibrate import load_calibration
+from astrostacker.img.frames import read_frame
+from astrostacker.img.register import Registration
+from astrostacker.img.stack import prepare, register, shift_offset
+
+logger = logging.getLogger()
+
+# extensions of files picked up from watched directory
+FITS_EXTENSIONS = ('.fit', '.fits')
+
+
+# Running stack of frames registered against fixed reference frame.
+# Mean and variance are updated with Welford's method, so adding a frame costs the same
+# regardless of how many frames are already stacked.
+# Frames are added at their offsets through overlapping slices (see astrostacker.img.accumulate.Accumulator)
+# and each pixel is updated with number of frames covering it, so edges uncovered by drifting frames
+# are neither darkened nor add variance.
+# Frames are added by live stacking thread while GUI reads result, so the stack is updated under lock
+# and result and variance are copies.
+class LiveStack:
+    def __init__(self, ref_frame):
+        self.registration = Registration(ref_frame)
+        self.lock = threading.Lock()
+        self.n = 1
+        self.mean = ref_frame.astype(np.float64)
+        # sum of squared differences from the mean
+        self.m2 = np.zeros(ref_frame.shape, dtype=np.float64)
+        # number of frames covering each pixel
+        self.coverage = np.ones(ref_frame.shape[:2], dtype=np.uint32)
+
+    # Registers prepared frame and adds it to the stack.
+    def add(self, data):
+        data, _, translation_x, translation_y, _ = register(data, self.registration, resample=None)
+        offset_x, offset_y = shift_offset(translation_x, translation_y)
+        dst_y, src_y = overlap(self.mean.shape[0], offset_y, data.shape[0])
+        dst_x, src_x = overlap(self.mean.shape[1], offset_x, data.shape[1])
+        data = data[src_y, src_x].astype(np.float64)
+        with self.lock:
+            self.n += 1
+            # views of covered pixels are updated in place
+            coverage = self.coverage[dst_y, dst_x]
+            coverage += 1
+            if data.ndim == 3:
+                coverage = coverage[:, :, np.newaxis]
+            mean = self.mean[dst_y, dst_x]
+            delta = data - mean
+            mean += delta / coverage
+            # m2 += delta * (data - new mean), computed in place on delta
+            delta *= data - mean
+            self.m2[dst_y, dst_x] += delta
+
+    # Returns per pixel variance of stacked frames, 0 where less than 2 frames cover pixel.
+    def variance(self):
+        with self.lock:
+            coverage = self.coverage if self.m2.ndim == 2 else self.coverage[:, :, np.newaxis]
+            variance = np.zeros_like(self.m2)
+            np.divide(self.m2, coverage - 1.0, out=variance, where=coverage > 1)
+            return variance
+
+    # Returns current stack as uint16 array.
+    def result(self):
+        with self.lock:
+            return np.clip(self.mean, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+# Thread watching directory for new FITS files and stacking them as they appear.
+# Files already present are stacked first, the first of them is the reference frame.
+# File is picked up once its size stops changing between two checks done every interval seconds.
+# on_update(live_stack) is called from the thread after every stacked frame.
+# prepare_options are arguments of astrostacker.img.stack.prepare following data.
+# If calibration_files (bias, darks, flats) are given, calibration masters are built (or loaded from cache
+# in the directory) by the thread before watching and replace calibration of prepare_options.
+class LiveStacker(threading.Thread):
+    def __init__(self, directory, on_update=None, prepare_options=(), interval=1.0, calibration_files=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.directory = directory
+        self.on_update = on_update
+        self.prepare_options = prepare_options
+        self.calibration_files = calibration_files
+        self.interval = interval
+        self.live_stack = None
+        self.stopped = threading.Event()
+        # files already stacked or failed
+        self.done = set()
+        # sizes of files seen in last check
+        self.sizes = {}
+
+    # Stops watching after file being stacked.
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if self.calibration_files is not None:
+            try:
+                calibration = load_calibration(*self.calibration_files, cache_dir=self.directory)
+            except Exception as e:
+                logger.info(f'Live stacking not started, calibration failed: {e}')
+                return
+            self.prepare_options = (calibration,) + tuple(self.prepare_options[1:])
+        logger.info(f'Watching {self.directory:s}')
+        while not self.stopped.is_set():
+            for filepath in self.__ready_files():
+                if self.stopped.is_set():
+                    break
+                self.done.add(filepath)
+                self.__stack_file(filepath)
+            self.stopped.wait(self.interval)
+        logger.info('Live stacking stopped.')
+
+    # Returns sorted list of new files, whose size did not change since last check.
+    def __ready_files(self):
+        ready = []
+        sizes = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(FITS_EXTENSIONS):
+                    continue
+                if entry.path in self.done:
+                    continue
+                size = entry.stat().st_size
+                if self.sizes.get(entry.path) == size:
+                    ready.append(entry.path)
+                sizes[entry.path] = size
+        self.sizes = sizes
+        return sorted(ready)
+
+    def __stack_file(self, filepath):
+        filename = os.path.basename(filepath)
+        try:
+            data = prepare(read_frame(filepath), *self.prepare_options)
+            if self.live_stack is None:
+                self.live_stack = LiveStack(data)
+                logger.info(f'{filename:s} set as reference image.')
+            else:
+                self.live_stack.add(data)
+                logger.info(f'{filename:s} stacked, {self.live_stack.n:d} frames.')
+        except Exception as e:
+            logger.info(f'{filename:s} skipped: {e}')
+            return
+        if self.on_update is not None:
+            self.on_update(self.live_stack)
@@ -0,0 +1,76 @@
+import logging
+import math
+import time
+import numpy as np
+from astrostacker.img.accumulate import Accumulator
+from astrostacker.img.debayer import debayer
+from astrostacker.img.phase import PhaseCorrelation, luminance
+from astrostacker.img.ser import SerReader
+from astrostacker.logging.events import emit_progress
+
+logger = logging.getLogger()
+
+# default percentage of the sharpest frames which are stacked
+KEEP_PERCENT = 10
+# number of frames scored or aligned at once
+BATCH_SIZE = 16
+
+
+# Returns sharpness of each frame of block of luminance frames: variance of laplacian normalized by squared mean,
+# so it does not depend on brightness of frame.
+def sharpness(frames):
+    laplacian = 4 * frames[:, 1:-1, 1:-1] - frames[:, :-2, 1:-1] - frames[:, 2:, 1:-1] \
+        - frames[:, 1:-1, :-2] - frames[:, 1:-1, 2:]
+    mean = frames.mean(axis=(1, 2))
+    return laplacian.var(axis=(1, 2)) / np.maximum(mean * mean, 1e-12)
+
+
+# Returns sharpness of all frames of SER reader, computed in blocks of batch_size frames.
+def score_frames(reader, batch_size=BATCH_SIZE):
+    bayer = reader.bayer_mask is not None
+    scores = np.empty(len(reader), dtype=np.float64)
+    for start in range(0, len(reader), batch_size):
+        scores[start:start + batch_size] = sharpness(luminance(reader[start:start + batch_size], bayer))
+    return scores
+
+
+# Lucky imaging stack of SER video: frames are ranked by sharpness, keep_percent of the sharpest ones are aligned
+# to the sharpest frame by phase correlation (astrostacker.img.phase.PhaseCorrelation) of blocks of frames
+# and averaged (astrostacker.img.accumulate.Accumulator). Frames with too weak correlation peak are skipped.
+# Bayer frames are aligned on their luminance and moved by even number of pixels, so bayer pattern is kept,
+# then stack is debayered if debayer_result is set. Returns uint16 stack scaled to 16 bit range.
+def lucky_stack(filename, keep_percent=KEEP_PERCENT, debayer_result=True, batch_size=BATCH_SIZE):
+    with SerReader(filename) as reader:
+        if len(reader) == 0:
+            raise Exception('SER file has no frames.')
+        logger.info(f'Scoring {len(reader):d} frames of {filename:s}')
+        scores = score_frames(reader, batch_size)
+        keep = max(1, int(math.ceil(len(reader) * keep_percent / 100)))
+        best = np.argsort(scores)[::-1][:keep]
+        logger.info(f'{keep:d} sharpest frames kept, best frame: {int(best[0]):d}')
+        bayer = reader.bayer_mask is not None
+        step = 2 if bayer else 1
+        aligner = PhaseCorrelation(reader[int(best[0])], bayer=bayer, downsample=1)
+        accumulator = Accumulator(reader[0].shape, reader.data.dtype)
+        # frames are read in order of file
+        kept = np.sort(best)
+        skipped = 0
+        started = time.time()
+        for start in range(0, len(kept), batch_size):
+            frames = reader[kept[start:start + batch_size]]
+            translations, ratios = aligner.translations(frames)
+            for frame, (offset_x, offset_y), ratio in zip(frames, translations, ratios):
+                if ratio < aligner.min_peak_ratio:
+                    skipped += 1
+                    continue
+                accumulator.add(frame, int(round(offset_x / step)) * step, int(round(offset_y / step)) * step)
+            logger.info(f'{min(start + batch_size, len(kept)):d}/{len(kept):d} frames stacked.')
+            emit_progress(min(start + batch_size, len(kept)), len(kept), started)
+        if skipped > 0:
+            logger.info(f'{skipped:d} frames not aligned, skipped.')
+        result = accumulator.mean()
+        result *= np.iinfo(np.uint16).max / reader.max_value
+        result = np.clip(result, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+        if bayer and debayer_result:
+            result = debayer(result, reader.bayer_mask)
+        return result
@@ -0,0 +1,150 @@
+import numpy as np
+from skimage.transform import SimilarityTransform
+
+# registration method
+PHASE = 'phase'
+# default downsampling factor of coarse level
+DOWNSAMPLE = 4
+# default size of fine level window in pixels
+WINDOW = 1024
+# minimum ratio of correlation peak to standard deviation of correlation, weaker peaks are not trusted
+MIN_PEAK_RATIO = 8.0
+
+
+# Returns float32 luminance of block of frames (frame index in axis 0). Bayer frames are summed in 2x2 cells,
+# so luminance has half resolution and does not show bayer pattern.
+def luminance(frames, bayer=False):
+    frames = np.asarray(frames, dtype=np.float32)
+    if frames.ndim == 4:
+        frames = frames.mean(axis=3)
+    if bayer:
+        height = frames.shape[1] // 2 * 2
+        width = frames.shape[2] // 2 * 2
+        frames = frames[:, 0:height:2, 0:width:2] + frames[:, 1:height:2, 0:width:2] \
+            + frames[:, 0:height:2, 1:width:2] + frames[:, 1:height:2, 1:width:2]
+    return frames
+
+
+# Returns block of frames downsampled by factor (mean of factor x factor cells).
+def _downsample(frames, factor):
+    n, height, width = frames.shape
+    height = height // factor
+    width = width // factor
+    cells = frames[:, 0:height * factor, 0:width * factor].reshape(n, height, factor, width, factor)
+    return cells.mean(axis=(2, 4))
+
+
+# Returns sub-pixel position of peak from values at peak - 1, peak and peak + 1 (parabola through them).
+def _refine_peak(left, centre, right):
+    denominator = left - 2 * centre + right
+    return np.where(denominator < 0, 0.5 * (left - right) / np.where(denominator < 0, denominator, 1), 0)
+
+
+# Phase correlation of frames against one reference image of the same shape.
+# Spectrum of the windowed reference image is computed once.
+class _Correlator:
+    def __init__(self, ref):
+        height, width = ref.shape
+        self.shape = ref.shape
+        self.window = np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+        self.ref_spectrum = np.conj(np.fft.rfft2(self.__prepare(ref[np.newaxis]))[0])
+
+    # Removes mean and applies window, so edges of frames do not correlate.
+    def __prepare(self, frames):
+        return (frames - frames.mean(axis=(1, 2), keepdims=True)) * self.window
+
+    # Returns (x, y) sub-pixel displacements of frames of block against reference image and ratios
+    # of their correlation peaks to standard deviation of correlation.
+    # All frames of block are transformed by one batched FFT.
+    def correlate(self, frames):
+        spectrum = np.fft.rfft2(self.__prepare(frames)) * self.ref_spectrum
+        spectrum /= np.maximum(np.abs(spectrum), 1e-12)
+        correlation = np.fft.irfft2(spectrum, s=self.shape)
+        height, width = self.shape
+        n = len(frames)
+        flat = correlation.reshape(n, -1)
+        peak_y, peak_x = np.unravel_index(flat.argmax(axis=1), self.shape)
+        frames_idx = np.arange(0, n)
+        centre = correlation[frames_idx, peak_y, peak_x]
+        dx = _refine_peak(correlation[frames_idx, peak_y, (peak_x - 1) % width], centre,
+                          correlation[frames_idx, peak_y, (peak_x + 1) % width])
+        dy = _refine_peak(correlation[frames_idx, (peak_y - 1) % height, peak_x], centre,
+                          correlation[frames_idx, (peak_y + 1) % height, peak_x])
+        # peaks in second half are negative displacements
+        displacement_x = np.where(peak_x > width // 2, peak_x - width, peak_x) + dx
+        displacement_y = np.where(peak_y > height // 2, peak_y - height, peak_y) + dy
+        ratios = (centre - flat.mean(axis=1)) / np.maximum(flat.std(axis=1), 1e-12)
+        return np.column_stack((displacement_x, displacement_y)), ratios
+
+
+# Registration of frames against fixed reference frame by phase correlation, for frames which differ
+# by translation only (guided short exposures, lunar and solar frames).
+# Frames larger than window are registered coarse to fine: whole frames downsampled by downsample factor
+# find displacement first, then window x window pixels crops in the centre, moved by that displacement,
+# refine it to sub-pixel precision. With downsample 1 whole frames are correlated at full resolution.
+# Bayer frames are correlated on their 2x2 luminance (see luminance).
+# Frames whose correlation peak is weaker than min_peak_ratio are registered by fallback registration
+# (astrostacker.img.register.Registration) if it is given.
+# Interface follows astrostacker.img.register.Registration: find_transform and stars of fallback registration.
+class PhaseCorrelation:
+    def __init__(self, ref_frame, fallback=None, bayer=False, downsample=DOWNSAMPLE, window=WINDOW,
+                 min_peak_ratio=MIN_PEAK_RATIO):
+        self.fallback = fallback
+        self.bayer = bayer
+        self.min_peak_ratio = min_peak_ratio
+        ref = luminance(np.asarray(ref_frame)[np.newaxis], bayer)[0]
+        self.shape = ref.shape
+        height, width = self.shape
+        if downsample > 1 and (height > window or width > window):
+            self.downsample = downsample
+            self.coarse = _Correlator(_downsample(ref[np.newaxis], downsample)[0])
+            window_height = min(window, height)
+            window_width = min(window, width)
+            self.window_origin = np.array(((width - window_width) // 2, (height - window_height) // 2))
+            self.window_shape = (window_height, window_width)
+            x0, y0 = self.window_origin
+            self.fine = _Correlator(ref[y0:y0 + window_height, x0:x0 + window_width])
+        else:
+            self.downsample = 1
+            self.coarse = None
+            self.fine = _Correlator(ref)
+
+    # Returns stars of fallback registration or None.
+    @property
+    def stars(self):
+        return None if self.fallback is None else self.fallback.stars
+
+    # Returns (x, y) sub-pixel translations moving frames of block (frame index in axis 0) onto reference frame
+    # and ratios of their correlation peaks to standard deviation of correlation.
+    def translations(self, frames):
+        frames = luminance(frames, self.bayer)
+        if self.coarse is None:
+            displacements, ratios = self.fine.correlate(frames)
+        else:
+            coarse, ratios = self.coarse.correlate(_downsample(frames, self.downsample))
+            coarse *= self.downsample
+            # crops of frames moved by coarse displacement, kept inside of frames
+            window_height, window_width = self.window_shape
+            limit = np.array((self.shape[1] - window_width, self.shape[0] - window_height))
+            origins = np.clip(self.window_origin + np.rint(coarse).astype(np.int64), 0, limit)
+            crops = np.stack([frame[y0:y0 + window_height, x0:x0 + window_width]
+                              for frame, (x0, y0) in zip(frames, origins)])
+            fine, fine_ratios = self.fine.correlate(crops)
+            displacements = origins - self.window_origin + fine
+            # crops without enough detail keep coarse displacement
+            weak = fine_ratios < self.min_peak_ratio
+            displacements[weak] = coarse[weak]
+        if self.bayer:
+            displacements *= 2
+        return -displacements, ratios
+
+    # Finds transformation of data onto the reference frame.
+    # Returns transformation and tuple of matching star positions in data and reference frame,
+    # which is None unless transformation was found by fallback registration.
+    def find_transform(self, data):
+        translations, ratios = self.translations(np.asarray(data)[np.newaxis])
+        if ratios[0] < self.min_peak_ratio:
+            if self.fallback is None:
+                raise ValueError('Correlation peak is too weak and there is no fallback registration.')
+            return self.fallback.find_transform(data)
+        return SimilarityTransform(translation=translations[0]), None
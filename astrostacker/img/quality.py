@@ -0,0 +1,103 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import sep
+from astrostacker.img.frames import read_frame
+from astrostacker.logging import events
+
+logger = logging.getLogger()
+
+# names of frame metrics
+STARS = 'stars'
+FWHM = 'fwhm'
+ECCENTRICITY = 'eccentricity'
+BACKGROUND = 'background'
+NOISE = 'noise'
+METRICS = (STARS, FWHM, ECCENTRICITY, BACKGROUND, NOISE)
+
+# detection threshold of stars, in background noise units
+DETECTION_SIGMA = 5
+# minimum number of connected pixels of star
+MIN_AREA = 5
+# conversion of gaussian sigma to FWHM
+SIGMA_TO_FWHM = 2.3548
+
+
+# Returns metrics of frame: number of detected stars, their median FWHM and eccentricity in pixels,
+# global background level and noise (background rms).
+def frame_metrics(data):
+    if data.ndim == 3:
+        data = np.mean(data, axis=2)
+    image = np.ascontiguousarray(data, dtype=np.float32)
+    background = sep.Background(image)
+    background.subfrom(image)
+    stars = sep.extract(image, DETECTION_SIGMA * background.globalrms, minarea=MIN_AREA)
+    metrics = {
+        STARS: len(stars),
+        FWHM: 0.0,
+        ECCENTRICITY: 0.0,
+        BACKGROUND: float(background.globalback),
+        NOISE: float(background.globalrms),
+    }
+    if len(stars) > 0:
+        a = stars['a']
+        b = stars['b']
+        metrics[FWHM] = float(np.median(SIGMA_TO_FWHM * np.sqrt((a * a + b * b) / 2)))
+        metrics[ECCENTRICITY] = float(np.median(np.sqrt(1 - (b * b) / np.maximum(a * a, 1e-12))))
+    return metrics
+
+
+# Returns metrics of frame read from file.
+def file_metrics(filepath):
+    return frame_metrics(read_frame(filepath))
+
+
+# Returns metrics of file and None, or zero metrics and error message if file cannot be read or measured
+# (e.g. too many objects for sep on crowded frame), so one bad file does not stop scoring of others.
+def _safe_file_metrics(filepath):
+    try:
+        return file_metrics(filepath), None
+    except Exception as e:
+        return {STARS: 0, FWHM: 0.0, ECCENTRICITY: 0.0, BACKGROUND: 0.0, NOISE: 0.0}, str(e)
+
+
+# Returns list of metrics of files in order of results, sending each of them with progress as events
+# (astrostacker.logging.events). Files which failed are logged, their zero metrics get score 0.
+def _collect(filenames, results):
+    started = time.time()
+    metrics = []
+    for filename, (result, error) in zip(filenames, results):
+        if error is not None:
+            logger.info(f'{filename:s} not scored: {error:s}')
+        metrics.append(result)
+        events.emit(events.METRICS, name=filename, metrics=result)
+        events.emit_progress(len(metrics), len(filenames), started)
+    return metrics
+
+
+# Returns list of metrics of files, computed by given number of processes.
+def score_files(filenames, workers=1):
+    if workers <= 1:
+        return _collect(filenames, map(_safe_file_metrics, filenames))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return _collect(filenames, executor.map(_safe_file_metrics, filenames))
+
+
+# Returns quality score of frame: more, sharper and rounder stars give higher score.
+# Frames with less than 3 stars cannot be registered and get 0.
+def quality_score(metrics):
+    if metrics[STARS] < 3 or metrics[FWHM] <= 0:
+        return 0.0
+    return metrics[STARS] / (metrics[FWHM] * (1 + metrics[ECCENTRICITY]))
+
+
+# Selects frames by their metrics. Frames scoring below given percentile of scores
+# and frames that cannot be registered are rejected.
+# Returns list of indices of kept frames and index of the best frame.
+def select_frames(metrics, reject_percentile=0):
+    scores = np.array([quality_score(m) for m in metrics])
+    threshold = np.percentile(scores, reject_percentile) if reject_percentile > 0 else 0
+    kept = [i for i in range(0, len(scores)) if scores[i] > 0 and scores[i] >= threshold]
+    best = int(np.argmax(scores))
+    return kept, best
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+# name of cache file created in session directory
+CACHE_FILENAME = '.astrostacker-registration.sqlite'
+# default maximum size of cached stars and transformations, in bytes
+MAX_SIZE = 64 * 1024 ** 2
+
+
+# Returns hash of frame content (shape, type and pixel values).
+def content_hash(data):
+    data = np.ascontiguousarray(data)
+    h = hashlib.sha1(f'{data.shape}{data.dtype.str}'.encode())
+    h.update(data.data)
+    return h.hexdigest()
+
+
+# Cache of stars detected in frames and transformations between frames and reference frames.
+# Frames are identified by content_hash. Data is kept in SQLite file in given directory.
+# When cached data exceeds max_size, least recently used entries are removed by evict.
+class RegistrationCache:
+    def __init__(self, directory, max_size=MAX_SIZE):
+        self.path = os.path.join(directory, CACHE_FILENAME)
+        self.max_size = max_size
+        # other processes may write to cache at the same time, so wait for them instead of failing
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS stars ('
+                                    'frame_hash TEXT PRIMARY KEY, stars BLOB, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS transforms ('
+                                    'frame_hash TEXT, ref_hash TEXT, matrix BLOB, size INTEGER, last_used REAL, '
+                                    'PRIMARY KEY (frame_hash, ref_hash))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Returns (x, y) positions of stars of frame or None if they are not cached.
+    def get_stars(self, frame_hash):
+        row = self.connection.execute('SELECT stars FROM stars WHERE frame_hash = ?', (frame_hash,)).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE stars SET last_used = ? WHERE frame_hash = ?', (time.time(), frame_hash))
+        return np.frombuffer(row[0], dtype=np.float64).reshape(-1, 2)
+
+    def put_stars(self, frame_hash, stars):
+        blob = np.ascontiguousarray(stars, dtype=np.float64).tobytes()
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO stars VALUES (?, ?, ?, ?)',
+                                    (frame_hash, blob, len(blob), time.time()))
+
+    # Returns 3x3 matrix of transformation from frame to reference frame or None if it is not cached.
+    def get_transform(self, frame_hash, ref_hash):
+        row = self.connection.execute('SELECT matrix FROM transforms WHERE frame_hash = ? AND ref_hash = ?',
+                                      (frame_hash, ref_hash)).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE transforms SET last_used = ? WHERE frame_hash = ? AND ref_hash = ?',
+                                    (time.time(), frame_hash, ref_hash))
+        return np.frombuffer(row[0], dtype=np.float64).reshape(3, 3)
+
+    def put_transform(self, frame_hash, ref_hash, matrix):
+        blob = np.ascontiguousarray(matrix, dtype=np.float64).tobytes()
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO transforms VALUES (?, ?, ?, ?, ?)',
+                                    (frame_hash, ref_hash, blob, len(blob), time.time()))
+
+    # Removes least recently used entries until cached data fits in max_size.
+    def evict(self):
+        entries = self.connection.execute(
+            'SELECT last_used, size, frame_hash, NULL FROM stars '
+            'UNION ALL SELECT last_used, size, frame_hash, ref_hash FROM transforms '
+            'ORDER BY last_used DESC').fetchall()
+        total = 0
+        with self.connection:
+            for last_used, size, frame_hash, ref_hash in entries:
+                total += size
+                if total <= self.max_size:
+                    continue
+                if ref_hash is None:
+                    self.connection.execute('DELETE FROM stars WHERE frame_hash = ?', (frame_hash,))
+                else:
+                    self.connection.execute('DELETE FROM transforms WHERE frame_hash = ? AND ref_hash = ?',
+                                            (frame_hash, ref_hash))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,86 @@
+import numpy as np
+import astroalign as aa
+from scipy.spatial import KDTree
+from skimage.transform import matrix_transform
+from astrostacker.img.phase import PhaseCorrelation, PHASE
+
+# registration method
+STARS = 'stars'
+
+
+# Registration of frames against fixed reference frame.
+# Stars of the reference frame, their asterism invariants and KD-tree of invariants are computed once,
+# then each frame only has its own stars detected and matched against them.
+# Matching follows astroalign.find_transform.
+# Already known stars of the reference frame can be given instead of detecting them again.
+class Registration:
+    def __init__(self, ref_frame, max_control_points=50, detection_sigma=5, min_area=5, stars=None):
+        self.max_control_points = max_control_points
+        self.detection_sigma = detection_sigma
+        self.min_area = min_area
+        if stars is None:
+            stars = self.find_stars(ref_frame)
+        self.stars = stars
+        if len(self.stars) < 3:
+            raise ValueError('Reference stars in reference frame are less than the minimum value (3).')
+        self.invariants, self.asterisms = aa._generate_invariants(self.stars)
+        self.invariant_tree = KDTree(self.invariants)
+
+    # Returns (x, y) positions of brightest stars in data.
+    def find_stars(self, data):
+        data = aa._bw(np.asarray(data))
+        stars = aa._find_sources(data, detection_sigma=self.detection_sigma, min_area=self.min_area)
+        return stars[:self.max_control_points]
+
+    # Finds transformation of data onto the reference frame.
+    # Returns transformation and tuple of matching star positions in data and reference frame.
+    def find_transform(self, data):
+        return self.match(self.find_stars(data))
+
+    # Finds transformation of stars onto stars of the reference frame.
+    def match(self, stars):
+        if len(stars) < 3:
+            raise ValueError('Stars in frame are less than the minimum value (3).')
+        invariants, asterisms = aa._generate_invariants(stars)
+        # r = 0.1 is the maximum search distance used by astroalign
+        matches_list = self.invariant_tree.query_ball_point(invariants, r=0.1)
+        matches = []
+        for t1, t2_list in zip(asterisms, matches_list):
+            for t2 in self.asterisms[t2_list]:
+                matches.append(list(zip(t1, t2)))
+        matches = np.array(matches)
+
+        model = aa._MatchTransform(stars, self.stars)
+        n_invariants = len(matches)
+        min_matches = max(1, min(10, int(n_invariants * aa.MIN_MATCHES_FRACTION)))
+        if (len(stars) == 3 or len(self.stars) == 3) and n_invariants == 1:
+            best_t = model.fit(matches)
+            inlier_idx = np.arange(n_invariants)
+        else:
+            best_t, inlier_idx = aa._ransac(matches, model, aa.PIXEL_TOL, min_matches)
+
+        # pairs of matching stars, for each star in frame the one with lowest reprojection error is kept
+        inliers = matches[inlier_idx].reshape(-1, 2)
+        best_pairs = {}
+        for s_i, t_i in set(tuple(pair) for pair in inliers):
+            error = np.linalg.norm(matrix_transform(stars[s_i], best_t.params) - self.stars[t_i])
+            if s_i not in best_pairs or error < best_pairs[s_i][1]:
+                best_pairs[s_i] = (t_i, error)
+        s = np.array(list(best_pairs.keys()))
+        t = np.array([t_i for t_i, _ in best_pairs.values()])
+        return best_t, (stars[s], self.stars[t])
+
+
+# Creates registration against ref_frame by given method: Registration for STARS, PhaseCorrelation
+# (astrostacker.img.phase) for PHASE, with Registration as fallback if the reference frame has enough stars.
+# Already known stars of the reference frame can be given.
+def create_registration(ref_frame, method=STARS, stars=None, bayer=False):
+    if method == STARS:
+        return Registration(ref_frame, stars=stars)
+    if method == PHASE:
+        try:
+            fallback = Registration(ref_frame, stars=stars)
+        except ValueError:
+            fallback = None
+        return PhaseCorrelation(ref_frame, fallback, bayer)
+    raise Exception(f'Unknown registration method: {method:s}')
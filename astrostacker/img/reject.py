@@ -0,0 +1,133 @@
+import tempfile
+import warnings
+import numpy as np
+from astrostacker.img.accumulate import overlap
+
+MEAN = 'mean'
+MEDIAN = 'median'
+KAPPA_SIGMA = 'kappa-sigma'
+WINSORIZED = 'winsorized'
+
+# default amount of memory used for combining cube, in bytes
+MEMORY_BUDGET = 512 * 1024 ** 2
+# number of bytes needed per combined value by each method: float32 copy of band and peak of temporaries
+# of its reduction (nan-aware functions copy band and make masks), measured by tracemalloc on bands with nan
+BYTES_PER_VALUE = {MEAN: 11, MEDIAN: 24, KAPPA_SIGMA: 14, WINSORIZED: 24}
+
+
+# Stack of frames kept in memory mapped scratch file.
+# Frame i is set with cube[i] = data.
+class ScratchCube:
+    def __init__(self, n, shape, dtype, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.data = np.memmap(self.file, dtype=dtype, mode='w+', shape=(n,) + tuple(shape))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __setitem__(self, idx, frame):
+        self.data[idx] = frame
+
+    # Sets frame idx to frame moved by offset_x, offset_y pixels (the same way as astrostacker.img.shift.shift)
+    # through overlapping slices, without shifted copy. Pixels not covered by moved frame are nan, so they are
+    # left out when combining, instead of skewing rejection with zeros. Cube must be float.
+    def put(self, idx, frame, offset_x=0, offset_y=0):
+        dst_y, src_y = overlap(self.data.shape[1], offset_y, frame.shape[0])
+        dst_x, src_x = overlap(self.data.shape[2], offset_x, frame.shape[1])
+        target = self.data[idx]
+        target[:dst_y.start] = np.nan
+        target[dst_y.stop:] = np.nan
+        target[dst_y, :dst_x.start] = np.nan
+        target[dst_y, dst_x.stop:] = np.nan
+        target[dst_y, dst_x] = frame[src_y, src_x]
+
+    # Combines frames using given rejection method.
+    def combine(self, method, kappa=3.0, iterations=5, memory_budget=MEMORY_BUDGET):
+        return combine(self.data, method, kappa, iterations, memory_budget)
+
+    # Removes scratch file.
+    def close(self):
+        if self.data is not None:
+            # dropping the only reference unmaps file before it is removed
+            self.data = None
+            self.file.close()
+
+
+# Combines cube of frames (frame index in axis 0) into single float32 frame.
+# Cube is processed in bands of rows, each band small enough to fit in memory_budget with temporaries of method.
+def combine(cube, method, kappa=3.0, iterations=5, memory_budget=MEMORY_BUDGET):
+    if method == MEDIAN:
+        reduce = _median
+    elif method == KAPPA_SIGMA:
+        reduce = _kappa_sigma
+    elif method == WINSORIZED:
+        reduce = _winsorized
+    elif method == MEAN:
+        reduce = _mean
+    else:
+        raise Exception('Not supported stacking method.')
+    n = cube.shape[0]
+    height = cube.shape[1]
+    row_size = int(np.prod(cube.shape[2:], dtype=np.int64))
+    rows = max(1, int(memory_budget // (n * row_size * BYTES_PER_VALUE[method])))
+    result = np.empty(cube.shape[1:], dtype=np.float32)
+    with warnings.catch_warnings():
+        # all-rejected pixels give nan with warning, they are set to 0
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for y in range(0, height, rows):
+            tile = np.array(cube[:, y:y + rows], dtype=np.float32)
+            result[y:y + rows] = reduce(tile, kappa, iterations)
+    np.nan_to_num(result, copy=False)
+    return result
+
+
+# Frames warped with sub-pixel interpolation have nan outside of their area, which is left out by all methods.
+# nan-aware functions are slower, so they are used only for tiles with nan.
+
+def _mean(tile, kappa, iterations):
+    if np.isnan(tile).any():
+        return np.nanmean(tile, axis=0)
+    return np.mean(tile, axis=0)
+
+
+def _median(tile, kappa, iterations):
+    if np.isnan(tile).any():
+        return np.nanmedian(tile, axis=0)
+    return np.median(tile, axis=0)
+
+
+# Iteratively rejects values further than kappa * sigma from mean and averages the rest.
+def _kappa_sigma(tile, kappa, iterations):
+    for _ in range(0, iterations):
+        mean = np.nanmean(tile, axis=0)
+        sigma = np.nanstd(tile, axis=0)
+        outliers = np.abs(tile - mean) > kappa * sigma
+        if not outliers.any():
+            break
+        tile[outliers] = np.nan
+    return np.nanmean(tile, axis=0)
+
+
+# Estimates sigma robustly from winsorized values (clipped to median +- 1.5 sigma until sigma converges),
+# then rejects values further than kappa * sigma from median and averages the rest.
+def _winsorized(tile, kappa, iterations):
+    if np.isnan(tile).any():
+        median = np.nanmedian(tile, axis=0)
+        std = np.nanstd
+    else:
+        median = np.median(tile, axis=0)
+        std = np.std
+    sigma = std(tile, axis=0)
+    winsorized = np.empty_like(tile)
+    for _ in range(0, iterations):
+        np.clip(tile, median - 1.5 * sigma, median + 1.5 * sigma, out=winsorized)
+        new_sigma = 1.134 * std(winsorized, axis=0)
+        converged = np.allclose(new_sigma, sigma, rtol=5e-4)
+        sigma = new_sigma
+        if converged:
+            break
+    tile[np.abs(tile - median) > kappa * sigma] = np.nan
+    return np.nanmean(tile, axis=0)
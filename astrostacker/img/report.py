@@ -0,0 +1,207 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import time
+import tracemalloc
+from astrostacker.logging.events import emit, PROGRESS, STAGE, METRICS
+
+logger = logging.getLogger()
+
+# stages of stacking timed by StackReport
+SCORE = 'score'
+READ = 'read'
+PREPARE = 'prepare'
+REGISTER = 'register'
+WARP = 'warp'
+ACCUMULATE = 'accumulate'
+COMBINE = 'combine'
+DEBAYER = 'debayer'
+WRITE = 'write'
+STAGES = (SCORE, READ, PREPARE, REGISTER, WARP, ACCUMULATE, COMBINE, DEBAYER, WRITE)
+
+# profilers which can be run during stacking
+CPROFILE = 'cprofile'
+TRACEMALLOC = 'tracemalloc'
+# number of functions or allocation sites kept in report from profiler
+PROFILE_TOP = 25
+
+
+# Returns peak resident set size of this process in bytes, or None where it cannot be found.
+def peak_rss():
+    if sys.platform == 'win32':
+        return _peak_working_set()
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Returns peak resident set size of finished child processes (workers) in bytes, or None where it cannot be found.
+def peak_children_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Returns peak working set of this process on Windows in bytes.
+def _peak_working_set():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+# Formats number of seconds as H:MM:SS.
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+# Timer of one stage, used as context manager by StackReport.time.
+class _StageTimer:
+    def __init__(self, report, stage, frame):
+        self.report = report
+        self.stage = stage
+        self.frame = frame
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        if self.frame is None:
+            emit(STAGE, stage=self.stage)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.report.add(self.stage, time.perf_counter() - self.started, self.frame)
+
+
+# Performance report of single stacking run.
+# Collects seconds spent in each stage (STAGES) in total and per frame, logs progress with ETA
+# after every stacked frame and records peak memory. Optionally runs CPROFILE or TRACEMALLOC profiler
+# between start and finish, whose top entries are added to report. cProfile profiles only the thread
+# which started it, tracemalloc traces the whole process, so runs profiled with it should not overlap.
+# Report is written as JSON by save.
+class StackReport:
+    def __init__(self, profile=None):
+        if profile not in (None, CPROFILE, TRACEMALLOC):
+            raise Exception('Not supported profiler.')
+        self.profile = profile
+        # seconds per stage in total and per frame (by filename)
+        self.stages = {}
+        self.frames = {}
+        self.total_frames = 0
+        self.done_frames = 0
+        self.started = None
+        self.finished = None
+        self.info = {}
+        self.profile_result = None
+        self.profiler = None
+        # peak memory of this process and of finished worker processes in bytes, recorded by finish
+        self.peak_rss = None
+        self.peak_children_rss = None
+
+    # Starts timing of run and profiler. Frames are counted from given number of already done ones.
+    def start(self, total_frames, done_frames=0):
+        self.total_frames = total_frames
+        self.done_frames = done_frames
+        self.started = time.time()
+        if self.profile == CPROFILE:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == TRACEMALLOC:
+            tracemalloc.start()
+
+    # Returns context manager timing stage, of given frame or whole run.
+    def time(self, stage, frame=None):
+        return _StageTimer(self, stage, frame)
+
+    # Adds seconds spent in stage, of given frame or whole run.
+    def add(self, stage, seconds, frame=None):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        if frame is not None:
+            timings = self.frames.setdefault(frame, {})
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    # Adds timings of frame measured elsewhere, e.g. in worker process.
+    def add_frame(self, frame, timings):
+        for stage, seconds in timings.items():
+            self.add(stage, seconds, frame)
+
+    # Marks frame as stacked, logs progress with estimated remaining time and sends it as PROGRESS event
+    # (astrostacker.logging.events).
+    def frame_done(self):
+        self.done_frames += 1
+        elapsed = time.time() - self.started
+        eta = elapsed / self.done_frames * (self.total_frames - self.done_frames)
+        emit(PROGRESS, done=self.done_frames, total=self.total_frames, elapsed=elapsed, eta=eta)
+        logger.info(f'Progress: {self.done_frames:d}/{self.total_frames:d} frames, '
+                    f'elapsed {format_duration(elapsed):s}, ETA {format_duration(eta):s}')
+
+    # Stops timing and profiler and records peak memory, which is sent with run time as METRICS event.
+    def finish(self):
+        self.finished = time.time()
+        self.peak_rss = peak_rss()
+        self.peak_children_rss = peak_children_rss()
+        if self.profile == CPROFILE and self.profiler is not None:
+            self.profiler.disable()
+            out = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=out)
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+            self.profile_result = out.getvalue()
+            self.profiler = None
+        elif self.profile == TRACEMALLOC and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.profile_result = {
+                'traced_peak': traced_peak,
+                'top': [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                        for stat in snapshot.statistics('lineno')[:PROFILE_TOP]],
+            }
+        emit(METRICS, name='run', metrics={'seconds': self.finished - self.started, 'frames': self.done_frames,
+                                           'peak_rss': self.peak_rss})
+        logger.info(f'Run took {format_duration(self.finished - self.started):s}: ' +
+                    ', '.join(f'{stage:s} {self.stages[stage]:.1f}s' for stage in STAGES if stage in self.stages))
+
+    # Returns report as dictionary which can be serialized to JSON.
+    def to_dict(self):
+        return {
+            'started': self.started,
+            'seconds': (self.finished or time.time()) - self.started if self.started is not None else 0.0,
+            'frames': self.total_frames,
+            'stacked_frames': self.done_frames,
+            'stages': self.stages,
+            'peak_rss': self.peak_rss,
+            'peak_children_rss': self.peak_children_rss,
+            'info': self.info,
+            'per_frame': self.frames,
+            'profile': self.profile,
+            'profile_result': self.profile_result,
+        }
+
+    # Writes report to JSON file.
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        logger.info(f'Performance report written to {filename:s}')
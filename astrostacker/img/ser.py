@@ -0,0 +1,100 @@
+import os
+import numpy as np
+from astrostacker.img.debayer import RGGB, GRBG, GBRG, BGGR
+
+# SER video file (https://free-astro.org/index.php/SER): 178 bytes header, frames one after another,
+# optional trailer with int64 timestamp of each frame.
+HEADER_SIZE = 178
+HEADER = np.dtype([
+    ('file_id', 'S14'),
+    ('lu_id', '<i4'),
+    ('color_id', '<i4'),
+    ('little_endian', '<i4'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('pixel_depth', '<i4'),
+    ('frame_count', '<i4'),
+    ('observer', 'S40'),
+    ('instrument', 'S40'),
+    ('telescope', 'S40'),
+    ('date_time', '<i8'),
+    ('date_time_utc', '<i8'),
+])
+
+# colour ids of header
+MONO = 0
+BAYER_MASKS = {8: RGGB, 9: GRBG, 10: GBRG, 11: BGGR}
+RGB = 100
+BGR = 101
+# Most capture software writes 16 bit little endian data with little_endian flag 0, contrary to the specification,
+# so the flag is read as big endian flag unless byte order is given explicitly.
+LITTLE_ENDIAN_FLAG = 0
+
+
+# Memory mapped SER video. Frames are read-only views of the mapped file (no copy), indexed as sequence:
+# ser[i] is (height, width) or (height, width, 3) RGB frame, ser[i:j] is block of frames.
+# Colour of BGR files is reversed in the view. 16 bit frames in byte order other than native are views with
+# that byte order, numpy converts them in arithmetic.
+class SerReader:
+    def __init__(self, filename, little_endian=None):
+        self.filename = filename
+        header = np.fromfile(filename, dtype=HEADER, count=1)
+        if len(header) == 0 or not header['file_id'][0].startswith(b'LUCAM-RECORDER'):
+            raise Exception('Not a SER file.')
+        header = header[0]
+        self.width = int(header['width'])
+        self.height = int(header['height'])
+        self.pixel_depth = int(header['pixel_depth'])
+        self.color_id = int(header['color_id'])
+        self.observer = header['observer'].decode(errors='replace').strip()
+        self.instrument = header['instrument'].decode(errors='replace').strip()
+        self.telescope = header['telescope'].decode(errors='replace').strip()
+        if little_endian is None:
+            little_endian = int(header['little_endian']) == LITTLE_ENDIAN_FLAG
+        if self.pixel_depth <= 8:
+            dtype = np.dtype(np.uint8)
+        else:
+            dtype = np.dtype('<u2' if little_endian else '>u2')
+        planes = 3 if self.color_id in (RGB, BGR) else 1
+        frame_shape = (self.height, self.width) + ((planes,) if planes > 1 else ())
+        frame_size = self.width * self.height * planes * dtype.itemsize
+        # frame count of header is wrong in files whose capture was interrupted
+        self.frame_count = min(int(header['frame_count']),
+                               (os.path.getsize(filename) - HEADER_SIZE) // max(1, frame_size))
+        self.data = np.memmap(filename, dtype=dtype, mode='r', offset=HEADER_SIZE,
+                              shape=(self.frame_count,) + frame_shape)
+        if self.color_id == BGR:
+            self.data = self.data[..., ::-1]
+        self.trailer_offset = HEADER_SIZE + self.frame_count * frame_size
+
+    # Returns bayer mask of astrostacker.img.debayer or None for mono and RGB files.
+    @property
+    def bayer_mask(self):
+        return BAYER_MASKS.get(self.color_id)
+
+    # Returns maximum value of pixels.
+    @property
+    def max_value(self):
+        return (1 << self.pixel_depth) - 1
+
+    # Returns int64 timestamps (100 ns units since year 1) of frames or None if file has no trailer.
+    def timestamps(self):
+        if os.path.getsize(self.filename) < self.trailer_offset + 8 * self.frame_count:
+            return None
+        return np.fromfile(self.filename, dtype='<i8', count=self.frame_count, offset=self.trailer_offset)
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, idx):
+        return self.data[idx]
+
+    # Closes memory map. Frames taken from reader must not be used after.
+    def close(self):
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
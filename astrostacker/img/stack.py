@@ -1,56 +1,343 @@
 import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from astropy.io import fits as pyfits
+from skimage.transform import SimilarityTransform
+from astrostacker.img.frames import read_frame, FrameReader
 from astrostacker.img.shift import shift
-from astrostacker.img.debayer import debayer
+from astrostacker.img.debayer import debayer, superpixel
 from astrostacker.img.debayer import RGGB
-import astroalign as aa
+from astrostacker.img.binning import bin_image
+from astrostacker.img.register import Registration, create_registration, STARS
+from astrostacker.img.regcache import RegistrationCache, content_hash, MAX_SIZE
+from astrostacker.img.reject import ScratchCube, MEAN, MEDIAN, KAPPA_SIGMA, WINSORIZED, MEMORY_BUDGET
+from astrostacker.img.accumulate import Accumulator
+from astrostacker.img.integrate import SharedIntegrator
+from astrostacker.img.drizzle import Drizzle, SCALE, PIXFRAC
+from astrostacker.img.warp import warp, SHIFT
+from astrostacker.img.quality import score_files, select_frames
+from astrostacker.img.report import StackReport, SCORE, READ, PREPARE, REGISTER, WARP, ACCUMULATE, COMBINE, DEBAYER
+from astrostacker.logging.events import get_channel
+from astrostacker.logging.loghandler import attach
 
 logger = logging.getLogger()
 
+# registration against reference frame of registering process, set by _init_worker
+_registration = None
+# registration cache of registering process and hash of reference frame, set by _init_worker
+_cache = None
+_ref_hash = None
+# frame preparation options of registering process (arguments of prepare), set by _init_worker
+_prepare_options = ()
+# resampling of registered frames in registering process (see register), set by _init_worker
+_resample = SHIFT
 
-def stack(filenames, debayer_result=False, mask=RGGB, ref_frame_idx=0):
+
+# Sets registration, frame preparation options and resampling of frames and opens registration cache
+# in newly started registering process. Its events and log messages are sent to channel
+# (astrostacker.logging.events.EventChannel) if it is given.
+def _init_worker(registration, cache_dir=None, ref_hash=None, prepare_options=(), resample=SHIFT, channel=None):
+    global _registration, _cache, _ref_hash, _prepare_options, _resample
+    if channel is not None:
+        attach(channel)
+    _registration = registration
+    _ref_hash = ref_hash
+    _prepare_options = prepare_options
+    _resample = resample
+    if cache_dir is not None:
+        _cache = RegistrationCache(cache_dir)
+
+
+# Prepares loaded frame for registration: calibration, superpixel debayering with given bayer mask and binning.
+def prepare(data, calibration=None, superpixel_mask=None, binning=1):
+    if calibration is not None:
+        data = calibration.apply(data)
+    if superpixel_mask is not None:
+        data = superpixel(data, superpixel_mask)
+    return bin_image(data, binning)
+
+
+# Finds transformation of data onto reference frame of registration.
+# If cache is given, cached transformation or stars of data are used when available and new ones are cached.
+def find_transform(data, registration, cache=None, ref_hash=None):
+    if cache is None:
+        return registration.find_transform(data)[0]
+    frame_hash = content_hash(data)
+    matrix = cache.get_transform(frame_hash, ref_hash)
+    if matrix is not None:
+        return SimilarityTransform(matrix=matrix)
+    if not isinstance(registration, Registration):
+        trans = registration.find_transform(data)[0]
+        cache.put_transform(frame_hash, ref_hash, trans.params)
+        return trans
+    stars = cache.get_stars(frame_hash)
+    if stars is None:
+        stars = registration.find_stars(data)
+        cache.put_stars(frame_hash, stars)
+    trans = registration.match(stars)[0]
+    cache.put_transform(frame_hash, ref_hash, trans.params)
+    return trans
+
+
+# Returns offset by which frame with given translation is shifted onto reference frame.
+# Translations of at most 1 pixel in both axes are ignored.
+def shift_offset(translation_x, translation_y):
+    if abs(translation_x) > 1 or abs(translation_y) > 1:
+        return translation_x, translation_y
+    return 0, 0
+
+
+# Registers data against reference frame of registration.
+# Returns registered data, rotation, translation and 3x3 matrix of full (sub-pixel) transformation.
+# Data is shifted by whole pixels with resample SHIFT or warped by full transformation with interpolation
+# of astrostacker.img.warp (float32 result with nan outside of data). With resample None data is returned
+# as it is, to be shifted by caller by shift_offset of translation.
+# If timings dictionary is given, seconds spent finding transformation and resampling are added to it.
+def register(data, registration, cache=None, ref_hash=None, timings=None, resample=SHIFT):
+    started = time.perf_counter()
+    trans = find_transform(data, registration, cache, ref_hash)
+    rotation = int(trans.rotation)
+    translation_x = int(trans.translation[0])
+    translation_y = int(trans.translation[1])
+    registered = time.perf_counter()
+    if resample == SHIFT:
+        data = shift(data, *shift_offset(translation_x, translation_y))
+    elif resample is not None:
+        data = warp(data, trans.params, resample)
+    if timings is not None:
+        timings[REGISTER] = registered - started
+        timings[WARP] = time.perf_counter() - registered
+    return data, rotation, translation_x, translation_y, trans.params
+
+
+# Prepares and registers loaded data, adding seconds spent in each stage to timings.
+def _prepare_and_register(data, registration, cache, ref_hash, prepare_options, resample, timings):
+    started = time.perf_counter()
+    data = prepare(data, *prepare_options)
+    timings[PREPARE] = time.perf_counter() - started
+    return register(data, registration, cache, ref_hash, timings, resample)
+
+
+# Loads, prepares and registers file using options set by _init_worker.
+# Returns result of register and seconds spent in each stage.
+def _load_and_register(filepath):
+    started = time.perf_counter()
+    data = read_frame(filepath)
+    timings = {READ: time.perf_counter() - started}
+    registered = _prepare_and_register(data, _registration, _cache, _ref_hash, _prepare_options, _resample,
+                                       timings)
+    return registered, timings
+
+
+# Loads and registers files in order, yielding (filepath, result of register, seconds spent in each stage).
+# Serially files are read ahead by FrameReader with given prefetch depth.
+# With more than one worker files are processed by process pool, at most 2 files per worker at a time.
+# If cache_dir is given, registration cache in that directory is used with ref_hash identifying reference frame.
+# Frames are prepared for registration with prepare_options (arguments of prepare following data).
+# Registered frames are resampled with resample (see register).
+def register_files(filepaths, registration, workers=1, prefetch=2, cache_dir=None, ref_hash=None,
+                   prepare_options=(), resample=SHIFT):
+    if workers <= 1:
+        cache = RegistrationCache(cache_dir) if cache_dir is not None else None
+        try:
+            with FrameReader(filepaths, prefetch) as reader:
+                for filepath, data in reader:
+                    timings = {READ: reader.read_seconds}
+                    registered = _prepare_and_register(data, registration, cache, ref_hash, prepare_options,
+                                                       resample, timings)
+                    yield filepath, registered, timings
+        finally:
+            if cache is not None:
+                cache.close()
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(registration, cache_dir, ref_hash, prepare_options,
+                                       resample, get_channel())) as executor:
+        pending = deque()
+        for filepath in filepaths:
+            pending.append((filepath, executor.submit(_load_and_register, filepath)))
+            if len(pending) >= 2 * workers:
+                filepath, future = pending.popleft()
+                yield (filepath, *future.result())
+        while len(pending) > 0:
+            filepath, future = pending.popleft()
+            yield (filepath, *future.result())
+
+
+# Stacks files registered against the reference frame.
+# Method MEAN sums frames in memory at their offsets (astrostacker.img.accumulate.Accumulator), without shifted
+# copies, and divides each pixel by number of frames covering it, so edges are not darkened. Other methods
+# of astrostacker.img.reject keep float32 frames in scratch file (in scratch_dir or system temporary directory),
+# with nan where frames do not cover the stack, and combine them using at most memory_budget bytes.
+# With integrators > 0 MEAN frames are added by that many processes, each owning tiles of the stack
+# in shared memory (astrostacker.img.integrate.SharedIntegrator), instead of in this process.
+# Frames are shifted by whole pixels with interpolation SHIFT or warped by their full sub-pixel transformation
+# (including rotation) with BILINEAR or LANCZOS interpolation of astrostacker.img.warp, in registering processes.
+# Bayer frames must be superpixel debayered to be interpolated.
+# If cache_dir is given, detected stars and transformations are cached there (up to cache_size bytes),
+# so stacking the same frames again skips registration.
+# With superpixel frames are debayered to colour superpixels with mask before registration and
+# with binning > 1 they are binned, which makes all further steps faster. Bayer frames must be superpixel
+# debayered to be binned.
+# If calibration (astrostacker.img.calibrate.Calibration) is given, frames are calibrated first, as they are read.
+# With drizzle frames are not shifted by whole pixels, but drizzled (astrostacker.img.drizzle.Drizzle) onto
+# drizzle_scale times finer grid with their full sub-pixel transformation and drops of pixfrac size.
+# Drizzle integrates with MEAN method only and colour frames must be superpixel debayered.
+# Frames are registered by registration method STARS (star matching, astrostacker.img.register.Registration)
+# or PHASE (phase correlation of translated frames, astrostacker.img.phase.PhaseCorrelation, falling back
+# to star matching where correlation peak is weak).
+# If reject_percentile is given, frames are scored first by astrostacker.img.quality, frames below that
+# percentile of scores are not stacked and the best one is used as reference frame instead of ref_frame_idx.
+# Time of each stage is collected in report (astrostacker.img.report.StackReport), which is started here
+# unless it was started by caller. Caller may time further stages (e.g. writing result) and must finish
+# the report. Without report, stack uses its own one, which only logs progress and timings.
+def stack(filenames, debayer_result=False, mask=RGGB, ref_frame_idx=0, workers=1, prefetch=2,
+          method=MEAN, kappa=3.0, memory_budget=MEMORY_BUDGET, scratch_dir=None,
+          cache_dir=None, cache_size=MAX_SIZE, superpixel=False, binning=1, calibration=None,
+          reject_percentile=None, report=None, drizzle=False, drizzle_scale=SCALE, pixfrac=PIXFRAC,
+          interpolation=SHIFT, integrators=0, registration_method=STARS):
+    if method not in (MEAN, MEDIAN, KAPPA_SIGMA, WINSORIZED):
+        raise Exception('Not supported stacking method.')
+    if drizzle and method != MEAN:
+        raise Exception('Drizzle integrates frames with mean method only.')
+    if drizzle and debayer_result and not superpixel:
+        raise Exception('Bayer frames can be drizzled only debayered to superpixels.')
+    if binning > 1 and debayer_result and not superpixel:
+        # binning 2x2 cells of bayer frame would sum pixels of different colours
+        raise Exception('Bayer frames can be binned only debayered to superpixels.')
+    if interpolation != SHIFT and debayer_result and not superpixel:
+        # interpolated pixels of bayer frame would mix neighbouring pixels of different colours
+        raise Exception('Bayer frames can be interpolated only debayered to superpixels.')
+    own_report = report is None
+    if own_report:
+        report = StackReport()
+    if report.started is None:
+        report.start(len(filenames))
+    if reject_percentile is not None:
+        logger.info(f'Scoring {len(filenames):d} files.')
+        with report.time(SCORE):
+            kept, best = select_frames(score_files(filenames, workers), reject_percentile)
+        if len(kept) == 0:
+            raise Exception('No frames with enough stars to stack.')
+        logger.info(f'{len(filenames) - len(kept):d} files rejected.')
+        ref_filename = filenames[best]
+        filenames = [filenames[i] for i in kept]
+        ref_frame_idx = filenames.index(ref_filename)
+        report.total_frames = len(filenames)
     logger.info(f'Stacking {len(filenames):d} files.')
     if ref_frame_idx >= len(filenames):
         ref_frame_idx = 0
     logger.info(f'Loading: {filenames[ref_frame_idx]:s}')
-    img = pyfits.open(filenames[ref_frame_idx])
-    result = img[0].data
-    ref_frame = result.astype(np.int)
-    img.close()
+    prepare_options = (calibration, mask if superpixel else None, binning)
+    # frames are bayer frames until they are debayered
+    bayer = debayer_result and not superpixel
+    with report.time(READ, filenames[ref_frame_idx]):
+        result = read_frame(filenames[ref_frame_idx])
+    with report.time(PREPARE, filenames[ref_frame_idx]):
+        result = prepare(result, *prepare_options)
     logger.info(f'{filenames[0]:s} loaded. Set as reference image.')
-    result = result.astype(np.int)
-    remaining_files = list(range(0, len(filenames)))
-    remaining_files.remove(ref_frame_idx)
-    for i in remaining_files:
-        filepath = filenames[i]
-        filename = filepath[filepath.rfind('\\')+1:]
-        logger.info(f'Loading {filename:s}')
-        img = pyfits.open(filepath)
-        data = img[0].data
-        img.close()
-        logger.info(f'{filename:s} loaded.')
-        logger.info(f'Registering {filename:s}')
-        trans = aa.find_transform(data, ref_frame)[0]
-        rotation = int(trans.rotation)
-        translation_x = int(trans.translation[0])
-        translation_y = int(trans.translation[1])
-        if rotation > 0:
-            logger.info(f'Rotate: {rotation}')
-
-        if abs(translation_x) > 1 or abs(translation_y > 1):
-            logger.info(f'Move X={translation_x}, Y={translation_y}')
-            data = shift(data, translation_x, translation_y)
-
-        logger.info(f'{filename:s} registered.')
-        registered_image = data
-        result += registered_image.astype(np.int)
-        logger.info(f'{filename:s} stacked.')
-    n = len(filenames)
-    result = result / n
-    result = result.astype(np.uint16)
-    if debayer_result:
+    ref_hash = None
+    with report.time(REGISTER, filenames[ref_frame_idx]):
+        if cache_dir is not None:
+            ref_hash = content_hash(result)
+            with RegistrationCache(cache_dir, cache_size) as cache:
+                ref_stars = cache.get_stars(ref_hash)
+                registration = create_registration(result, registration_method, ref_stars, bayer)
+                if registration.stars is not None:
+                    cache.put_stars(ref_hash, registration.stars)
+            if registration_method != STARS:
+                # transformations found by other methods are cached apart from star matching ones
+                ref_hash = f'{ref_hash:s}-{registration_method:s}'
+        else:
+            registration = create_registration(result, registration_method, bayer=bayer)
+    if registration.stars is not None:
+        logger.info(f'{len(registration.stars):d} reference stars found.')
+    # shared memory and processes of integrator and scratch file of cube are released also when stacking fails
+    integrator = None
+    cube = None
+    try:
+        if drizzle:
+            accumulator = Drizzle(result.shape, drizzle_scale, pixfrac)
+            accumulator.add(result)
+            result = None
+        elif method == MEAN:
+            # calibrated and warped frames are float and are summed without truncation
+            frame_type = result.dtype if interpolation == SHIFT else np.float32
+            if integrators > 0:
+                logger.info(f'Integrating with {integrators:d} processes.')
+                integrator = SharedIntegrator(result.shape, frame_type, len(filenames), integrators)
+                accumulator = integrator
+            else:
+                accumulator = Accumulator(result.shape, frame_type)
+            accumulator.add(result)
+            result = None
+        else:
+            # warped and shifted frames have nan outside of their area
+            cube = ScratchCube(len(filenames), result.shape, np.float32, scratch_dir)
+            cube[0] = result
+        report.frame_done()
+        remaining_files = list(range(0, len(filenames)))
+        remaining_files.remove(ref_frame_idx)
+        if workers > 1:
+            logger.info(f'Registering with {workers:d} processes.')
+        filepaths = [filenames[i] for i in remaining_files]
+        if drizzle or interpolation == SHIFT:
+            # drizzle, accumulator and cube take frames as they are with their transformation or offset
+            resample = None
+        else:
+            resample = interpolation
+        registered_files = register_files(filepaths, registration, workers, prefetch, cache_dir, ref_hash,
+                                          prepare_options, resample)
+        for i, (filepath, registered, timings) in enumerate(registered_files, 1):
+            report.add_frame(filepath, timings)
+            filename = filepath[filepath.rfind('\\')+1:]
+            registered_image, rotation, translation_x, translation_y, matrix = registered
+            if rotation > 0:
+                logger.info(f'Rotate: {rotation}')
+            offset_x, offset_y = shift_offset(translation_x, translation_y)
+            if offset_x != 0 or offset_y != 0:
+                logger.info(f'Move X={translation_x}, Y={translation_y}')
+            logger.info(f'{filename:s} registered.')
+            with report.time(ACCUMULATE, filepath):
+                if drizzle:
+                    accumulator.add(registered_image, matrix)
+                elif cube is None and resample is None:
+                    accumulator.add(registered_image, offset_x, offset_y)
+                elif cube is None:
+                    accumulator.add(registered_image)
+                elif resample is None:
+                    cube.put(i, registered_image, offset_x, offset_y)
+                else:
+                    cube[i] = registered_image
+            logger.info(f'{filename:s} stacked.')
+            report.frame_done()
+        if cache_dir is not None:
+            with RegistrationCache(cache_dir, cache_size) as cache:
+                cache.evict()
+        if drizzle:
+            result = accumulator.result()
+        elif cube is None:
+            result = accumulator.mean()
+        else:
+            logger.info(f'Combining stack with {method:s} method.')
+            with report.time(COMBINE):
+                result = cube.combine(method, kappa, memory_budget=memory_budget)
+    finally:
+        if integrator is not None:
+            integrator.close()
+        if cube is not None:
+            cube.close()
+    result = np.clip(result, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    if debayer_result and not superpixel:
         logger.info('Debayering stack.')
-        result = debayer(result, mask)
+        with report.time(DEBAYER):
+            result = debayer(result, mask)
         logger.info('Stack debayered.')
+    report.info.update({'method': method, 'workers': workers, 'shape': list(result.shape),
+                        'superpixel': superpixel, 'binning': binning, 'calibrated': calibration is not None,
+                        'drizzle': drizzle_scale if drizzle else None, 'interpolation': interpolation,
+                        'integrators': integrators, 'registration': registration_method})
+    if own_report:
+        report.finish()
     return result
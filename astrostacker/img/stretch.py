@@ -0,0 +1,92 @@
+import numpy as np
+
+LINEAR = 'linear'
+ASINH = 'asinh'
+STF = 'stf'
+
+# approximate number of pixels sampled for estimating levels
+SAMPLE_SIZE = 1 << 18
+# black point distance below median, in normalized MAD units
+SHADOWS_CLIP = -2.8
+# fraction of white point above which pixels are clipped
+HIGHLIGHTS_QUANTILE = 0.9999
+# brightness of background (median) after stretch
+TARGET_BACKGROUND = 0.25
+
+MAX_UINT16 = np.iinfo(np.uint16).max
+
+
+# Midtones transfer function with midtones balance m.
+def mtf(m, x):
+    return (m - 1) * x / ((2 * m - 1) * x - m)
+
+
+# Estimates black point, white point and midtones (median normalized to black and white points)
+# of uint16 data from histogram of its regularly subsampled pixels.
+def estimate_levels(data):
+    step = max(1, int(np.sqrt(data.size / SAMPLE_SIZE)))
+    histogram = np.bincount(data[::step, ::step].ravel(), minlength=MAX_UINT16 + 1)
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    median = int(np.searchsorted(cumulative, total / 2))
+    # median absolute deviation from histogram of deviations
+    values = np.arange(0, len(histogram))
+    deviation_histogram = np.bincount(np.abs(values - median), weights=histogram)
+    mad = int(np.searchsorted(np.cumsum(deviation_histogram), total / 2))
+    black = max(int(np.searchsorted(cumulative, 1)), int(median + SHADOWS_CLIP * 1.4826 * mad))
+    white = int(np.searchsorted(cumulative, total * HIGHLIGHTS_QUANTILE))
+    white = max(white, black + 1)
+    midtones = min(max((median - black) / (white - black), 0.0), 1.0)
+    return black, white, midtones
+
+
+# Returns 65536 entries uint8 lookup table stretching uint16 values with given levels.
+# LINEAR maps black to white point linearly, ASINH and STF additionally brighten background (midtones)
+# to TARGET_BACKGROUND with asinh or midtones transfer function.
+def make_lut(black, white, midtones, mode=STF):
+    x = np.arange(0, MAX_UINT16 + 1, dtype=np.float64)
+    x = np.clip((x - black) / (white - black), 0, 1)
+    if mode == STF and 0 < midtones < 1:
+        x = mtf(mtf(TARGET_BACKGROUND, midtones), x)
+    elif mode == ASINH and 0 < midtones < TARGET_BACKGROUND:
+        beta = _asinh_beta(midtones)
+        x = np.arcsinh(beta * x) / np.arcsinh(beta)
+    elif mode not in (LINEAR, STF, ASINH):
+        raise Exception('Not supported stretch mode.')
+    return np.round(x * 255).astype(np.uint8)
+
+
+# Finds by bisection stretch factor of asinh, which maps midtones to TARGET_BACKGROUND.
+def _asinh_beta(midtones):
+    low = 1e-3
+    high = 1e6
+    for _ in range(0, 60):
+        beta = np.sqrt(low * high)
+        if np.arcsinh(beta * midtones) / np.arcsinh(beta) < TARGET_BACKGROUND:
+            low = beta
+        else:
+            high = beta
+    return beta
+
+
+# Stretches mono or colour data to uint8 for display. Colour channels are stretched separately.
+# uint16 (or smaller unsigned) data is stretched by single lookup in table, other data is first
+# scaled to uint16 range as float32, so signed data does not overflow. Nan pixels are left out of the range
+# and shown black.
+def stretch(data, mode=STF):
+    if data.dtype.kind != 'u' or data.dtype.itemsize > 2:
+        data = data.astype(np.float32)
+        low = np.nanmin(data)
+        high = np.nanmax(data)
+        if np.isnan(low):
+            low = high = 0
+        data -= low
+        data *= MAX_UINT16 / max(high - low, 1)
+        data = np.nan_to_num(data, copy=False, nan=0).astype(np.uint16)
+    if data.ndim == 2:
+        return make_lut(*estimate_levels(data), mode)[data]
+    result = np.empty(data.shape, dtype=np.uint8)
+    for c in range(0, data.shape[2]):
+        channel = data[:, :, c]
+        result[:, :, c] = make_lut(*estimate_levels(channel), mode)[channel]
+    return result
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import numpy as np
+
+# resampling of registered frames: whole pixel shift, bilinear or lanczos interpolation
+SHIFT = 'shift'
+BILINEAR = 'bilinear'
+LANCZOS = 'lanczos'
+# radius of lanczos kernel in pixels
+LANCZOS_RADIUS = 3
+# padding of source frame by its edge pixels, so taps of all interpolations stay inside
+PADDING = LANCZOS_RADIUS
+# number of output rows warped at once
+TILE_ROWS = 128
+# maximum size of cached coordinate maps of one process in bytes
+MAP_CACHE_SIZE = 256 * 1024 ** 2
+# transformation matrices are rounded to this number of decimals, so equal transformations share maps
+MATRIX_DECIMALS = 9
+
+
+# Coordinate map of band of output rows: mask of output pixels inside source frame, flat index of the first
+# interpolation tap of each output pixel in source frame padded by PADDING pixels and weights of taps along
+# rows and columns (tap index in axis 0).
+class TileMap:
+    def __init__(self, valid, index, row_weights, column_weights):
+        self.valid = valid
+        self.index = index
+        self.row_weights = row_weights
+        self.column_weights = column_weights
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.valid, self.index, self.row_weights, self.column_weights))
+
+
+# Returns number of taps of interpolation along each axis.
+def _tap_count(interpolation):
+    if interpolation == BILINEAR:
+        return 2
+    if interpolation == LANCZOS:
+        return 2 * LANCZOS_RADIUS
+    raise Exception('Not supported interpolation.')
+
+
+# Returns position of the first tap and float32 weights of interpolation taps of source coordinates.
+# Lanczos weights are normalized to sum 1.
+def _taps(coordinates, interpolation):
+    if interpolation == BILINEAR:
+        first = np.floor(coordinates)
+        fraction = (coordinates - first).astype(np.float32)
+        return first.astype(np.int64), np.stack((1 - fraction, fraction))
+    floor = np.floor(coordinates)
+    fraction = (coordinates - floor).astype(np.float32)
+    # sin(pi * x) of distance x = fraction + n from any tap differs only in sign, so it is computed once
+    sin_fraction = np.sin(np.pi * fraction)
+    weights = np.empty((_tap_count(interpolation),) + coordinates.shape, dtype=np.float32)
+    for k in range(0, len(weights)):
+        n = LANCZOS_RADIUS - 1 - k
+        x = fraction + n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = (-1) ** n * LANCZOS_RADIUS * sin_fraction * np.sin(np.pi / LANCZOS_RADIUS * x) / (np.pi * x) ** 2
+        weights[k] = np.where(x == 0, 1, weight)
+    weights /= weights.sum(axis=0)
+    return (floor - LANCZOS_RADIUS + 1).astype(np.int64), weights
+
+
+# Computes coordinate map of output rows y0..y1 of frame of given shape (height, width), warped
+# with inverse matrix (mapping output pixel coordinates to source pixel coordinates).
+# Indices point to source frame padded by PADDING pixels on each side, so taps of pixels at edges need no clipping.
+def tile_map(inverse, shape, y0, y1, interpolation):
+    height, width = shape
+    ys, xs = np.mgrid[y0:y1, 0:width]
+    source_x = inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]
+    source_y = inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]
+    del xs, ys
+    valid = (source_x >= 0) & (source_x <= width - 1) & (source_y >= 0) & (source_y <= height - 1)
+    # coordinates of pixels outside frame are moved to its edge, their values are masked anyway
+    np.clip(source_x, 0, width - 1, out=source_x)
+    np.clip(source_y, 0, height - 1, out=source_y)
+    first_x, column_weights = _taps(source_x, interpolation)
+    first_y, row_weights = _taps(source_y, interpolation)
+    index = (first_y + PADDING) * (width + 2 * PADDING) + first_x + PADDING
+    index_type = np.int32 if (height + 2 * PADDING) * (width + 2 * PADDING) < 2 ** 31 else np.int64
+    return TileMap(valid, index.astype(index_type), row_weights, column_weights)
+
+
+# Least recently used cache of coordinate maps of whole frames, by shape, interpolation and transformation.
+# Maps larger than the whole cache are not kept.
+class CoordinateMapCache:
+    def __init__(self, max_size=MAP_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.maps = OrderedDict()
+
+    # Returns list of TileMap of frame or None if it is not cached.
+    def get(self, key):
+        tile_maps = self.maps.get(key)
+        if tile_maps is not None:
+            self.maps.move_to_end(key)
+        return tile_maps
+
+    def put(self, key, tile_maps):
+        size = sum(m.nbytes() for m in tile_maps)
+        if size > self.max_size or key in self.maps:
+            return
+        self.maps[key] = tile_maps
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.maps.popitem(last=False)
+            self.size -= sum(m.nbytes() for m in evicted)
+
+
+# coordinate maps of this process
+_map_cache = CoordinateMapCache()
+
+
+# Yields (y0, y1, TileMap) of bands of output rows of frame of given shape warped with matrix.
+# Maps of the whole frame are cached and reused for equal transformation when they fit in cache.
+def _tile_maps(matrix, shape, interpolation, tile_rows):
+    matrix = np.round(np.asarray(matrix, dtype=np.float64), MATRIX_DECIMALS)
+    key = (tuple(shape), interpolation, tile_rows, matrix.tobytes())
+    bands = [(y0, min(shape[0], y0 + tile_rows)) for y0 in range(0, shape[0], tile_rows)]
+    tile_maps = _map_cache.get(key)
+    if tile_maps is not None:
+        for (y0, y1), tile in zip(bands, tile_maps):
+            yield y0, y1, tile
+        return
+    inverse = np.linalg.inv(matrix)
+    tile_maps = []
+    for y0, y1 in bands:
+        tile = tile_map(inverse, shape, y0, y1, interpolation)
+        if tile_maps is not None:
+            tile_maps.append(tile)
+            if sum(m.nbytes() for m in tile_maps) > _map_cache.max_size:
+                tile_maps = None
+        yield y0, y1, tile
+    if tile_maps is not None:
+        _map_cache.put(key, tile_maps)
+
+
+# Warps data with 3x3 matrix of transformation onto reference frame ((x, y) coordinates, e.g. params of
+# skimage transformation), resampling it with BILINEAR or LANCZOS interpolation.
+# Output is computed in bands of tile_rows rows. Returns float32 array of the same shape as data,
+# with nan in pixels mapped from outside of data. Works for mono and colour (height, width, channels) frames.
+def warp(data, matrix, interpolation=BILINEAR, tile_rows=TILE_ROWS):
+    shape = data.shape[:2]
+    result = np.empty(data.shape, dtype=np.float32)
+    channels = [data] if data.ndim == 2 else [data[:, :, c] for c in range(0, data.shape[2])]
+    flats = [np.pad(channel, PADDING, mode='edge').ravel() for channel in channels]
+    padded_width = shape[1] + 2 * PADDING
+    taps = _tap_count(interpolation)
+    for y0, y1, tile in _tile_maps(matrix, shape, interpolation, tile_rows):
+        for c, flat in enumerate(flats):
+            band = np.zeros((y1 - y0, shape[1]), dtype=np.float32)
+            for j in range(0, taps):
+                line = np.zeros((y1 - y0, shape[1]), dtype=np.float32)
+                for i in range(0, taps):
+                    line += tile.column_weights[i] * np.take(flat, tile.index + (j * padded_width + i))
+                band += tile.row_weights[j] * line
+            band[~tile.valid] = np.nan
+            if data.ndim == 2:
+                result[y0:y1] = band
+            else:
+                result[y0:y1, :, c] = band
+    return result
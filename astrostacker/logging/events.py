@@ -0,0 +1,63 @@
+import multiprocessing
+import queue
+import time
+
+# types of events
+LOG = 'log'
+PROGRESS = 'progress'
+STAGE = 'stage'
+METRICS = 'metrics'
+
+# channel events of this process are sent to, set by set_channel
+_channel = None
+
+
+# Channel of events from threads and processes to GUI. Event is dictionary with type (LOG, PROGRESS, STAGE
+# or METRICS) and its fields, which must be picklable:
+# LOG: message, level
+# PROGRESS: done, total, elapsed and eta (seconds)
+# STAGE: stage (astrostacker.img.report) which started
+# METRICS: name of frame or run and its metrics
+# Events are put to multiprocessing queue, so worker processes which get the channel when they start
+# (e.g. as argument of pool initializer) send events to the same receiver.
+class EventChannel:
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+
+    def put(self, event):
+        self.queue.put(event)
+
+    # Returns waiting events, at most max_events of them, without waiting for more.
+    def drain(self, max_events):
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(self.queue.get(block=False))
+            except queue.Empty:
+                break
+        return events
+
+
+# Sets channel events of this process are sent to, None stops sending them.
+def set_channel(channel):
+    global _channel
+    _channel = channel
+
+
+# Returns channel events of this process are sent to or None.
+def get_channel():
+    return _channel
+
+
+# Sends event of given type with given fields, if this process has channel.
+def emit(event_type, **fields):
+    if _channel is not None:
+        fields['type'] = event_type
+        _channel.put(fields)
+
+
+# Sends PROGRESS event of done of total items of work started at given time (time.time()).
+def emit_progress(done, total, started):
+    elapsed = time.time() - started
+    eta = elapsed / done * (total - done) if done > 0 else 0.0
+    emit(PROGRESS, done=done, total=total, elapsed=elapsed, eta=eta)
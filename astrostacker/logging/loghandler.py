@@ -1,11 +1,30 @@
 import logging
+from astrostacker.logging.events import LOG, set_channel
 
+# format of log messages sent as events
+LOG_FORMAT = '%(asctime)s: %(message)s'
 
-# Implementation of logging.Handler for queuing messages
+
+# Implementation of logging.Handler sending formatted messages as LOG events
+# to astrostacker.logging.events.EventChannel
 class LogHandler(logging.Handler):
-    def __init__(self, log_queue):
+    def __init__(self, channel):
         super().__init__()
-        self.log_queue = log_queue
+        self.channel = channel
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
 
     def emit(self, record):
-        self.log_queue.put(record)
+        try:
+            self.channel.put({'type': LOG, 'message': self.format(record), 'level': record.levelno})
+        except Exception:
+            self.handleError(record)
+
+
+# Sends events and log messages of given level of this process to channel. Called in GUI process
+# and in worker processes it starts, which keep their handler inherited from GUI process if they have it.
+def attach(channel, level=logging.INFO):
+    set_channel(channel)
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not any(isinstance(handler, LogHandler) for handler in root.handlers):
+        root.addHandler(LogHandler(channel))
@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from skimage.transform import SimilarityTransform
+from astrostacker.img.debayer import debayer, RGGB, BGGR, GBRG, GRBG
+from astrostacker.img.frames import read_frame
+from astrostacker.img.shift import shift
+from astrostacker.img.scale import lingray
+from astrostacker.img.stretch import stretch, LINEAR, ASINH, STF
+from astrostacker.img.register import Registration
+from astrostacker.img.stack import stack
+from benchmarks.synthetic import SIZES, star_field, make_frame, make_frames, registration_error
+
+# Benchmarks of astrostacker on synthetic star fields (benchmarks.synthetic).
+# Run from repository root:
+#     python -m benchmarks.run [--sizes small,medium] [--frames 5,10] [--repeat 3] [--output results.json]
+#                              [--baseline benchmarks/baseline.json] [--tolerance 0.25] [--save-baseline]
+# Every case records wall time (best of repeats), peak memory allocated during the case (tracemalloc,
+# numpy arrays included) and, for registration, RMS error against known transformations in pixels.
+# With --baseline results are compared with stored ones and the run fails if any case is slower or uses more
+# memory by more than tolerance or registers worse by more than ERROR_TOLERANCE pixels.
+# Baseline is machine specific, --save-baseline stores results of the run as new baseline.
+# Run also fails if any correctness check of edge case data (check_correctness) fails.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_SIZES = 'small,medium'
+DEFAULT_FRAMES = '5,10'
+# allowed increase of registration error in pixels before it is a regression
+ERROR_TOLERANCE = 0.05
+# differences of time below this number of seconds are timer noise, not regressions
+MIN_TIME_DIFFERENCE = 0.005
+MASKS = (RGGB, BGGR, GBRG, GRBG)
+
+
+# Runs fn repeat times and returns best wall time in seconds and peak memory in bytes of separate traced run.
+def measure(fn, repeat):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = None
+    for _ in range(0, repeat):
+        started = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return {'seconds': best, 'peak_memory': peak}
+
+
+# Yields (name, result) of benchmark cases of single frame operations for sensor size.
+def frame_cases(size, repeat):
+    shape = SIZES[size]
+    field = star_field(shape)
+    transform = SimilarityTransform()
+    mono = make_frame(shape, field, transform)
+    for mask in MASKS:
+        cfa = make_frame(shape, field, transform, mask)
+        yield f'debayer/{mask:s}/{size:s}', measure(lambda: debayer(cfa, mask), repeat)
+    yield f'shift/{size:s}', measure(lambda: shift(mono, 7, -5), repeat)
+    yield f'lingray/{size:s}', measure(lambda: lingray(mono), repeat)
+    for mode in (LINEAR, ASINH, STF):
+        yield f'stretch/{mode:s}/{size:s}', measure(lambda: stretch(mono, mode), repeat)
+
+
+# Yields (name, result) of benchmark cases of registration and stacking of n frames of sensor size,
+# written to directory.
+def stack_cases(size, n, repeat, directory):
+    shape = SIZES[size]
+    paths, transforms = make_frames(os.path.join(directory, f'{size:s}-{n:d}'), shape, n)
+    positions = star_field(shape)[0]
+    frames = [read_frame(path) for path in paths]
+
+    def register_all():
+        registration = Registration(frames[0])
+        return [registration.find_transform(frame)[0] for frame in frames[1:]]
+
+    result = measure(register_all, repeat)
+    errors = [registration_error(found, true, positions) for found, true in zip(register_all(), transforms[1:])]
+    result['error'] = max(errors)
+    yield f'register/{size:s}/{n:d}', result
+    yield f'stack/{size:s}/{n:d}', measure(lambda: stack(paths), repeat)
+
+
+# Checks results of operations on edge case data. Returns list of descriptions of failed checks.
+def check_correctness():
+    failures = []
+    rng = np.random.default_rng(0)
+    # signed frames must not overflow when scaled for display
+    signed = rng.integers(-32768, 32768, (256, 256)).astype(np.int16)
+    correlation = np.corrcoef(signed.ravel(), stretch(signed, LINEAR).ravel())[0, 1]
+    if correlation < 0.99:
+        failures.append(f'stretch/int16: correlation with input {correlation:.2f}')
+    # single nan pixel must not turn float frame black
+    with_nan = rng.normal(1000, 50, (256, 256))
+    with_nan[0, 0] = np.nan
+    stretched = stretch(with_nan, LINEAR)
+    if stretched.max() == 0 or stretched[0, 0] != 0:
+        failures.append('stretch/nan: frame with nan pixel not stretched')
+    return failures
+
+
+# Compares results with baseline. Returns list of descriptions of regressions.
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            print(f'{name:32s} {result["seconds"]:9.4f}s {result["peak_memory"] / 1024 ** 2:9.1f}MB  (new)')
+            continue
+        time_ratio = result['seconds'] / max(base['seconds'], 1e-9)
+        memory_ratio = result['peak_memory'] / max(base['peak_memory'], 1)
+        flags = []
+        if time_ratio > 1 + tolerance and result['seconds'] - base['seconds'] > MIN_TIME_DIFFERENCE:
+            flags.append('slower')
+        if memory_ratio > 1 + tolerance:
+            flags.append('more memory')
+        if 'error' in result and result['error'] > base.get('error', result['error']) + ERROR_TOLERANCE:
+            flags.append('less accurate')
+        print(f'{name:32s} {result["seconds"]:9.4f}s x{time_ratio:5.2f} '
+              f'{result["peak_memory"] / 1024 ** 2:9.1f}MB x{memory_ratio:5.2f}  {", ".join(flags)}')
+        if flags:
+            regressions.append(f'{name:s}: {", ".join(flags)}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmarks.run', description='Benchmarks astrostacker on synthetic data.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'sensor sizes: {", ".join(SIZES):s}')
+    parser.add_argument('--frames', default=DEFAULT_FRAMES, help='numbers of stacked frames')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every case, the best one counts')
+    parser.add_argument('--output', help='JSON file for results')
+    parser.add_argument('--baseline', default=BASELINE, help='JSON file with baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative increase of time and memory')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as new baseline')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(',')
+    counts = [int(n) for n in args.frames.split(',')]
+    results = {
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                    'python': platform.python_version(), 'numpy': np.__version__, 'cpus': os.cpu_count()},
+        'options': {'sizes': sizes, 'frames': counts, 'repeat': args.repeat},
+        'cases': {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            cases = list(frame_cases(size, args.repeat))
+            for n in counts:
+                cases.extend(stack_cases(size, n, args.repeat, directory))
+            for name, result in cases:
+                results['cases'][name] = result
+                print(f'{name:32s} {result["seconds"]:9.4f}s {result["peak_memory"] / 1024 ** 2:9.1f}MB'
+                      + (f' error {result["error"]:.3f}px' if 'error' in result else ''))
+
+    failures = check_correctness()
+    for failure in failures:
+        print(f'FAILED {failure:s}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline written to {args.baseline:s}')
+        return 1 if failures else 0
+    if not os.path.exists(args.baseline):
+        return 1 if failures else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f'\nComparison with baseline {args.baseline:s}:')
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression:s}')
+    return 1 if regressions or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
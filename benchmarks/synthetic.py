@@ -0,0 +1,120 @@
+import os
+import numpy as np
+from astropy.io import fits as pyfits
+from skimage.transform import SimilarityTransform
+from astrostacker.img.debayer import RED_BLUE_POSITIONS
+
+# Synthetic star fields for benchmarks: stars with gaussian profile and known position, brightness and colour,
+# rendered on flat sky background with gaussian noise, optionally mosaicked to bayer pattern.
+
+# sensor sizes (height, width) used by benchmarks
+SIZES = {
+    'small': (480, 640),
+    'medium': (1080, 1920),
+    'large': (2822, 4144),
+}
+
+# number of stars per megapixel
+STAR_DENSITY = 150
+# sigma of star profile in pixels
+STAR_SIGMA = 1.5
+# half size of rendered star stamp in pixels
+STAMP_RADIUS = 8
+SKY_LEVEL = 800.0
+NOISE_SIGMA = 12.0
+# maximal translation in pixels and rotation in degrees of generated frames
+MAX_SHIFT = 12.0
+MAX_ROTATION = 0.5
+
+
+# Returns positions (x, y), fluxes and colours (r, g, b weights) of stars in field of given shape.
+def star_field(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    n = max(20, int(STAR_DENSITY * height * width / 1e6))
+    positions = np.column_stack((rng.uniform(0, width, n), rng.uniform(0, height, n)))
+    # few bright stars and many faint ones
+    fluxes = 2000 * rng.pareto(1.5, n) + 800
+    colours = rng.uniform(0.6, 1.4, (n, 3))
+    return positions, fluxes, colours
+
+
+# Returns random transformations of frames: the first one is identity, others are translated
+# by up to MAX_SHIFT pixels (sub-pixel) and rotated by up to MAX_ROTATION degrees around image centre.
+def frame_transforms(shape, n, rotation=True, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    centre = np.array([shape[1], shape[0]]) / 2
+    transforms = [SimilarityTransform()]
+    for _ in range(1, n):
+        angle = np.deg2rad(rng.uniform(-MAX_ROTATION, MAX_ROTATION)) if rotation else 0.0
+        offset = rng.uniform(-MAX_SHIFT, MAX_SHIFT, 2)
+        to_centre = SimilarityTransform(translation=-centre)
+        rotate = SimilarityTransform(rotation=angle, translation=centre + offset)
+        transforms.append(SimilarityTransform(matrix=rotate.params @ to_centre.params))
+    return transforms
+
+
+# Renders stars moved by transform to float64 image of given shape with channels (height, width, 3),
+# without sky and noise.
+def render_stars(shape, positions, fluxes, colours, transform):
+    height, width = shape
+    image = np.zeros((height, width, 3))
+    offsets = np.arange(-STAMP_RADIUS, STAMP_RADIUS + 1)
+    for (x, y), flux, colour in zip(transform(positions), fluxes, colours):
+        x0 = int(round(x))
+        y0 = int(round(y))
+        xs = offsets + x0
+        ys = offsets + y0
+        keep_x = (xs >= 0) & (xs < width)
+        keep_y = (ys >= 0) & (ys < height)
+        if not keep_x.any() or not keep_y.any():
+            continue
+        xs = xs[keep_x]
+        ys = ys[keep_y]
+        profile_x = np.exp(-(xs - x) ** 2 / (2 * STAR_SIGMA ** 2))
+        profile_y = np.exp(-(ys - y) ** 2 / (2 * STAR_SIGMA ** 2))
+        stamp = flux / (2 * np.pi * STAR_SIGMA ** 2) * np.outer(profile_y, profile_x)
+        image[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1] += stamp[:, :, np.newaxis] * colour
+    return image
+
+
+# Keeps in each pixel only the colour of bayer mask filter above it.
+def mosaic(image, mask):
+    result = image[:, :, 1].copy()
+    (red_row, red_col), (blue_row, blue_col) = RED_BLUE_POSITIONS[mask]
+    result[red_row::2, red_col::2] = image[red_row::2, red_col::2, 0]
+    result[blue_row::2, blue_col::2] = image[blue_row::2, blue_col::2, 2]
+    return result
+
+
+# Returns synthetic uint16 frame of star field moved by transform, mono or mosaicked with bayer mask.
+def make_frame(shape, field, transform, mask=None, seed=0):
+    image = render_stars(shape, *field, transform)
+    if mask is None:
+        image = image.mean(axis=2)
+    else:
+        image = mosaic(image, mask)
+    rng = np.random.default_rng(seed + 2)
+    image += SKY_LEVEL + rng.normal(0, NOISE_SIGMA, image.shape)
+    return np.clip(image, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+# Writes n synthetic frames to FITS files in directory. Returns their paths and transformations of frames
+# from the first (reference) one.
+def make_frames(directory, shape, n, mask=None, rotation=True, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    field = star_field(shape, seed)
+    transforms = frame_transforms(shape, n, rotation, seed)
+    paths = []
+    for i, transform in enumerate(transforms):
+        path = os.path.join(directory, f'frame{i:03d}.fits')
+        pyfits.PrimaryHDU(make_frame(shape, field, transform, mask, seed + i)).writeto(path, overwrite=True)
+        paths.append(path)
+    return paths, transforms
+
+
+# Returns RMS distance in pixels between star positions of reference frame and positions of the same stars
+# in frame generated by true_transform, mapped back by found transformation of frame onto reference frame.
+def registration_error(found, true_transform, positions):
+    mapped = found(true_transform(positions))
+    return float(np.sqrt(np.mean(np.sum((mapped - positions) ** 2, axis=1))))
@@ -1,10 +1,14 @@
+import multiprocessing
 import tkinter as tk
 from astrostacker.gui.MainFrame import MainFrame
 
 
-root = tk.Tk()
-root.title('Obrabiarka kosmosu')
-root.rowconfigure(0, weight=1)
-root.columnconfigure(0, weight=1)
-app = MainFrame(root).grid(sticky='nwes')
-root.mainloop()
+if __name__ == '__main__':
+    # Needed by registering processes in frozen executable.
+    multiprocessing.freeze_support()
+    root = tk.Tk()
+    root.title('Obrabiarka kosmosu')
+    root.rowconfigure(0, weight=1)
+    root.columnconfigure(0, weight=1)
+    app = MainFrame(root).grid(sticky='nwes')
+    root.mainloop()